@@ -0,0 +1,29 @@
+"""Add crop_cache_counters table
+
+Revision ID: 0b5d7e2c9a14
+Revises: f1b7d3a95c24
+Create Date: 2026-10-18 16:20:44.918306
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '0b5d7e2c9a14'
+down_revision: Union[str, None] = 'f1b7d3a95c24'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    # Crop cache hits and misses, written by the workers and read by the API
+    op.create_table(
+        'crop_cache_counters',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('hits', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('misses', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+
+def downgrade() -> None:
+    op.drop_table('crop_cache_counters')
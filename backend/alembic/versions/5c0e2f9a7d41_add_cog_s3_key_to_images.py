@@ -0,0 +1,24 @@
+"""Add cog_s3_key column to images
+
+Revision ID: 5c0e2f9a7d41
+Revises: 321a878cd2fa
+Create Date: 2026-10-18 09:12:40.118273
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '5c0e2f9a7d41'
+down_revision: Union[str, None] = '321a878cd2fa'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    # S3 key of the Cloud-Optimized GeoTIFF produced at ingest
+    op.add_column('images', sa.Column('cog_s3_key', sa.String(), nullable=True))
+    op.create_unique_constraint('images_cog_s3_key_key', 'images', ['cog_s3_key'])
+
+def downgrade() -> None:
+    op.drop_constraint('images_cog_s3_key_key', 'images', type_='unique')
+    op.drop_column('images', 'cog_s3_key')
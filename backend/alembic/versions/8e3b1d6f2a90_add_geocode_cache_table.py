@@ -0,0 +1,35 @@
+"""Add geocode_cache table
+
+Revision ID: 8e3b1d6f2a90
+Revises: 5c0e2f9a7d41
+Create Date: 2026-10-18 10:02:17.532904
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '8e3b1d6f2a90'
+down_revision: Union[str, None] = '5c0e2f9a7d41'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    op.create_table(
+        'geocode_cache',
+        sa.Column('cell_key', sa.String(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+        sa.Column('last_used_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('expires_at', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('address', sa.String(), nullable=False),
+        sa.Column('source', sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint('cell_key'),
+    )
+    op.create_index(op.f('ix_geocode_cache_last_used_at'), 'geocode_cache', ['last_used_at'], unique=False)
+    op.create_index(op.f('ix_geocode_cache_expires_at'), 'geocode_cache', ['expires_at'], unique=False)
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_geocode_cache_expires_at'), table_name='geocode_cache')
+    op.drop_index(op.f('ix_geocode_cache_last_used_at'), table_name='geocode_cache')
+    op.drop_table('geocode_cache')
@@ -0,0 +1,37 @@
+"""Add crop_analysis_cache table
+
+Revision ID: a41c7e9d3b52
+Revises: 8e3b1d6f2a90
+Create Date: 2026-10-18 11:26:40.118305
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = 'a41c7e9d3b52'
+down_revision: Union[str, None] = '8e3b1d6f2a90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    op.create_table(
+        'crop_analysis_cache',
+        sa.Column('content_hash', sa.String(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('last_used_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('s3_key', sa.String(), nullable=False),
+        sa.Column('model', sa.String(), nullable=False),
+        sa.Column('prompt_version', sa.String(), nullable=False),
+        sa.Column('data', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+        sa.Column('hit_count', sa.Integer(), server_default='0', nullable=False),
+        sa.PrimaryKeyConstraint('content_hash'),
+    )
+    op.create_index(op.f('ix_crop_analysis_cache_last_used_at'), 'crop_analysis_cache', ['last_used_at'], unique=False)
+    op.create_index(op.f('ix_crop_analysis_cache_s3_key'), 'crop_analysis_cache', ['s3_key'], unique=False)
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_crop_analysis_cache_s3_key'), table_name='crop_analysis_cache')
+    op.drop_index(op.f('ix_crop_analysis_cache_last_used_at'), table_name='crop_analysis_cache')
+    op.drop_table('crop_analysis_cache')
@@ -0,0 +1,51 @@
+"""Add processing_jobs table
+
+Revision ID: c7f2a8e41d63
+Revises: a41c7e9d3b52
+Create Date: 2026-10-18 12:48:05.274611
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7f2a8e41d63'
+down_revision: Union[str, None] = 'a41c7e9d3b52'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    op.create_table(
+        'processing_jobs',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+        sa.Column('image_id', sa.Integer(), nullable=False),
+        sa.Column('status', sa.String(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('max_attempts', sa.Integer(), nullable=False),
+        sa.Column('run_after', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('worker_id', sa.String(), nullable=True),
+        sa.Column('lease_expires_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('heartbeat_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('started_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('finished_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('last_error', sa.String(), nullable=True),
+        sa.ForeignKeyConstraint(['image_id'], ['images.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index(op.f('ix_processing_jobs_image_id'), 'processing_jobs', ['image_id'], unique=False)
+    op.create_index(op.f('ix_processing_jobs_status'), 'processing_jobs', ['status'], unique=False)
+    op.create_index(op.f('ix_processing_jobs_lease_expires_at'), 'processing_jobs', ['lease_expires_at'], unique=False)
+    # At most one queued or running job per image; enqueue_job relies on it when requests race
+    op.create_index(
+        'uq_processing_jobs_active_image_id', 'processing_jobs', ['image_id'], unique=True,
+        postgresql_where=sa.text("status IN ('queued', 'running')"),
+    )
+
+def downgrade() -> None:
+    op.drop_index('uq_processing_jobs_active_image_id', table_name='processing_jobs')
+    op.drop_index(op.f('ix_processing_jobs_lease_expires_at'), table_name='processing_jobs')
+    op.drop_index(op.f('ix_processing_jobs_status'), table_name='processing_jobs')
+    op.drop_index(op.f('ix_processing_jobs_image_id'), table_name='processing_jobs')
+    op.drop_table('processing_jobs')
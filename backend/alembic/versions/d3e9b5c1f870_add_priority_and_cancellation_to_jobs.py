@@ -0,0 +1,29 @@
+"""Add priority, fair share and cancellation to processing_jobs
+
+Revision ID: d3e9b5c1f870
+Revises: c7f2a8e41d63
+Create Date: 2026-10-18 13:35:51.906127
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = 'd3e9b5c1f870'
+down_revision: Union[str, None] = 'c7f2a8e41d63'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    op.add_column('processing_jobs', sa.Column('priority', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('processing_jobs', sa.Column('fair_share_key', sa.String(), nullable=True))
+    op.add_column('processing_jobs', sa.Column('cancel_requested_at', sa.DateTime(timezone=True), nullable=True))
+    op.create_index(op.f('ix_processing_jobs_priority'), 'processing_jobs', ['priority'], unique=False)
+    op.create_index(op.f('ix_processing_jobs_fair_share_key'), 'processing_jobs', ['fair_share_key'], unique=False)
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_processing_jobs_fair_share_key'), table_name='processing_jobs')
+    op.drop_index(op.f('ix_processing_jobs_priority'), table_name='processing_jobs')
+    op.drop_column('processing_jobs', 'cancel_requested_at')
+    op.drop_column('processing_jobs', 'fair_share_key')
+    op.drop_column('processing_jobs', 'priority')
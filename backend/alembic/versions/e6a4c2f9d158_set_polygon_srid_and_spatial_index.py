@@ -0,0 +1,70 @@
+"""Set the SRID of polygons.coordinates to 4326 and add a GiST index
+
+Nothing here rewrites the table or blocks writes for long: geometries are
+re-tagged in small batches, the SRID is enforced with a CHECK constraint
+added NOT VALID and validated separately (validation only takes a SHARE
+UPDATE EXCLUSIVE lock), and the index is built CONCURRENTLY. The column keeps
+its geometry(POLYGON) type; changing its type modifier to
+geometry(POLYGON, 4326) would rewrite the whole table under an ACCESS
+EXCLUSIVE lock, so it is left to a separately scheduled maintenance step.
+
+Revision ID: e6a4c2f9d158
+Revises: d3e9b5c1f870
+Create Date: 2026-10-18 14:02:17.436281
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = 'e6a4c2f9d158'
+down_revision: Union[str, None] = 'd3e9b5c1f870'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Rows re-tagged per transaction, so the update never holds many row locks for long
+SRID_BATCH_SIZE = 5000
+
+def retag_polygons(bind) -> None:
+    # Geometries written without an SRID are re-tagged in small committed batches
+    while True:
+        result = bind.execute(sa.text(
+            "UPDATE polygons SET coordinates = ST_SetSRID(coordinates, 4326) "
+            "WHERE id IN (SELECT id FROM polygons WHERE coordinates IS NOT NULL AND ST_SRID(coordinates) <> 4326 LIMIT :batch_size)"
+        ), {"batch_size": SRID_BATCH_SIZE})
+        if result.rowcount == 0:
+            break
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        bind = op.get_bind()
+        retag_polygons(bind)
+
+        # NOT VALID skips the scan of existing rows, so the ACCESS EXCLUSIVE lock is only held for an instant;
+        # from here on every insert and update must carry SRID 4326. An interrupted run may have added it already.
+        op.execute(
+            "DO $$ BEGIN "
+            "IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'ck_polygons_coordinates_srid') THEN "
+            "ALTER TABLE polygons ADD CONSTRAINT ck_polygons_coordinates_srid "
+            "CHECK (ST_SRID(coordinates) = 4326) NOT VALID; END IF; END $$"
+        )
+        # Rows written without an SRID between the first pass and the constraint
+        retag_polygons(bind)
+        # Scans the table under SHARE UPDATE EXCLUSIVE, which lets reads and writes continue
+        op.execute("ALTER TABLE polygons VALIDATE CONSTRAINT ck_polygons_coordinates_srid")
+
+    with op.get_context().autocommit_block():
+        # A previously interrupted concurrent build leaves an invalid index behind that IF NOT EXISTS would keep
+        op.execute(
+            "DO $$ BEGIN "
+            "IF EXISTS (SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+            "WHERE pg_class.relname = 'idx_polygons_coordinates' AND NOT pg_index.indisvalid) THEN "
+            "DROP INDEX idx_polygons_coordinates; END IF; END $$"
+        )
+        # CONCURRENTLY keeps inserts and updates of polygons running while the index builds
+        op.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_polygons_coordinates ON polygons USING gist (coordinates)")
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS idx_polygons_coordinates")
+    op.execute("ALTER TABLE polygons DROP CONSTRAINT IF EXISTS ck_polygons_coordinates_srid")
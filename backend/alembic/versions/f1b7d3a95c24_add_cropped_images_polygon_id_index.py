@@ -0,0 +1,30 @@
+"""Add an index on cropped_images.polygon_id
+
+Revision ID: f1b7d3a95c24
+Revises: e6a4c2f9d158
+Create Date: 2026-10-18 14:41:09.572813
+"""
+from typing import Sequence, Union
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = 'f1b7d3a95c24'
+down_revision: Union[str, None] = 'e6a4c2f9d158'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+def upgrade() -> None:
+    # Vector tiles count the obstructions of the polygons in a tile through this column
+    with op.get_context().autocommit_block():
+        op.create_index(
+            op.f('ix_cropped_images_polygon_id'), 'cropped_images', ['polygon_id'],
+            unique=False, postgresql_concurrently=True, if_not_exists=True,
+        )
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            op.f('ix_cropped_images_polygon_id'), table_name='cropped_images',
+            postgresql_concurrently=True, if_exists=True,
+        )
@@ -60,4 +60,18 @@ def get_heat_map_data(db: Session = Depends(get_db)) -> List[schemas.HeatMapResp
         MetricsResponse: Dictionary with the analytics data.
     """
     analytics_data = services.get_heat_map_data(db)
-    return analytics_data
\ No newline at end of file
+    return analytics_data
+
+# -------------------------------- Crop Cache --------------------------------
+@router.get("/crop-cache", response_model=schemas.CropCacheStatsResponse)
+def get_crop_cache_stats(db: Session = Depends(get_db)) -> schemas.CropCacheStatsResponse:
+    """
+    Endpoint to get the hit and miss counts of the crop analysis cache.
+    
+    Args:
+        db (Session): The SQLAlchemy database session.
+        
+    Returns:
+        CropCacheStatsResponse: Hits and misses recorded by the workers, entries and their recorded hits.
+    """
+    return services.get_crop_cache_stats(db)
@@ -2,7 +2,7 @@ import boto3
 from botocore.exceptions import NoCredentialsError, PartialCredentialsError
 import os
 from dotenv import load_dotenv
-from app import crud, schemas, processing, lvm, models
+from app import crud, schemas, processing, lvm, models, ingest, services, jobs
 from app.db import SessionLocal
 from PIL import Image
 from typing import List, Optional, Union
@@ -23,6 +23,7 @@ import asyncio
 import threading
 import json
 from app.websockets import manager
+from app.raster_cache import raster_cache
 from concurrent.futures import ThreadPoolExecutor
 
 from app import crud, schemas, processing
@@ -132,6 +133,15 @@ def generate_presigned_url(s3_key: str, expiration: int = 3600):
 @router.websocket("/ws/{image_id}")
 async def websocket_endpoint(websocket: WebSocket, image_id: int):
     await manager.connect(websocket, image_id)
+    # Late subscribers start from the status the worker last persisted instead of waiting for the next update
+    db = SessionLocal()
+    try:
+        statuses = await run_in_threadpool(crud.get_processing_statuses, db, [image_id])
+    finally:
+        db.close()
+    status = statuses.get(image_id)
+    if status is not None:
+        await manager.send_progress(image_id, status)
     try:
         while True:
             await websocket.receive_text()
@@ -228,7 +238,7 @@ async def generate_presigned_url_upload(
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/notify-backend")
-async def notify_backend(s3_key: str, label: str, db: Session = Depends(get_db)):
+async def notify_backend(s3_key: str, label: str, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
     try:
         # Extract filename from the s3_key
         filename = s3_key.split("/")[-1]
@@ -237,10 +247,13 @@ async def notify_backend(s3_key: str, label: str, db: Session = Depends(get_db))
         image = schemas.ImageCreate(
             filename=filename,  # Filename extracted from the S3 key
             label=label,
-            image_original_s3_key=s3_key  # Store the S3 key for later access
+            original_s3_key=s3_key  # Store the S3 key for later access
         )
         db_image = crud.create_image(db=db, image=image)
 
+        # Rewrite the upload as a Cloud-Optimized GeoTIFF once the response has been sent
+        background_tasks.add_task(ingest.ingest_image, db_image.id)
+
         # Simulate processing logic (you can add more complex processing here)
         # In this example, we assume that the image gets processed in a separate task or service
         
@@ -258,6 +271,7 @@ async def notify_backend(s3_key: str, label: str, db: Session = Depends(get_db))
 # -------------------------------- Upload - DEPRECATED Normal Method --------------------------------
 @router.post("/")
 async def upload_file(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...), 
     label: str = Form(...),  # Accepting label as a form field
     db: Session = Depends(get_db)
@@ -297,6 +311,9 @@ async def upload_file(
         # Update the image record with the new S3 object key
         crud.update_image_s3_key(db, image_id=db_image.id, image_original_s3_key=prefixed_new_filename)
 
+        # Rewrite the upload as a Cloud-Optimized GeoTIFF once the response has been sent
+        background_tasks.add_task(ingest.ingest_image, db_image.id)
+
         return schemas.ImageResponse(
             id=db_image.id,
             created_at=db_image.created_at,
@@ -321,6 +338,7 @@ async def upload_file(
 # Chunk method save chunk to s3
 @router.post("/upload-chunk/")
 async def upload_file_chunk(
+    background_tasks: BackgroundTasks,
     chunk_number: int = Form(...),
     total_chunks: int = Form(...),
     label: str = Form(...),
@@ -404,6 +422,9 @@ async def upload_file_chunk(
             db_image = crud.create_image(db=db, image=image)
             crud.update_image_s3_key(db, image_id=db_image.id, image_original_s3_key=final_key)
 
+            # Rewrite the upload as a Cloud-Optimized GeoTIFF once the response has been sent
+            background_tasks.add_task(ingest.ingest_image, db_image.id)
+
             # Clean up all the chunk files from S3 after final file assembly
             logging.info("Cleaning up chunk files from S3...")
             await cleanup_chunks(new_filename, total_chunks)
@@ -461,6 +482,13 @@ async def delete_files(ids: Union[int, List[int]], db: Session = Depends(get_db)
                 except s3_client.exceptions.NoSuchKey:
                     logging.warning(f"{db_image.original_s3_key} not found in S3")
             
+            if db_image.cog_s3_key:
+                try:
+                    s3_client.delete_object(Bucket=BUCKET_NAME, Key=db_image.cog_s3_key)
+                    logging.info(f"Deleted {db_image.cog_s3_key} from S3")
+                except s3_client.exceptions.NoSuchKey:
+                    logging.warning(f"{db_image.cog_s3_key} not found in S3")
+
             if db_image.annotated_s3_key:
                 print(db_image.annotated_s3_key)
                 try:
@@ -477,6 +505,18 @@ async def delete_files(ids: Union[int, List[int]], db: Session = Depends(get_db)
                 except s3_client.exceptions.NoSuchKey:
                     logging.warning(f"{cropped_image_key} not found in S3")
 
+                # Full-resolution archive, if one was ever requested (deleting a missing key is a no-op)
+                for extension in (".jpg", ".tif"):
+                    s3_client.delete_object(Bucket=BUCKET_NAME, Key=processing.get_full_resolution_s3_key(cropped_image_key, extension))
+
+            # Local copies of the source rasters; the API shares the workers' cache directory (RASTER_CACHE_DIR)
+            for source_s3_key in (db_image.original_s3_key, db_image.cog_s3_key):
+                if source_s3_key:
+                    raster_cache.evict(f's3://{BUCKET_NAME}/{source_s3_key}')
+
+            # Cached analyses must not point at the deleted crops
+            services.purge_crop_cache(db, [cropped_image.s3_key for cropped_image in db_image.cropped_images])
+
             # Delete the image record from the database
             crud.delete_image(db=db, image_id=id)
 
@@ -507,20 +547,56 @@ async def delete_files(ids: Union[int, List[int]], db: Session = Depends(get_db)
 #     except Exception as e:
 #         raise HTTPException(status_code=500, detail=str(e))
 
-# Process Image Endpoint
-executor = ThreadPoolExecutor(max_workers=1)
+# # Process Image Endpoint
+# executor = ThreadPoolExecutor(max_workers=1)
+
+# @router.post("/process-image")
+# async def process_image_endpoint(id: int, db: Session = Depends(get_db)):
+#     try:
+#         db_image = crud.get_image_by_id(db, image_id=id)
+#         if not db_image:
+#             raise HTTPException(status_code=404, detail="Image not found")
 
+#         loop = asyncio.get_event_loop()
+#         loop.run_in_executor(executor, processing.process_image, db, db_image)
+
+#         return {"message": "Image processing started", "id": id}
+#     except Exception as e:
+#         raise HTTPException(status_code=500, detail=str(e))
+
+# Process Image Endpoint - jobs are picked up by the workers (python -m app.worker)
 @router.post("/process-image")
-async def process_image_endpoint(id: int, db: Session = Depends(get_db)):
+async def process_image_endpoint(
+    id: int,
+    priority: int = 0,  # Higher is claimed first, e.g. for an urgent single-site check
+    owner: Optional[str] = None,  # Uploader to share workers fairly by; defaults to the image label
+    db: Session = Depends(get_db)
+):
     try:
         db_image = crud.get_image_by_id(db, image_id=id)
         if not db_image:
             raise HTTPException(status_code=404, detail="Image not found")
 
-        loop = asyncio.get_event_loop()
-        loop.run_in_executor(executor, processing.process_image, db, db_image)
+        fair_share_key = owner or db_image.label or "unlabelled"
+        db_job = jobs.enqueue_job(db, image_id=id, priority=priority, fair_share_key=fair_share_key)
+
+        return {"message": "Image processing queued", "id": id, "job_id": db_job.id, "priority": db_job.priority}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Cancel Processing Endpoint - a running job stops between polygons
+@router.post("/cancel-processing/{id}")
+async def cancel_processing_endpoint(id: int, db: Session = Depends(get_db)):
+    try:
+        db_job = jobs.cancel_job(db, image_id=id)
+        if not db_job:
+            raise HTTPException(status_code=404, detail="No queued or running processing job for this image")
 
-        return {"message": "Image processing started", "id": id}
+        return {"message": "Image processing cancelled", "id": id, "job_id": db_job.id, "status": db_job.status}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
@@ -528,13 +604,27 @@ async def process_image_endpoint(id: int, db: Session = Depends(get_db)):
 @router.get("/processing-status/{id}")
 async def get_processing_status(id: int, db: Session = Depends(get_db)):
     try:
-        # Retrieve image details from the database
-        db_image = crud.get_image_by_id(db, image_id=id)
-        if not db_image:
+        # Persisted by the worker running the job, so every API process sees the same status
+        statuses = crud.get_processing_statuses(db, [id])
+        if id not in statuses:
             raise HTTPException(status_code=404, detail="Image not found")
 
         # Return processing status
-        return {"status": db_image.processing_status}  # Adjust according to your implementation
+        return {"status": statuses[id]}  # Adjust according to your implementation
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+# -------------------------------- Full-Resolution Crop --------------------------------
+@router.get("/cropped-images/{cropped_image_id}/full-resolution")
+async def get_full_resolution_crop(cropped_image_id: int, db: Session = Depends(get_db)):
+    try:
+        # Produced on first request, then served from S3
+        s3_key = await run_in_threadpool(processing.archive_full_resolution_crop, db, cropped_image_id)
+        return {"url": generate_presigned_url(s3_key)}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
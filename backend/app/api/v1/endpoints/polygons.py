@@ -1,10 +1,8 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, UploadFile, File, Form
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 from fastapi.responses import StreamingResponse
-import pandas as pd
-import io
-from app import crud, schemas
+from app import crud, schemas, services
 from app.db import SessionLocal
 
 router = APIRouter()
@@ -18,8 +16,24 @@ def get_db():
 
 # -------------------------------- Get Polygons --------------------------------
 @router.get("/", response_model=List[schemas.Polygon])
-def get_polygons(skip: int = 0, limit: int = None, db: Session = Depends(get_db)):
-    return crud.get_polygons(db=db, skip=skip, limit=limit)
+def get_polygons(
+    skip: int = 0,
+    limit: int = None,
+    bbox: Optional[str] = Query(None, description="Viewport as min_lon,min_lat,max_lon,max_lat"),
+    zoom: Optional[int] = Query(None, ge=0, le=24, description="Map zoom level used to simplify geometries"),
+    db: Session = Depends(get_db),
+):
+    if bbox is None:
+        return crud.get_polygons(db=db, skip=skip, limit=limit)
+
+    # Viewport mode: only what is on screen, simplified for the zoom level
+    try:
+        bounds = tuple(float(value) for value in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox must be four numbers: min_lon,min_lat,max_lon,max_lat")
+    if len(bounds) != 4 or bounds[0] > bounds[2] or bounds[1] > bounds[3]:
+        raise HTTPException(status_code=400, detail="bbox must be four numbers: min_lon,min_lat,max_lon,max_lat")
+    return crud.get_polygons_in_viewport(db=db, bounds=bounds, zoom=zoom, limit=limit)
 
 # -------------------------------- Create Polygon --------------------------------
 @router.post("/", response_model=schemas.Polygon)
@@ -29,6 +43,35 @@ def create_polygon(polygon: schemas.PolygonCreate, db: Session = Depends(get_db)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+# -------------------------------- Import Polygons --------------------------------
+@router.post("/import", response_model=schemas.PolygonImportResponse)
+def import_polygons(file: UploadFile = File(...), dry_run: bool = Form(False), db: Session = Depends(get_db)):
+    # GeoJSON (.geojson/.json), CSV (.csv) or a zipped Shapefile (.zip); valid rows are imported, the rest reported
+    try:
+        parsed = services.read_polygon_upload(file.filename, file.file.read())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    valid = services.validate_polygons(parsed)
+    ids = []
+    if not dry_run and len(valid):
+        ids = crud.create_polygons_bulk(
+            db=db,
+            rows=[parsed.rows[index] for index in valid],
+            geometries=[parsed.geometries[index] for index in valid],
+        )
+
+    return schemas.PolygonImportResponse(
+        total=len(parsed.rows),
+        imported=len(ids),
+        failed=len(parsed.errors),
+        ids=ids,
+        errors=[
+            schemas.PolygonImportError(row=index + 1, error=error)
+            for index, error in sorted(parsed.errors.items())
+        ],
+    )
+
 # -------------------------------- Update Polygons by id --------------------------------
 @router.put("/{polygon_id}", response_model=schemas.Polygon)
 def update_polygon(polygon_id: int, polygon: schemas.PolygonUpdate, db: Session = Depends(get_db)):
@@ -45,39 +88,27 @@ def delete_polygon(polygon_id: int, db: Session = Depends(get_db)):
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+# -------------------------------- Export Polygons --------------------------------
+@router.get("/export")
+def export_polygons(format: str = "csv", skip: int = 0, limit: int = None):
+    # Streamed from Postgres with COPY, so memory stays flat whatever the number of polygons
+    if format not in services.EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format '{format}', expected one of {', '.join(services.EXPORT_FORMATS)}")
+
+    export_format = services.EXPORT_FORMATS[format]
+    response = StreamingResponse(
+        services.stream_polygon_export(format, skip=skip, limit=limit),
+        media_type=export_format["media_type"]
+    )
+    response.headers["Content-Disposition"] = f"attachment; filename=polygons.{export_format['extension']}"
+    return response
+
 # -------------------------------- Download Polygons CSV --------------------------------
 @router.get("/download-csv")
 def download_csv(skip: int = 0, limit: int = None, db: Session = Depends(get_db)):
-    polygons = crud.get_polygons(db=db, skip=skip, limit=limit)
-    
-    if not polygons:
+    # Checked before streaming, since the status can't change once the CSV header is sent
+    if limit == 0 or not crud.polygons_exist(db=db, skip=skip):
         raise HTTPException(status_code=404, detail="No polygons found")
 
-    # Convert the polygons to a list of dictionaries
-    polygons_dict = [
-        {
-            "id": poly.id,
-            "name": poly.name,
-            "address": poly.address,
-            "type": poly.type,
-            "coordinates": poly.coordinates  # Ensure this is a serializable format
-        }
-        for poly in polygons
-    ]
-    
-    # Convert the list of dictionaries to a DataFrame
-    df = pd.DataFrame(polygons_dict)
-    
-    # Convert DataFrame to CSV
-    output = io.StringIO()
-    df.to_csv(output, index=False)
-    output.seek(0)
+    return export_polygons(format="csv", skip=skip, limit=limit)
 
-    # Stream the CSV back as a response
-    response = StreamingResponse(
-        iter([output.getvalue()]),
-        media_type="text/csv"
-    )
-    response.headers["Content-Disposition"] = "attachment; filename=polygons.csv"
-    return response
-    
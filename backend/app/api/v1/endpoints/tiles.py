@@ -0,0 +1,22 @@
+from fastapi import APIRouter, Depends, HTTPException, Response
+from sqlalchemy.orm import Session
+from app import tiles
+from app.db import SessionLocal
+
+router = APIRouter()
+
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+# -------------------------------- Polygon Vector Tiles --------------------------------
+@router.get("/{z}/{x}/{y}.mvt")
+def get_polygon_tile(z: int, x: int, y: int, db: Session = Depends(get_db)):
+    # Layer 'polygons' with id, name, address, type, latest_status and obstruction_count per feature
+    if not tiles.is_valid_tile(z, x, y):
+        raise HTTPException(status_code=400, detail=f"Invalid tile {z}/{x}/{y}")
+    data = tiles.get_polygon_tile(db, z, x, y)
+    return Response(content=data, media_type="application/vnd.mapbox-vector-tile")
@@ -18,6 +18,7 @@
 
 from .crud_polygons import *
 from .crud_images import *
+from .crud_batch import *
 
 
 # import pkgutil
@@ -0,0 +1,170 @@
+import os
+import time
+
+from sqlalchemy import insert, update, bindparam, func
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from dotenv import load_dotenv
+
+from app import models, schemas, lvm
+from .crud_images import get_polygon_status
+from app.tiles import invalidate_polygon_tiles
+
+load_dotenv()
+
+# A batch is written once it holds this many crop results, or once its oldest result is this old
+CROP_WRITE_BATCH_SIZE = int(os.getenv("CROP_WRITE_BATCH_SIZE", "50"))
+CROP_WRITE_FLUSH_SECONDS = float(os.getenv("CROP_WRITE_FLUSH_SECONDS", "2"))
+
+
+# -------------------------------- Batched crop result writer --------------------------------
+class PendingCroppedImage:
+    """A buffered cropped image row; id is set once the batch holding it is written."""
+
+    def __init__(self, values: dict):
+        self.values = values
+        self.id = None
+
+
+class CropResultWriter:
+    """
+    Unit of work for the results of an image's polygon crops.
+
+    Cropped image rows (with their analysis) and the resulting Polygon.latest_status
+    values are buffered and written with one multi-row INSERT, one executemany
+    UPDATE and a single commit per batch, instead of several commits and refreshes
+    per polygon. Call flush() to write the buffer now; close() flushes what is left
+    and closes the session. Once discard_event is set (e.g. the worker lost its
+    job to another one), buffered rows are dropped instead of written.
+    """
+
+    def __init__(self, db: Session, batch_size: int = CROP_WRITE_BATCH_SIZE, flush_seconds: float = CROP_WRITE_FLUSH_SECONDS, discard_event=None):
+        self.db = db
+        self.discard_event = discard_event
+        self.batch_size = max(1, batch_size)
+        self.flush_seconds = flush_seconds
+        self._pending = []
+        self._polygon_statuses = {}
+        self._cache_entries = {}  # content_hash -> crop cache row for crops analysed by the model
+        self._cache_hits = []  # content hashes of crops reused from the cache
+        self._cache_misses = 0  # Crops looked up in the cache and analysed by the model
+        self._oldest_pending_at = None
+        self.rows_written = 0
+        self.flushes = 0
+
+    def add(self, cropped_image: schemas.CroppedImageCreate, data, content_hash: str = None, cache_s3_key: str = None, cache_hit: bool = False) -> PendingCroppedImage:
+        """
+        Buffer a cropped image row.
+
+        content_hash is the crop's content address and cache_s3_key the
+        content-addressed copy of the crop; a fresh analysis (cache_hit False) is
+        also stored in the crop cache under them, while a reused one counts as a
+        hit on the existing entry.
+        """
+        values = cropped_image.dict()
+        values["data"] = data
+        pending = PendingCroppedImage(values)
+        self._pending.append(pending)
+        # Only the latest result per polygon decides its status
+        self._polygon_statuses[cropped_image.polygon_id] = get_polygon_status(data)
+        if content_hash is not None:
+            if cache_hit:
+                self._cache_hits.append(content_hash)
+            else:
+                self._cache_misses += 1
+                self._cache_entries[content_hash] = {
+                    "content_hash": content_hash,
+                    "s3_key": cache_s3_key,
+                    "model": lvm.MODEL_NAME,
+                    "prompt_version": lvm.PROMPT_VERSION,
+                    "data": data,
+                }
+        if self._oldest_pending_at is None:
+            self._oldest_pending_at = time.time()
+
+        if len(self._pending) >= self.batch_size or time.time() - self._oldest_pending_at >= self.flush_seconds:
+            self.flush()
+        return pending
+
+    def discard(self):
+        # Drop everything buffered without writing it
+        if self._pending:
+            print(f"Discarded {len(self._pending)} buffered cropped images")
+        self._pending = []
+        self._polygon_statuses = {}
+        self._cache_entries = {}
+        self._cache_hits = []
+        self._cache_misses = 0
+        self._oldest_pending_at = None
+
+    def flush(self):
+        if self.discard_event is not None and self.discard_event.is_set():
+            self.discard()
+            return
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        polygon_statuses, self._polygon_statuses = self._polygon_statuses, {}
+        cache_entries, self._cache_entries = list(self._cache_entries.values()), {}
+        cache_hits, self._cache_hits = self._cache_hits, []
+        cache_misses, self._cache_misses = self._cache_misses, 0
+        self._oldest_pending_at = None
+
+        start_time = time.time()
+        try:
+            ids = self.db.scalars(
+                insert(models.CroppedImage).returning(models.CroppedImage.id, sort_by_parameter_order=True),
+                [item.values for item in pending],
+            ).all()
+            self.db.execute(
+                update(models.Polygon),
+                [{"id": polygon_id, "latest_status": status} for polygon_id, status in polygon_statuses.items()],
+            )
+            if cache_entries:
+                # Legacy entries for the same crop, pointing at a per-image key, are moved to the content-addressed copy
+                cache_insert = pg_insert(models.CropAnalysisCache)
+                self.db.execute(
+                    cache_insert.on_conflict_do_update(
+                        index_elements=["content_hash"],
+                        set_={"s3_key": cache_insert.excluded.s3_key, "data": cache_insert.excluded.data},
+                        where=models.CropAnalysisCache.s3_key != cache_insert.excluded.s3_key,
+                    ),
+                    cache_entries,
+                )
+            if cache_hits:
+                self.db.execute(
+                    update(models.CropAnalysisCache.__table__)
+                    .where(models.CropAnalysisCache.content_hash == bindparam("hit_hash"))
+                    .values(hit_count=models.CropAnalysisCache.hit_count + 1, last_used_at=func.now()),
+                    [{"hit_hash": content_hash} for content_hash in cache_hits],
+                )
+            if cache_hits or cache_misses:
+                # Counted in the database, since lookups happen in the workers and the stats are read by the API
+                counter_insert = pg_insert(models.CropCacheCounter).values(id=1, hits=len(cache_hits), misses=cache_misses)
+                self.db.execute(counter_insert.on_conflict_do_update(
+                    index_elements=["id"],
+                    set_={
+                        "hits": models.CropCacheCounter.hits + counter_insert.excluded.hits,
+                        "misses": models.CropCacheCounter.misses + counter_insert.excluded.misses,
+                        "updated_at": func.now(),
+                    },
+                ))
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+
+        # New analyses change the status and obstruction count drawn in the polygons' tiles
+        invalidate_polygon_tiles(self.db, polygon_statuses.keys())
+
+        for item, cropped_image_id in zip(pending, ids):
+            item.id = cropped_image_id
+        self.rows_written += len(pending)
+        self.flushes += 1
+        print(f"Wrote {len(pending)} cropped images and {len(polygon_statuses)} polygon statuses in {time.time() - start_time:.2f} seconds.")
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.db.close()
@@ -1,9 +1,10 @@
 from sqlalchemy.orm import Session
-from app import models, schemas
+from app import models, schemas, geo
+from app.tiles import invalidate_polygon_tiles
 from shapely.geometry import Polygon
 from geoalchemy2.shape import from_shape, to_shape
 from shapely.geometry import mapping, box
-from sqlalchemy import asc, desc
+from sqlalchemy import asc, desc, update
 from sqlalchemy.sql import func
 from sqlalchemy.orm import joinedload 
 from fastapi import HTTPException
@@ -161,33 +162,36 @@ def update_image(db: Session, image_id: int, **kwargs):
     else:
         raise HTTPException(status_code=404, detail="Image not found")
 
+def get_image_polygon_ids(db: Session, image_id: int) -> list:
+    # Polygons with a cropped image of this image, i.e. whose obstruction counts depend on it
+    rows = db.query(models.CroppedImage.polygon_id).filter(models.CroppedImage.image_id == image_id).distinct().all()
+    return [row.polygon_id for row in rows]
+
 def delete_image(db: Session, image_id: int):
     db_image = db.query(models.Image).filter(models.Image.id == image_id).first()
     if db_image:
+        polygon_ids = get_image_polygon_ids(db, image_id)
         db.delete(db_image)
         db.commit()
+        invalidate_polygon_tiles(db, polygon_ids)
     return db_image
 
 def get_image_by_filename(db: Session, filename: str):
     return db.query(models.Image).filter(models.Image.filename == filename).first()
 
 
-def get_polygons_within_bounds(db: Session, bounds):
+def polygons_within_bounds_query(db: Session, bounds):
     min_lon, min_lat, max_lon, max_lat = bounds
 
-    # Create a Shapely box object representing the bounds
-    bounding_box = box(min_lon, min_lat, max_lon, max_lat)
+    # ST_MakeEnvelope builds the box directly in the column's SRID, so ST_Intersects
+    # can use the GiST index on coordinates for its bounding-box pre-filter
+    envelope = func.ST_MakeEnvelope(min_lon, min_lat, max_lon, max_lat, 4326)
+    return db.query(models.Polygon).filter(models.Polygon.coordinates.ST_Intersects(envelope))
 
-    # Convert the Shapely geometry to WKT (Well-Known Text) format
-    bounding_box_wkt = bounding_box.wkt
 
+def get_polygons_within_bounds(db: Session, bounds):
     # Query polygons within the bounding box
-    query = db.query(models.Polygon).filter(
-        models.Polygon.coordinates.ST_Intersects(
-            func.ST_Transform(func.ST_SetSRID(func.ST_GeomFromText(bounding_box_wkt), 4326), 4326)
-        )
-    )
-    polygons = query.all()
+    polygons = polygons_within_bounds_query(db, bounds).all()
 
     return polygons
 
@@ -203,20 +207,29 @@ def get_cropped_image_by_id(db: Session, cropped_image_id: int):
     return db.query(models.CroppedImage).filter(models.CroppedImage.id == cropped_image_id).first()
 
 def delete_cropped_images(db: Session, image_id: int):
+    polygon_ids = get_image_polygon_ids(db, image_id)
     db.query(models.CroppedImage).filter_by(image_id=image_id).delete()
     db.commit()
+    invalidate_polygon_tiles(db, polygon_ids)
 
 
 def update_processing_status(db: Session, image_id: int, status: int):
-    db_image = db.query(models.Image).filter(models.Image.id == image_id).first()
-    if db_image:
-        db_image.processing_status = status
-        db.commit()
-        db.refresh(db_image)
-    else:
+    # Single UPDATE statement, no SELECT or refresh
+    result = db.execute(
+        update(models.Image)
+        .where(models.Image.id == image_id)
+        .values(processing_status=status)
+    )
+    db.commit()
+    if result.rowcount == 0:
         raise Exception("Image not found")
     
 
+def get_processing_statuses(db: Session, image_ids: list) -> dict:
+    # Processing status of several images in one query
+    rows = db.query(models.Image.id, models.Image.processing_status).filter(models.Image.id.in_(image_ids)).all()
+    return {row.id: row.processing_status for row in rows}
+
 def get_full_image_by_id(db: Session, image_id: int) -> schemas.FullImageResponse:
     # Fetch the image from the database
     db_image = db.query(models.Image).filter(models.Image.id == image_id).first()
@@ -224,22 +237,42 @@ def get_full_image_by_id(db: Session, image_id: int) -> schemas.FullImageRespons
     if not db_image:
         return None
     
-    # Prepare the nested data for cropped images
+    # Prepare the nested data for cropped images, with every polygon ring decoded in one pass
+    rows = (
+        db.query(
+            models.CroppedImage.id,
+            models.CroppedImage.filename,
+            models.CroppedImage.s3_key,
+            models.CroppedImage.data,
+            models.Polygon.id.label("polygon_id"),
+            models.Polygon.name.label("polygon_name"),
+            models.Polygon.address.label("polygon_address"),
+            models.Polygon.type.label("polygon_type"),
+            models.Polygon.latest_status.label("polygon_latest_status"),
+            func.ST_AsBinary(models.Polygon.coordinates).label("polygon_wkb"),
+        )
+        .join(models.Polygon, models.CroppedImage.polygon_id == models.Polygon.id)
+        .filter(models.CroppedImage.image_id == image_id)
+        .order_by(models.CroppedImage.id)
+        .all()
+    )
+    polygon_coordinates = geo.ring_coordinate_lists([row.polygon_wkb for row in rows])
+
     cropped_images = [
         schemas.FullCroppedImageResponse(
-            id=cropped_image.id,
-            filename=cropped_image.filename,
-            url=generate_presigned_url(cropped_image.s3_key) if cropped_image.s3_key else None,
-            data=cropped_image.data,
+            id=row.id,
+            filename=row.filename,
+            url=generate_presigned_url(row.s3_key) if row.s3_key else None,
+            data=row.data,
             polygon=schemas.Polygon(
-                id=cropped_image.polygon.id,
-                name=cropped_image.polygon.name,
-                address=cropped_image.polygon.address,
-                type=cropped_image.polygon.type,
-                coordinates=mapping(to_shape(cropped_image.polygon.coordinates))["coordinates"][0],
-                latest_status=cropped_image.polygon.latest_status
+                id=row.polygon_id,
+                name=row.polygon_name,
+                address=row.polygon_address,
+                type=row.polygon_type,
+                coordinates=coordinates,
+                latest_status=row.polygon_latest_status
             )
-        ) for cropped_image in db_image.cropped_images
+        ) for row, coordinates in zip(rows, polygon_coordinates)
     ]
     
     # Return the full image response
@@ -253,6 +286,15 @@ def get_full_image_by_id(db: Session, image_id: int) -> schemas.FullImageRespons
         cropped_images=cropped_images
     )
 
+def get_polygon_status(data) -> models.StatusEnum:
+    # Status of a polygon given the analysis of its latest cropped image
+    if data.get('obstruction_present') == False:
+        return models.StatusEnum.clear
+    elif data.get('is_permanent') == True:
+        return models.StatusEnum.permanent
+    else:
+        return models.StatusEnum.temporary
+
 def update_cropped_image_analysis(db: Session, cropped_image_id: int, data, polygon_id: int):
     # Fetch the cropped image by ID
     db_image = db.query(models.CroppedImage).filter(models.CroppedImage.id == cropped_image_id).first()
@@ -264,12 +306,7 @@ def update_cropped_image_analysis(db: Session, cropped_image_id: int, data, poly
         db.refresh(db_image)
         
         # Determine the new status for the polygon based on the data
-        if data.get('obstruction_present') == False:
-            new_status = models.StatusEnum.clear
-        elif data.get('is_permanent') == True:
-            new_status = models.StatusEnum.permanent
-        else:
-            new_status = models.StatusEnum.temporary
+        new_status = get_polygon_status(data)
         
         # Fetch the polygon by the provided polygon_id and update its latest_status
         db_polygon = db.query(models.Polygon).filter(models.Polygon.id == polygon_id).first()
@@ -277,5 +314,8 @@ def update_cropped_image_analysis(db: Session, cropped_image_id: int, data, poly
             db_polygon.latest_status = new_status
             db.commit()
             db.refresh(db_polygon)
+
+        # The polygon's status and obstruction count are drawn in the vector tiles
+        invalidate_polygon_tiles(db, {polygon_id, db_image.polygon_id})
     
     return db_image
\ No newline at end of file
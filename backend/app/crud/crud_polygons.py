@@ -1,10 +1,23 @@
 from sqlalchemy.orm import Session
-from app import models, schemas
+from app import models, schemas, geo
+from app.tiles import tile_cache, get_polygon_bounds
 from shapely.geometry import Polygon
 from geoalchemy2.shape import from_shape, to_shape
 from shapely.geometry import mapping, box
-from sqlalchemy import asc
+from sqlalchemy import asc, insert
+from geoalchemy2.elements import WKBElement
+import shapely
 from sqlalchemy.sql import func
+import os
+import math
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Viewport queries simplify geometries to this fraction of a screen pixel at the requested zoom
+POLYGON_SIMPLIFY_PIXELS = float(os.getenv("POLYGON_SIMPLIFY_PIXELS", "0.5"))
+# From this zoom level on, viewport queries return full-precision geometries
+POLYGON_SIMPLIFY_MAX_ZOOM = int(os.getenv("POLYGON_SIMPLIFY_MAX_ZOOM", "18"))
 
 # -------------------------------- CRUD --------------------------------
 def create_polygon(db: Session, polygon: schemas.PolygonCreate):
@@ -23,10 +36,10 @@ def create_polygon(db: Session, polygon: schemas.PolygonCreate):
     db.add(db_polygon)
     db.commit()
     db.refresh(db_polygon)
+    tile_cache.invalidate_bounds(shapely_polygon.bounds)
 
     # Convert the GeoAlchemy2 geometry back to a list of coordinates for the response
-    shape = to_shape(db_polygon.coordinates)
-    coordinates = mapping(shape)["coordinates"][0]
+    coordinates = geo.ring_coordinate_lists([db_polygon.coordinates])[0]
 
     return schemas.Polygon(
         id=db_polygon.id,
@@ -37,22 +50,136 @@ def create_polygon(db: Session, polygon: schemas.PolygonCreate):
         latest_status=db_polygon.latest_status,
     )
 
+def create_polygons_bulk(db: Session, rows: list, geometries) -> list:
+    """
+    Insert many polygons in a single transaction.
+
+    Geometries are encoded to EWKB in one vectorized call and the rows go out as
+    multi-row INSERT ... RETURNING statements, with one commit at the end.
+
+    Args:
+        db (Session): The SQLAlchemy database session.
+        rows (list): {"name", "address", "type"} per polygon.
+        geometries: Valid Shapely polygons in WGS84, one per row.
+
+    Returns:
+        list: Ids of the new polygons, in the order of rows.
+    """
+    if not rows:
+        return []
+    # output_dimension=2: the column is 2D, so a stray Z must never reach the EWKB
+    ewkb = shapely.to_wkb(shapely.set_srid(geometries, 4326), hex=True, include_srid=True, output_dimension=2)
+    values = [
+        {**row, "coordinates": WKBElement(wkb, srid=4326, extended=True)}
+        for row, wkb in zip(rows, ewkb)
+    ]
+    try:
+        ids = db.scalars(
+            insert(models.Polygon).returning(models.Polygon.id, sort_by_parameter_order=True),
+            values,
+        ).all()
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    tile_cache.invalidate_bounds(tuple(shapely.total_bounds(geometries)))
+    return ids
+
+
 def get_polygons(db: Session, skip: int = 0, limit: int = None):
-    query = db.query(models.Polygon).order_by(asc(models.Polygon.id)).offset(skip)
+    # Plain columns with the geometry as WKB, so every ring is decoded in one vectorized pass
+    query = db.query(
+        models.Polygon.id,
+        models.Polygon.name,
+        models.Polygon.address,
+        models.Polygon.type,
+        models.Polygon.latest_status,
+        func.ST_AsBinary(models.Polygon.coordinates).label("wkb"),
+    ).order_by(asc(models.Polygon.id)).offset(skip)
     if limit is not None:
         query = query.limit(limit)
     polygons = query.all()
-    
+    coordinates = geo.ring_coordinate_lists([poly.wkb for poly in polygons])
+
+    return [
+        schemas.Polygon(
+            id=poly.id,
+            name=poly.name,
+            address=poly.address,
+            type=poly.type,
+            coordinates=poly_coordinates,
+            latest_status=poly.latest_status,
+        )
+        for poly, poly_coordinates in zip(polygons, coordinates)
+    ]
+
+
+def polygons_exist(db: Session, skip: int = 0) -> bool:
+    # Whether any polygon is left after skipping the first `skip`, reading at most one id
+    return db.query(models.Polygon.id).order_by(asc(models.Polygon.id)).offset(skip).limit(1).first() is not None
+
+
+def get_simplify_tolerance(zoom: int) -> float:
+    # Degrees covered by POLYGON_SIMPLIFY_PIXELS of a 256-pixel web map tile at this zoom
+    if zoom is None or zoom >= POLYGON_SIMPLIFY_MAX_ZOOM:
+        return 0.0
+    return POLYGON_SIMPLIFY_PIXELS * 360.0 / (256 * 2 ** zoom)
+
+
+def get_polygons_in_viewport(db: Session, bounds, zoom: int = None, limit: int = None):
+    """
+    Get the polygons intersecting a map viewport, simplified for its zoom level.
+
+    The bbox filter goes through the GiST index on coordinates, and geometries
+    are simplified in the database with ST_SimplifyPreserveTopology (so rings
+    stay valid) and rounded to the precision the zoom can show.
+
+    Args:
+        db (Session): The SQLAlchemy database session.
+        bounds (tuple): (min_lon, min_lat, max_lon, max_lat) of the viewport in WGS84.
+        zoom (int): Web map zoom level, or None for full-precision geometries.
+        limit (int): Maximum number of polygons to return.
+
+    Returns:
+        list: schemas.Polygon for every polygon in the viewport.
+    """
+    min_lon, min_lat, max_lon, max_lat = bounds
+    envelope = func.ST_MakeEnvelope(min_lon, min_lat, max_lon, max_lat, 4326)
+
+    tolerance = get_simplify_tolerance(zoom)
+    geometry = models.Polygon.coordinates
+    if tolerance > 0:
+        geometry = func.ST_SimplifyPreserveTopology(geometry, tolerance)
+
+    query = db.query(
+        models.Polygon.id,
+        models.Polygon.name,
+        models.Polygon.address,
+        models.Polygon.type,
+        models.Polygon.latest_status,
+        func.ST_AsBinary(geometry).label("wkb"),
+    ).filter(
+        models.Polygon.coordinates.ST_Intersects(envelope)
+    ).order_by(asc(models.Polygon.id))
+    if limit is not None:
+        query = query.limit(limit)
+    polygons = query.all()
+
+    # One decimal more than the tolerance needs, so simplified vertices still land on the right pixel
+    decimals = max(0, math.ceil(-math.log10(tolerance)) + 1) if tolerance > 0 else None
+    coordinates = geo.ring_coordinate_lists([poly.wkb for poly in polygons], decimals=decimals)
+
     return [
         schemas.Polygon(
             id=poly.id,
             name=poly.name,
             address=poly.address,
             type=poly.type,
-            coordinates=mapping(to_shape(poly.coordinates))["coordinates"][0],
+            coordinates=poly_coordinates,
             latest_status=poly.latest_status,
         )
-        for poly in polygons
+        for poly, poly_coordinates in zip(polygons, coordinates)
     ]
 
 
@@ -67,6 +194,7 @@ def update_polygon(db: Session, polygon_id: int, polygon: schemas.PolygonUpdate)
         raise ValueError("Invalid polygon coordinates")
 
     geoalchemy_polygon = from_shape(shapely_polygon, srid=4326)
+    previous_bounds = get_polygon_bounds(db, [polygon_id])
 
     db_polygon.name = polygon.name
     db_polygon.address = polygon.address
@@ -75,9 +203,11 @@ def update_polygon(db: Session, polygon_id: int, polygon: schemas.PolygonUpdate)
 
     db.commit()
     db.refresh(db_polygon)
+    # Tiles showing the polygon where it was and where it is now
+    for bounds in previous_bounds + [shapely_polygon.bounds]:
+        tile_cache.invalidate_bounds(bounds)
 
-    shape = to_shape(db_polygon.coordinates)
-    coordinates = mapping(shape)["coordinates"][0]
+    coordinates = geo.ring_coordinate_lists([db_polygon.coordinates])[0]
 
     return schemas.Polygon(
         id=db_polygon.id,
@@ -93,11 +223,13 @@ def delete_polygon(db: Session, polygon_id: int):
     if not db_polygon:
         raise ValueError("Polygon not found")
 
-    shape = to_shape(db_polygon.coordinates)
-    coordinates = list(shape.exterior.coords)
+    coordinates = geo.ring_coordinate_lists([db_polygon.coordinates])[0]
+    previous_bounds = get_polygon_bounds(db, [polygon_id])
 
     db.delete(db_polygon)
     db.commit()
+    for bounds in previous_bounds:
+        tile_cache.invalidate_bounds(bounds)
     return schemas.Polygon(
         id=db_polygon.id,
         name=db_polygon.name,
@@ -0,0 +1,134 @@
+# app/geo.py
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import shapely
+from pyproj import Transformer
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# CRS of the polygon coordinates stored in the database
+POLYGON_CRS = "EPSG:4326"
+
+# Maximum number of (src, dst) transformers kept alive in the process
+TRANSFORMER_CACHE_SIZE = int(os.getenv("TRANSFORMER_CACHE_SIZE", "32"))
+
+# -------------------------------- Transformer cache --------------------------------
+_transformers = OrderedDict()
+_transformers_lock = threading.Lock()
+
+
+def _crs_key(crs) -> str:
+    # rasterio and pyproj CRS objects are keyed by their WKT, anything else (e.g. 'EPSG:4326') as given
+    if hasattr(crs, "to_wkt"):
+        return crs.to_wkt()
+    return str(crs)
+
+
+def get_transformer(src_crs, dst_crs) -> Transformer:
+    """
+    Return a shared always_xy Transformer for (src_crs, dst_crs).
+
+    Building a Transformer parses both CRS definitions and looks up the PROJ
+    pipeline, which is far more expensive than using one. Transformers are kept
+    in a process-wide LRU; pyproj transformers are thread-safe, so the same
+    instance is handed to every thread.
+    """
+    key = (_crs_key(src_crs), _crs_key(dst_crs))
+    with _transformers_lock:
+        transformer = _transformers.get(key)
+        if transformer is not None:
+            _transformers.move_to_end(key)
+            return transformer
+
+    # Build outside the lock; a concurrent build of the same pair is harmless
+    transformer = Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+    with _transformers_lock:
+        transformer = _transformers.setdefault(key, transformer)
+        _transformers.move_to_end(key)
+        while len(_transformers) > TRANSFORMER_CACHE_SIZE:
+            _transformers.popitem(last=False)
+    return transformer
+
+
+# -------------------------------- Ragged coordinate arrays --------------------------------
+# A set of rings is stored as one (N, 2) coordinate array plus an offsets array of
+# length len(rings) + 1, so ring i is coords[offsets[i]:offsets[i + 1]].
+
+def _wkb_data(geometry):
+    # GeoAlchemy2 elements carry their WKB in .data; memoryviews are not accepted by shapely
+    data = getattr(geometry, "data", geometry)
+    return bytes(data) if isinstance(data, memoryview) else data
+
+
+def exterior_rings(geometries) -> tuple:
+    """
+    Decode the exterior ring of every polygon in one vectorized pass.
+
+    Args:
+        geometries: GeoAlchemy2 WKB elements, or raw WKB bytes / hex strings.
+
+    Returns:
+        tuple: (coords, offsets) as described above.
+    """
+    if len(geometries) == 0:
+        return np.empty((0, 2), dtype=np.float64), np.zeros(1, dtype=np.int64)
+
+    shapes = shapely.from_wkb([_wkb_data(geometry) for geometry in geometries])
+    rings = shapely.get_exterior_ring(shapes)
+    coords, ring_index = shapely.get_coordinates(rings, return_index=True)
+    counts = np.bincount(ring_index, minlength=len(geometries))
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return coords, offsets
+
+
+def ring_coordinate_lists(geometries, swap_xy: bool = False, decimals: int = None) -> list:
+    """
+    Exterior ring of every polygon as a [[x, y], ...] list, e.g. for API responses.
+
+    The rings are decoded with exterior_rings and converted to Python lists in a
+    single tolist() call, then sliced per polygon at the ring offsets, so no
+    Shapely object or GeoJSON mapping is built per row.
+
+    Args:
+        geometries: GeoAlchemy2 WKB elements, or raw WKB bytes / hex strings.
+        swap_xy (bool): Return [y, x] (i.e. [lat, lon]) pairs instead.
+        decimals (int): Round coordinates to this many decimals, e.g. to trim payloads.
+
+    Returns:
+        list: One coordinate list per geometry (empty for a null geometry).
+    """
+    coords, offsets = exterior_rings(geometries)
+    if swap_xy:
+        coords = coords[:, ::-1]
+    if decimals is not None:
+        coords = np.round(coords, decimals)
+    values = coords.tolist()
+    bounds = offsets.tolist()
+    return [values[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def transform_coordinates(coords: np.ndarray, src_crs, dst_crs) -> np.ndarray:
+    # Reproject an (N, 2) array with a single PROJ call
+    if len(coords) == 0:
+        return coords
+    x, y = get_transformer(src_crs, dst_crs).transform(coords[:, 0], coords[:, 1])
+    return np.column_stack((x, y))
+
+
+def split_rings(coords: np.ndarray, offsets: np.ndarray) -> list:
+    return np.split(coords, offsets[1:-1])
+
+
+def reproject_rings(geometries, src_crs, dst_crs) -> list:
+    """
+    Reproject the exterior ring of every polygon in one call.
+
+    Returns a list of (n_i, 2) arrays, one per input geometry, in dst_crs.
+    """
+    coords, offsets = exterior_rings(geometries)
+    return split_rings(transform_coordinates(coords, src_crs, dst_crs), offsets)
@@ -0,0 +1,80 @@
+# app/imaging.py
+import io
+import base64
+import threading
+
+import numpy as np
+from PIL import Image
+
+
+# -------------------------------- Image frame --------------------------------
+class ImageFrame:
+    """
+    An in-memory RGB image handed between pipeline stages.
+
+    Carries the pixel array and caches every encoding made from it, keyed by
+    format and options, so the same bytes are reused for S3 uploads and model
+    requests instead of being decoded and re-encoded along the way.
+    """
+
+    def __init__(self, array: np.ndarray = None, image: Image.Image = None):
+        if array is None and image is None:
+            raise ValueError("ImageFrame needs an array or a PIL image")
+        self._array = array
+        self._image = image
+        self._encodings = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_bands(cls, bands: np.ndarray) -> "ImageFrame":
+        # Raster reads are (bands, height, width); images are (height, width, bands)
+        return cls(array=np.moveaxis(bands, 0, -1).astype('uint8', copy=False))
+
+    @property
+    def array(self) -> np.ndarray:
+        if self._array is None:
+            self._array = np.asarray(self._image)
+        return self._array
+
+    @property
+    def image(self) -> Image.Image:
+        if self._image is None:
+            self._image = Image.fromarray(self._array, mode='RGB')
+        return self._image
+
+    @property
+    def width(self) -> int:
+        return self.image.width
+
+    @property
+    def height(self) -> int:
+        return self.image.height
+
+    def encode(self, format: str = 'JPEG', **options) -> bytes:
+        """
+        Encode the image, at most once per format and options.
+
+        Returns:
+            bytes: The encoded image.
+        """
+        key = (format.upper(), tuple(sorted(options.items())))
+        with self._lock:
+            encoded = self._encodings.get(key)
+            if encoded is None:
+                buffer = io.BytesIO()
+                self.image.save(buffer, format=format, **options)
+                encoded = buffer.getvalue()
+                self._encodings[key] = encoded
+        return encoded
+
+    def to_buffer(self, format: str = 'JPEG', **options) -> io.BytesIO:
+        return io.BytesIO(self.encode(format, **options))
+
+    def to_base64(self, format: str = 'JPEG', **options) -> str:
+        return base64.b64encode(self.encode(format, **options)).decode('utf-8')
+
+    def release_pixels(self):
+        # Keep only the encodings once no further encoding is needed
+        with self._lock:
+            self._array = None
+            self._image = None
@@ -0,0 +1,182 @@
+# app/ingest.py
+import os
+import time
+import tempfile
+from contextlib import contextmanager
+
+import boto3
+import rasterio
+import rasterio.shutil
+from botocore.client import Config
+from dotenv import load_dotenv
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app import crud, models
+from app.db import SessionLocal, engine
+from app.raster import get_gdal_env_options
+
+# -------------------------------- Connection to AWS - Access Keys Version --------------------------------
+load_dotenv()  # Load environment variables from .env file
+
+AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
+AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+AWS_REGION = os.getenv("AWS_REGION")
+BUCKET_NAME = os.getenv("BUCKET_NAME")
+
+s3_client = boto3.client(
+    's3',
+    aws_access_key_id=AWS_ACCESS_KEY_ID,
+    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+    region_name=AWS_REGION,
+    config=Config(signature_version='s3v4'),
+)
+
+# -------------------------------- COG settings --------------------------------
+# DEFLATE keeps the pixels identical to the upload; JPEG or WEBP (with COG_QUALITY) trade fidelity for size
+COG_COMPRESSION = os.getenv("COG_COMPRESSION", "DEFLATE").upper()
+COG_QUALITY = int(os.getenv("COG_QUALITY", "90"))
+COG_BLOCKSIZE = int(os.getenv("COG_BLOCKSIZE", "512"))
+# How long a worker waits for a conversion already running elsewhere (e.g. the ingest task) before reading the upload
+COG_WAIT_SECONDS = int(os.getenv("COG_WAIT_SECONDS", "1800"))
+COG_LOCK_POLL_SECONDS = 2
+
+# First key of the Postgres advisory lock held while an image is converted (the second is the image id)
+_COG_LOCK_NAMESPACE = 4101
+
+
+def cog_creation_options() -> dict:
+    options = {
+        "BLOCKSIZE": COG_BLOCKSIZE,
+        "COMPRESS": COG_COMPRESSION,
+        "OVERVIEWS": "AUTO",
+        "OVERVIEW_RESAMPLING": "AVERAGE",
+        "BIGTIFF": "IF_SAFER",
+        "NUM_THREADS": "ALL_CPUS",
+    }
+    if COG_COMPRESSION in ("DEFLATE", "LZW", "ZSTD"):
+        options["PREDICTOR"] = "YES"
+    if COG_COMPRESSION in ("JPEG", "WEBP"):
+        options["QUALITY"] = COG_QUALITY
+    return options
+
+
+def get_cog_s3_key(image_original_s3_key: str) -> str:
+    # Store the COG next to the upload, the same way annotated images go under modified/
+    dirname, filename = os.path.split(image_original_s3_key)
+    basename, _ = os.path.splitext(filename)
+    return f"{dirname}/cog/{basename}.tif"
+
+
+def get_source_s3_key(image: models.Image) -> str:
+    # The processing pipeline reads the COG whenever one has been produced
+    return image.cog_s3_key or image.original_s3_key
+
+
+# -------------------------------- Conversion --------------------------------
+def convert_to_cog(image_original_s3_key: str) -> str:
+    """
+    Rewrite an uploaded GeoTIFF as a tiled Cloud-Optimized GeoTIFF with internal overviews.
+
+    The upload is downloaded once to local disk, since striped TIFFs are slow to
+    read over HTTP ranges, converted with GDAL's COG driver and uploaded back to S3.
+
+    Args:
+        image_original_s3_key (str): S3 key of the uploaded GeoTIFF.
+
+    Returns:
+        str: S3 key of the COG.
+    """
+    start_time = time.time()
+    cog_s3_key = get_cog_s3_key(image_original_s3_key)
+
+    with tempfile.TemporaryDirectory(prefix="cog-") as tmp_dir:
+        source_path = os.path.join(tmp_dir, "source.tif")
+        cog_path = os.path.join(tmp_dir, "cog.tif")
+
+        print(f"Downloading {image_original_s3_key} for COG conversion...")
+        s3_client.download_file(BUCKET_NAME, image_original_s3_key, source_path)
+
+        print(f"Converting {image_original_s3_key} to COG ({COG_COMPRESSION})...")
+        with rasterio.Env(**get_gdal_env_options()):
+            with rasterio.open(source_path) as src:
+                rasterio.shutil.copy(src, cog_path, driver="COG", **cog_creation_options())
+
+        print(f"Uploading COG to S3 with key: {cog_s3_key}")
+        s3_client.upload_file(cog_path, BUCKET_NAME, cog_s3_key, ExtraArgs={'ContentType': 'image/tiff'})
+
+    print(f"COG conversion of {image_original_s3_key} completed in {time.time() - start_time:.2f} seconds.")
+    return cog_s3_key
+
+
+@contextmanager
+def cog_conversion_lock(image_id: int, wait_seconds: int = 0):
+    """
+    Hold the conversion lock of an image, shared by the API and the workers through Postgres.
+
+    Yields True once the lock is held, or False if another process still holds it
+    after wait_seconds. The lock lives on its own connection, so commits on the
+    caller's session do not release it.
+    """
+    with engine.connect() as connection:
+        deadline = time.time() + wait_seconds
+        params = {"namespace": _COG_LOCK_NAMESPACE, "image_id": image_id}
+        while True:
+            acquired = connection.execute(text("SELECT pg_try_advisory_lock(:namespace, :image_id)"), params).scalar()
+            if acquired or time.time() >= deadline:
+                break
+            time.sleep(COG_LOCK_POLL_SECONDS)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                connection.execute(text("SELECT pg_advisory_unlock(:namespace, :image_id)"), params)
+
+
+def ensure_cog(db: Session, image, wait_seconds: int = COG_WAIT_SECONDS) -> str:
+    """
+    Make sure the image has a COG, converting it now if ingest has not done so yet.
+
+    Returns the key the pipeline should read from. A conversion already running
+    for the image (the ingest task, or another worker) is waited for rather than
+    started a second time. If it does not finish within wait_seconds, or the
+    conversion fails, the original upload is used, so processing is never blocked
+    by the ingest stage.
+    """
+    if image.cog_s3_key or not image.original_s3_key:
+        return get_source_s3_key(image)
+
+    with cog_conversion_lock(image.id, wait_seconds) as acquired:
+        # Whoever held the lock may have stored the COG in the meantime
+        db_image = db.query(models.Image).filter(models.Image.id == image.id).first()
+        if db_image is not None:
+            db.refresh(db_image)
+            if db_image.cog_s3_key:
+                return db_image.cog_s3_key
+        if not acquired:
+            print(f"COG conversion of image {image.id} is still running elsewhere, reading the original upload instead")
+            return image.original_s3_key
+
+        try:
+            cog_s3_key = convert_to_cog(image.original_s3_key)
+            crud.update_image(db, image_id=image.id, cog_s3_key=cog_s3_key)
+            return cog_s3_key
+        except Exception as e:
+            db.rollback()
+            print(f"COG conversion failed for image {image.id}, reading the original upload instead: {e}")
+            return image.original_s3_key
+
+
+# -------------------------------- Ingest stage --------------------------------
+def ingest_image(image_id: int):
+    # Runs after the upload response has been sent, so it uses its own session
+    db = SessionLocal()
+    try:
+        db_image = db.query(models.Image).filter(models.Image.id == image_id).first()
+        if not db_image:
+            print(f"Ingest skipped: image {image_id} not found")
+            return
+        # A worker converting the image already is not waited for; its result is used as is
+        ensure_cog(db, db_image, wait_seconds=0)
+    finally:
+        db.close()
@@ -0,0 +1,256 @@
+# app/jobs.py
+import os
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+from sqlalchemy import or_, and_, update, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm import Session
+
+from app import models
+
+load_dotenv()
+
+# A running job is taken over by another worker once its lease runs out without a heartbeat
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_DELAY_SECONDS = int(os.getenv("JOB_RETRY_DELAY_SECONDS", "30"))
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_SUCCEEDED = "succeeded"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_RUNNING)
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+# -------------------------------- Enqueue --------------------------------
+def enqueue_job(db: Session, image_id: int, priority: int = 0, fair_share_key: str = None) -> models.ProcessingJob:
+    """
+    Queue an image for processing.
+
+    Jobs with a higher priority are claimed first. Among equal priorities,
+    jobs whose fair_share_key (uploader or label) has the fewest running jobs
+    go first, so one large batch cannot hold every worker. If the image already
+    has a queued or running job, that job is returned instead of adding a
+    second one, with its priority raised if needed.
+    """
+    db_job = get_active_job(db, image_id)
+    if db_job:
+        return _raise_priority(db, db_job, priority)
+
+    db_job = models.ProcessingJob(
+        image_id=image_id,
+        status=STATUS_QUEUED,
+        priority=priority,
+        fair_share_key=fair_share_key,
+        attempts=0,
+        max_attempts=JOB_MAX_ATTEMPTS,
+        run_after=_now(),
+    )
+    db.add(db_job)
+    try:
+        db.commit()
+    except IntegrityError:
+        # A concurrent request queued a job for the image between the check and the insert;
+        # the partial unique index on active jobs rejected this one, so return that job
+        db.rollback()
+        db_job = get_active_job(db, image_id)
+        if db_job is None:
+            raise
+        return _raise_priority(db, db_job, priority)
+    db.refresh(db_job)
+    return db_job
+
+
+def _raise_priority(db: Session, db_job: models.ProcessingJob, priority: int) -> models.ProcessingJob:
+    if priority > db_job.priority:
+        db_job.priority = priority
+        db.commit()
+        db.refresh(db_job)
+    return db_job
+
+
+def get_active_job(db: Session, image_id: int):
+    return (
+        db.query(models.ProcessingJob)
+        .filter(models.ProcessingJob.image_id == image_id, models.ProcessingJob.status.in_(ACTIVE_STATUSES))
+        .first()
+    )
+
+
+# -------------------------------- Claim --------------------------------
+def claim_job(db: Session, worker_id: str):
+    """
+    Claim the next job for worker_id.
+
+    Queued jobs that are due and running jobs whose lease expired (their worker
+    died) are candidates. The row is locked with FOR UPDATE SKIP LOCKED, so
+    concurrent workers never claim the same job and never wait on each other.
+    An abandoned job that already used all its attempts is failed instead.
+
+    Returns:
+        ProcessingJob | None: The claimed job, or None if there is nothing to do.
+    """
+    # Running jobs sharing the candidate's fair-share key
+    running = aliased(models.ProcessingJob)
+    running_in_share = (
+        db.query(func.count(running.id))
+        .filter(running.status == STATUS_RUNNING, running.fair_share_key == models.ProcessingJob.fair_share_key)
+        .correlate(models.ProcessingJob)
+        .scalar_subquery()
+    )
+
+    while True:
+        now = _now()
+        db_job = (
+            db.query(models.ProcessingJob)
+            .filter(or_(
+                and_(models.ProcessingJob.status == STATUS_QUEUED, models.ProcessingJob.run_after <= now),
+                and_(models.ProcessingJob.status == STATUS_RUNNING, models.ProcessingJob.lease_expires_at < now),
+            ))
+            .order_by(
+                models.ProcessingJob.priority.desc(),
+                running_in_share,
+                models.ProcessingJob.run_after,
+                models.ProcessingJob.id,
+            )
+            .with_for_update(skip_locked=True)
+            .limit(1)
+            .first()
+        )
+        if db_job is None:
+            db.rollback()
+            return None
+
+        if db_job.status == STATUS_RUNNING:
+            print(f"Job {db_job.id} lost its worker {db_job.worker_id} (lease expired at {db_job.lease_expires_at})")
+            if db_job.cancel_requested_at is not None:
+                db_job.status = STATUS_CANCELLED
+                db_job.finished_at = now
+                db.commit()
+                continue
+            if db_job.attempts >= db_job.max_attempts:
+                db_job.status = STATUS_FAILED
+                db_job.finished_at = now
+                db_job.last_error = f"Worker {db_job.worker_id} stopped responding"
+                db.query(models.Image).filter(models.Image.id == db_job.image_id).update(
+                    {models.Image.processing_status: -1}, synchronize_session=False
+                )
+                db.commit()
+                continue
+
+        db_job.status = STATUS_RUNNING
+        db_job.attempts += 1
+        db_job.worker_id = worker_id
+        db_job.started_at = now
+        db_job.heartbeat_at = now
+        db_job.lease_expires_at = now + timedelta(seconds=JOB_LEASE_SECONDS)
+        db.commit()
+        db.refresh(db_job)
+        return db_job
+
+
+# -------------------------------- Lease --------------------------------
+def heartbeat_job(db: Session, job_id: int, worker_id: str) -> bool:
+    """
+    Extend the lease of a running job.
+
+    Returns:
+        bool: False if the job is no longer held by worker_id (it was taken over).
+    """
+    now = _now()
+    result = db.execute(
+        update(models.ProcessingJob)
+        .where(
+            models.ProcessingJob.id == job_id,
+            models.ProcessingJob.worker_id == worker_id,
+            models.ProcessingJob.status == STATUS_RUNNING,
+        )
+        .values(heartbeat_at=now, lease_expires_at=now + timedelta(seconds=JOB_LEASE_SECONDS))
+    )
+    db.commit()
+    return result.rowcount == 1
+
+
+def complete_job(db: Session, job_id: int, worker_id: str):
+    db.execute(
+        update(models.ProcessingJob)
+        .where(models.ProcessingJob.id == job_id, models.ProcessingJob.worker_id == worker_id)
+        .values(status=STATUS_SUCCEEDED, finished_at=_now(), lease_expires_at=None, last_error=None)
+    )
+    db.commit()
+
+
+def fail_job(db: Session, job_id: int, worker_id: str, error: str):
+    """
+    Record a failed attempt: queue the job again after JOB_RETRY_DELAY_SECONDS,
+    or fail it for good once it used all its attempts.
+    """
+    db_job = db.query(models.ProcessingJob).filter(
+        models.ProcessingJob.id == job_id, models.ProcessingJob.worker_id == worker_id
+    ).first()
+    if not db_job:
+        db.rollback()
+        return
+
+    now = _now()
+    db_job.last_error = error
+    db_job.lease_expires_at = None
+    if db_job.attempts < db_job.max_attempts:
+        db_job.status = STATUS_QUEUED
+        db_job.run_after = now + timedelta(seconds=JOB_RETRY_DELAY_SECONDS * db_job.attempts)
+        print(f"Job {job_id} failed (attempt {db_job.attempts}/{db_job.max_attempts}), retrying after {db_job.run_after}: {error}")
+    else:
+        db_job.status = STATUS_FAILED
+        db_job.finished_at = now
+        print(f"Job {job_id} failed after {db_job.attempts} attempts: {error}")
+    db.commit()
+
+
+# -------------------------------- Cancellation --------------------------------
+def cancel_job(db: Session, image_id: int):
+    """
+    Cancel the queued or running job of an image.
+
+    A queued job is cancelled at once; a running one is flagged and its worker
+    stops between polygons.
+
+    Returns:
+        ProcessingJob | None: The job, or None if the image has no active job.
+    """
+    db_job = get_active_job(db, image_id)
+    if not db_job:
+        return None
+
+    now = _now()
+    if db_job.status == STATUS_QUEUED:
+        db_job.status = STATUS_CANCELLED
+        db_job.finished_at = now
+    db_job.cancel_requested_at = now
+    db.commit()
+    db.refresh(db_job)
+    return db_job
+
+
+def is_cancel_requested(db: Session, job_id: int) -> bool:
+    cancel_requested_at = db.query(models.ProcessingJob.cancel_requested_at).filter(
+        models.ProcessingJob.id == job_id
+    ).scalar()
+    db.rollback()  # Read only; end the transaction so the next check sees new commits
+    return cancel_requested_at is not None
+
+
+def mark_cancelled(db: Session, job_id: int, worker_id: str):
+    db.execute(
+        update(models.ProcessingJob)
+        .where(models.ProcessingJob.id == job_id, models.ProcessingJob.worker_id == worker_id)
+        .values(status=STATUS_CANCELLED, finished_at=_now(), lease_expires_at=None)
+    )
+    db.commit()
+    print(f"Job {job_id} cancelled")
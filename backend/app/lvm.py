@@ -10,14 +10,64 @@ from botocore.client import Config
 from PIL import Image
 import io
 import re
+import hashlib
 import time  # Added for timing measurements
 from io import BytesIO
+from typing import Union
+from app.imaging import ImageFrame
 
 # -------------------------------- Connection to Ollama API --------------------------------
 load_dotenv()
 
 OLLAMA_API_URL = os.getenv('OLLAMA_API_URL')
 TEMPERATURE = 0.1
+MODEL_NAME = "llava:7b"
+
+PROMPT = """
+                Analyze the entire cropped image for obstructions in fire access ways. Since the image is cropped, do not consider areas outside of the image in your analysis.
+
+                **Important**: Ensure high accuracy in the detection of obstructions such as vehicles to eliminate false positives and false negatives. Logical consistency between every single field/detail is mandatory. For example, if a vehicle is detected, it must correlate with an obstruction. If a description mentions the presence of vehicle(s), the 'vehicle' boolean must be true and cannot be false. 
+                
+                Ensure that the response is in the exact format specified below
+                
+                Provide a summary report with the following details in JSON format:
+
+                1. "obstruction": Indicate if any obstruction is detected (true/false).
+                2. "sufficient": Indicate if a SCDF fire engine can pass through the area considering all detected obstructions (true/false).
+                3. "sufficient_explanation": Provide an explanation for why the area is sufficient or not for a SCDF fire engine (truck).
+                4. "permanent": Indicate if any of the detected obstructions are permanent (true/false).
+                5. "permanent_explanation": Provide an explanation for why any detected obstruction is permanent or not.
+                6. "flammable": Indicate if any of the detected obstructions are flammable (true/false).
+                7. "flammable_explanation": Provide an explanation for why the obstruction is considered flammable or not.
+                8. "vehicle": Indicate if any of the detected obstructions is/are vehicle(s) (true/false).
+                9. "vehicle_explanation": Provide an explanation for why the obstruction is considered a vehicle or not.
+                10. "label": Provide a brief, comma-separated string of the types of all detected obstructions.
+                11. "description": Provide a concise summary of the descriptions of all detected obstructions.
+
+                Format the output as a valid JSON object:
+                {
+                "obstruction": boolean,
+                "sufficient": boolean,
+                "sufficient_explanation": "string",
+                "permanent": boolean,
+                "permanent_explanation": "string",
+                "flammable": boolean,
+                "flammable_explanation": "string",
+                "vehicle": boolean,
+                "vehicle_explanation": "string",
+                "label": "string",
+                "description": "string"
+                }
+
+                Important: Return only the JSON object without any additional text, explanation, or formatting outside of the JSON object. Ensure that the output is a pure JSON object. Make certain that all boolean values are lowercase (true/false) and all string values are properly enclosed in double quotes.
+            """
+
+# Changes whenever the prompt text changes, so cached analyses from an older prompt are not reused
+PROMPT_VERSION = hashlib.sha256(PROMPT.encode("utf-8")).hexdigest()[:12]
+
+# Encoding of the image sent to the model
+MODEL_IMAGE_FORMAT = "JPEG"
+MODEL_IMAGE_OPTIONS = {"quality": 100, "optimize": True}
 
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
@@ -174,6 +224,11 @@ def encode_image_to_base64(image_data: BytesIO, max_size: tuple = (1024, 1024),
 #     except Exception as e:
 #         raise HTTPException(status_code=500, detail=str(e))
 
+def encode_frame_for_model(frame: ImageFrame) -> str:
+    # Base64 of the model encoding, made once per frame and shared with anyone else who needs it
+    return frame.to_base64(MODEL_IMAGE_FORMAT, **MODEL_IMAGE_OPTIONS)
+
+
 # -------------------------------- Main function --------------------------------
 # def run_image_through_model(cropped_image: schemas.CroppedImage) -> dict:
 
@@ -351,7 +406,7 @@ def encode_image_to_base64(image_data: BytesIO, max_size: tuple = (1024, 1024),
 #         raise HTTPException(status_code=500, detail="An unexpected error occurred while processing the image through the API.")
 
 # Official ollama/ollama
-def run_image_through_model(image_data: BytesIO) -> dict:
+def run_image_through_model(image_data: Union[BytesIO, ImageFrame]) -> dict:
     try:
         total_start_time = time.time()
         print("Starting run_image_through_model...")
@@ -373,7 +428,10 @@ def run_image_through_model(image_data: BytesIO) -> dict:
 
         # Encode image to base64
         base64_encode_start_time = time.time()
-        base64_image = encode_image_to_base64(image_data)
+        if isinstance(image_data, ImageFrame):
+            base64_image = encode_frame_for_model(image_data)  # Not decoded and re-encoded
+        else:
+            base64_image = encode_image_to_base64(image_data)
         base64_encode_end_time = time.time()
         print(f"Image encoded to base64 in {base64_encode_end_time - base64_encode_start_time:.2f} seconds.")
 
@@ -383,46 +441,9 @@ def run_image_through_model(image_data: BytesIO) -> dict:
 
         data = {
             # "model": "aiden_lu/minicpm-v2.6:Q4_K_M",
-            "model": "llava:7b",
-
-            "prompt": """
-                Analyze the entire cropped image for obstructions in fire access ways. Since the image is cropped, do not consider areas outside of the image in your analysis.
-
-                **Important**: Ensure high accuracy in the detection of obstructions such as vehicles to eliminate false positives and false negatives. Logical consistency between every single field/detail is mandatory. For example, if a vehicle is detected, it must correlate with an obstruction. If a description mentions the presence of vehicle(s), the 'vehicle' boolean must be true and cannot be false. 
-                
-                Ensure that the response is in the exact format specified below
-                
-                Provide a summary report with the following details in JSON format:
+            "model": MODEL_NAME,
 
-                1. "obstruction": Indicate if any obstruction is detected (true/false).
-                2. "sufficient": Indicate if a SCDF fire engine can pass through the area considering all detected obstructions (true/false).
-                3. "sufficient_explanation": Provide an explanation for why the area is sufficient or not for a SCDF fire engine (truck).
-                4. "permanent": Indicate if any of the detected obstructions are permanent (true/false).
-                5. "permanent_explanation": Provide an explanation for why any detected obstruction is permanent or not.
-                6. "flammable": Indicate if any of the detected obstructions are flammable (true/false).
-                7. "flammable_explanation": Provide an explanation for why the obstruction is considered flammable or not.
-                8. "vehicle": Indicate if any of the detected obstructions is/are vehicle(s) (true/false).
-                9. "vehicle_explanation": Provide an explanation for why the obstruction is considered a vehicle or not.
-                10. "label": Provide a brief, comma-separated string of the types of all detected obstructions.
-                11. "description": Provide a concise summary of the descriptions of all detected obstructions.
-
-                Format the output as a valid JSON object:
-                {
-                "obstruction": boolean,
-                "sufficient": boolean,
-                "sufficient_explanation": "string",
-                "permanent": boolean,
-                "permanent_explanation": "string",
-                "flammable": boolean,
-                "flammable_explanation": "string",
-                "vehicle": boolean,
-                "vehicle_explanation": "string",
-                "label": "string",
-                "description": "string"
-                }
-
-                Important: Return only the JSON object without any additional text, explanation, or formatting outside of the JSON object. Ensure that the output is a pure JSON object. Make certain that all boolean values are lowercase (true/false) and all string values are properly enclosed in double quotes.
-            """,
+            "prompt": PROMPT,
             
             "stream": False,
             "format": "json",
@@ -1,7 +1,7 @@
 # app/main.py
 
 from fastapi import FastAPI
-from app.api.v1.endpoints import images, polygons, analytics
+from app.api.v1.endpoints import images, polygons, analytics, tiles
 from app.db import engine, Base
 from fastapi.middleware.cors import CORSMiddleware
 import os
@@ -9,6 +9,7 @@ from dotenv import load_dotenv
 from starlette.responses import HTMLResponse
 import asyncio
 from app.websockets import manager
+from app.progress import relay_progress_from_db
 
 load_dotenv()
 
@@ -37,6 +38,7 @@ Base.metadata.create_all(bind=engine)
 app.include_router(polygons.router, prefix="/api/v1/polygons", tags=["polygons"])
 app.include_router(images.router, prefix="/api/v1/images", tags=["images"])
 app.include_router(analytics.router, prefix="/api/v1/analytics", tags=["analytics"])
+app.include_router(tiles.router, prefix="/api/v1/tiles", tags=["tiles"])
 
 @app.get("/", response_class=HTMLResponse)
 async def index():
@@ -53,3 +55,6 @@ async def index():
 async def startup_event():
     # Set the event loop in the manager
     manager.loop = asyncio.get_event_loop()
+
+    # Relay progress of jobs running in worker processes to websockets
+    asyncio.create_task(relay_progress_from_db())
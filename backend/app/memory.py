@@ -0,0 +1,148 @@
+# app/memory.py
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Memory that raster work (windows read for crops and their copies) may hold at once, process-wide
+RASTER_MEMORY_BUDGET_MB = int(os.getenv("RASTER_MEMORY_BUDGET_MB", "1024"))
+
+# Copies made of a crop window per pixel, besides the read itself: the mask (1 byte), the masked
+# product (same as the read) and two RGB images (3 bytes each)
+_CROP_EXTRA_BYTES_PER_PIXEL = 1 + 3 + 3
+
+# How often a queued acquire() wakes up to check whether its work was stopped
+_WAIT_POLL_SECONDS = 0.2
+
+
+class MemoryBudgetCancelled(Exception):
+    """Raised by MemoryBudget.acquire() when its stop_event is set before the request is admitted."""
+
+
+# -------------------------------- Footprint --------------------------------
+def estimate_crop_footprint(out_width: int, out_height: int, bands: int, itemsize: int = 1) -> int:
+    """
+    Estimate the peak memory of cropping one polygon window.
+
+    Args:
+        out_width (int): Width of the array read for the window.
+        out_height (int): Height of the array read for the window.
+        bands (int): Number of bands read.
+        itemsize (int): Bytes per sample of the raster dtype.
+
+    Returns:
+        int: Estimated bytes held while the window is read, masked and converted.
+    """
+    pixels = int(out_width) * int(out_height)
+    return pixels * (2 * bands * itemsize + _CROP_EXTRA_BYTES_PER_PIXEL)
+
+
+# -------------------------------- Budget --------------------------------
+class MemoryBudget:
+    """
+    Admission control for memory-heavy work.
+
+    acquire() blocks until the requested bytes fit next to what is already
+    admitted, or until the caller's stop_event is set. A request larger than the
+    whole budget is admitted alone, once nothing else is running, rather than
+    never. Reservations are tagged with an owner (e.g. the image being processed)
+    so a failed job can release what its in-flight work still holds.
+    """
+
+    def __init__(self, budget_bytes: int, name: str = "raster"):
+        self.name = name
+        self.budget_bytes = budget_bytes
+        self._condition = threading.Condition()
+        self._reservations = {}  # reservation id -> (owner, bytes)
+        self._next_id = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.admitted = 0
+        self.queued = 0
+        self.oversized = 0
+        self.waiting = 0
+        self.throttled_seconds = 0.0
+
+    def _fits(self, nbytes: int) -> bool:
+        if nbytes > self.budget_bytes:
+            return self.in_use == 0
+        return self.in_use + nbytes <= self.budget_bytes
+
+    def acquire(self, nbytes: int, owner=None, label: str = "", stop_event: threading.Event = None) -> int:
+        """
+        Block until nbytes can be admitted.
+
+        Raises MemoryBudgetCancelled if stop_event is set while waiting, so work
+        that is being torn down (e.g. a failed or cancelled pipeline) never waits
+        for memory that will only be released once it has stopped.
+
+        Returns:
+            int: Reservation id to pass to release().
+        """
+        with self._condition:
+            if not self._fits(nbytes):
+                self.queued += 1
+                self.waiting += 1
+                start_time = time.time()
+                print(
+                    f"Memory budget {self.name}: queued {label} needing {nbytes / 2**20:.1f} MB "
+                    f"({self.in_use / 2**20:.1f}/{self.budget_bytes / 2**20:.0f} MB in use, {self.waiting} waiting)"
+                )
+                try:
+                    while not self._fits(nbytes):
+                        if stop_event is not None and stop_event.is_set():
+                            raise MemoryBudgetCancelled(f"Memory budget {self.name}: gave up on {label}, its work was stopped")
+                        self._condition.wait(timeout=_WAIT_POLL_SECONDS)
+                finally:
+                    waited = time.time() - start_time
+                    self.waiting -= 1
+                    self.throttled_seconds += waited
+                print(f"Memory budget {self.name}: admitted {label} after {waited:.2f} seconds")
+
+            if nbytes > self.budget_bytes:
+                self.oversized += 1
+                print(f"Memory budget {self.name}: {label} needs {nbytes / 2**20:.1f} MB, more than the whole budget; running it alone")
+
+            reservation_id = self._next_id
+            self._next_id += 1
+            self._reservations[reservation_id] = (owner, nbytes)
+            self.in_use += nbytes
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.admitted += 1
+            return reservation_id
+
+    def release(self, reservation_id: int):
+        with self._condition:
+            reservation = self._reservations.pop(reservation_id, None)
+            if reservation is None:
+                return  # Already released
+            self.in_use -= reservation[1]
+            self._condition.notify_all()
+
+    def release_owner(self, owner):
+        # Release everything still held for owner, e.g. by work abandoned when a job failed
+        with self._condition:
+            for reservation_id, (reservation_owner, nbytes) in list(self._reservations.items()):
+                if reservation_owner == owner:
+                    del self._reservations[reservation_id]
+                    self.in_use -= nbytes
+            self._condition.notify_all()
+
+    def metrics(self) -> dict:
+        with self._condition:
+            return {
+                "budget_mb": round(self.budget_bytes / 2**20, 1),
+                "in_use_mb": round(self.in_use / 2**20, 1),
+                "peak_in_use_mb": round(self.peak_in_use / 2**20, 1),
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "waiting": self.waiting,
+                "oversized": self.oversized,
+                "throttled_seconds": round(self.throttled_seconds, 3),
+            }
+
+
+raster_memory_budget = MemoryBudget(RASTER_MEMORY_BUDGET_MB * 2**20)
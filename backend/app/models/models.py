@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, func, Enum
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, func, Enum, Index, text
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 from app.db import Base
@@ -20,7 +20,7 @@ class Polygon(Base):
     name = Column(String, index=True)
     address = Column(String, index=True)
     type = Column(String, index=True)
-    coordinates = Column(Geometry('POLYGON'))
+    coordinates = Column(Geometry('POLYGON', srid=4326))  # GiST index idx_polygons_coordinates; SRID enforced by ck_polygons_coordinates_srid
     latest_status = Column(Enum(StatusEnum), default=StatusEnum.clear, nullable=False, index=True)
 
     def __repr__(self):
@@ -54,6 +54,7 @@ class Image(Base):
     filename = Column(String, unique=False, index=True, nullable=False)
     original_s3_key = Column(String, unique=True, nullable=True)
     annotated_s3_key = Column(String, unique=True, nullable=True)
+    cog_s3_key = Column(String, unique=True, nullable=True)
     processing_status = Column(Integer, default=0)
 
     # Relationship to CroppedImage with cascading deletes
@@ -73,7 +74,7 @@ class CroppedImage(Base):
     filename = Column(String, unique=False, index=True, nullable=False)
     s3_key = Column(String, unique=True, nullable=False)
     # polygon_id = Column(Integer, ForeignKey('polygons.id'), nullable=False)
-    polygon_id = Column(Integer, ForeignKey('polygons.id', ondelete='CASCADE'), nullable=False)  # Add cascade here
+    polygon_id = Column(Integer, ForeignKey('polygons.id', ondelete='CASCADE'), index=True, nullable=False)  # Add cascade here
 
     data = Column(JSONB)
 
@@ -82,3 +83,80 @@ class CroppedImage(Base):
 
     def __repr__(self):
         return f"<CroppedImage(id={self.id}, filename={self.filename}, s3_key={self.s3_key}, image_id={self.image_id}, polygon_id={self.polygon_id})>"
+
+class GeocodeCache(Base):
+    __tablename__ = 'geocode_cache'
+
+    # Coordinates are snapped to a grid, so every image centre in the same cell shares one entry
+    cell_key = Column(String, primary_key=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    last_used_at = Column(DateTime(timezone=True), server_default=func.now(), index=True, nullable=False)
+    expires_at = Column(DateTime(timezone=True), index=True, nullable=False)
+    address = Column(String, nullable=False)
+    source = Column(String, nullable=False)  # 'nominatim' or 'local'
+
+    def __repr__(self):
+        return f"<GeocodeCache(cell_key={self.cell_key}, address={self.address}, source={self.source})>"
+
+class CropAnalysisCache(Base):
+    __tablename__ = 'crop_analysis_cache'
+
+    # SHA-256 of the crop pixels, mask, model and prompt version
+    content_hash = Column(String, primary_key=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    last_used_at = Column(DateTime(timezone=True), server_default=func.now(), index=True, nullable=False)
+    s3_key = Column(String, index=True, nullable=False)  # Cropped image uploaded for the first occurrence
+    model = Column(String, nullable=False)
+    prompt_version = Column(String, nullable=False)
+    data = Column(JSONB, nullable=False)
+    hit_count = Column(Integer, server_default='0', nullable=False)
+
+    def __repr__(self):
+        return f"<CropAnalysisCache(content_hash={self.content_hash}, s3_key={self.s3_key}, model={self.model}, hit_count={self.hit_count})>"
+
+class CropCacheCounter(Base):
+    __tablename__ = 'crop_cache_counters'
+
+    # A single row (id 1) with the crop cache lookups of every worker, added to with each batch of crop results
+    id = Column(Integer, primary_key=True)
+    hits = Column(Integer, server_default='0', nullable=False)
+    misses = Column(Integer, server_default='0', nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<CropCacheCounter(hits={self.hits}, misses={self.misses})>"
+
+class ProcessingJob(Base):
+    __tablename__ = 'processing_jobs'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    image_id = Column(Integer, ForeignKey('images.id', ondelete='CASCADE'), index=True, nullable=False)
+    status = Column(String, index=True, nullable=False, default='queued')  # queued, running, succeeded, failed, cancelled
+    priority = Column(Integer, index=True, nullable=False, default=0)  # Higher runs first
+    fair_share_key = Column(String, index=True, nullable=True)  # Jobs of the same uploader or label share workers fairly
+    cancel_requested_at = Column(DateTime(timezone=True), nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    run_after = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)  # Retry backoff
+    worker_id = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime(timezone=True), index=True, nullable=True)
+    heartbeat_at = Column(DateTime(timezone=True), nullable=True)
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    last_error = Column(String, nullable=True)
+
+    image = relationship("Image")
+
+    __table_args__ = (
+        # At most one queued or running job per image, whatever races between enqueue requests
+        Index(
+            'uq_processing_jobs_active_image_id', 'image_id',
+            unique=True, postgresql_where=text("status IN ('queued', 'running')"),
+        ),
+    )
+
+    def __repr__(self):
+        return f"<ProcessingJob(id={self.id}, image_id={self.image_id}, status={self.status}, attempts={self.attempts}, worker_id={self.worker_id})>"
@@ -0,0 +1,271 @@
+# app/pipeline.py
+import time
+import queue
+import threading
+
+# Marks the end of a stage's input
+_END = object()
+
+# How often blocked workers wake up to check whether the pipeline has been stopped
+_POLL_SECONDS = 0.2
+
+
+class PipelineCancelled(Exception):
+    """
+    Raised by Pipeline.run() when the pipeline was cancelled before all items went through.
+
+    A stage may raise it too, to abandon its item once the pipeline is stopped;
+    that is not recorded as a failure.
+    """
+
+
+# -------------------------------- Stage --------------------------------
+class Stage:
+    """
+    One step of a Pipeline, run by its own pool of worker threads.
+
+    func(item) or func(item, context) returns the item to hand to the next
+    stage, or None when the item is finished early (e.g. a polygon that does
+    not overlap the image). If context_factory is given, each worker thread
+    creates one context (e.g. a database session) and closes it when it exits.
+    """
+
+    def __init__(self, name: str, func, workers: int = 1, queue_size: int = None, context_factory=None):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.queue_size = queue_size if queue_size is not None else self.workers * 2
+        self.context_factory = context_factory
+
+        self.input = queue.Queue(maxsize=self.queue_size)
+        self._lock = threading.Lock()
+        self._active_workers = 0
+        self._started_at = None
+        self._finished_at = None
+        self.processed = 0
+        self.finished_early = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+
+    def record(self, seconds: float, finished_early: bool):
+        with self._lock:
+            self.processed += 1
+            self.busy_seconds += seconds
+            if finished_early:
+                self.finished_early += 1
+
+    def record_queue_depth(self):
+        depth = self.input.qsize()
+        with self._lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            end = self._finished_at or time.time()
+            elapsed = end - self._started_at if self._started_at else 0.0
+            return {
+                "stage": self.name,
+                "workers": self.workers,
+                "processed": self.processed,
+                "finished_early": self.finished_early,
+                "busy_seconds": round(self.busy_seconds, 3),
+                "throughput_per_second": round(self.processed / elapsed, 3) if elapsed > 0 else 0.0,
+                "utilisation": round(self.busy_seconds / (elapsed * self.workers), 3) if elapsed > 0 else 0.0,
+                "queue_depth": self.input.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "queue_size": self.queue_size,
+            }
+
+
+# -------------------------------- Pipeline --------------------------------
+class Pipeline:
+    """
+    Streams items through a chain of stages connected by bounded queues.
+
+    Every stage works concurrently with the others, so CPU-bound steps overlap
+    with network-bound ones, and the bounded queues apply back-pressure so a fast
+    stage cannot run arbitrarily far ahead of a slow one. run() yields each item
+    as soon as it leaves the last stage (or finishes early). If any stage raises,
+    the pipeline stops and the first exception is re-raised from run().
+
+    Setting cancel_event (e.g. from another thread) stops the pipeline too:
+    workers finish the item they hold, take no new ones, and run() raises
+    PipelineCancelled. Stages that block (e.g. waiting for memory) should watch
+    stop_event so they give up once the pipeline stops. on_stop, if given, is
+    called as soon as the pipeline stops, before its threads are joined, to
+    release what abandoned items still hold.
+    """
+
+    def __init__(self, name: str, stages: list, cancel_event: threading.Event = None, on_stop=None):
+        self.name = name
+        self.stages = stages
+        self.output = queue.Queue()
+        self.cancel_event = cancel_event
+        self.on_stop = on_stop
+        self._stop = threading.Event()
+        self._error = None
+        self._error_lock = threading.Lock()
+        self._threads = []
+
+    # ------------------- Internal -------------------
+    def _stopped(self) -> bool:
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            self._stop.set()
+        return self._stop.is_set()
+
+    def _put(self, target: queue.Queue, item) -> bool:
+        # Blocking put that gives up once the pipeline is stopped
+        while not self._stopped():
+            try:
+                target.put(item, timeout=_POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fail(self, error: BaseException):
+        with self._error_lock:
+            if self._error is None:
+                self._error = error
+        self._stop.set()
+
+    def _worker(self, stage_index: int):
+        stage = self.stages[stage_index]
+        next_queue = self.stages[stage_index + 1].input if stage_index + 1 < len(self.stages) else self.output
+        context = None
+        try:
+            if stage.context_factory is not None:
+                context = stage.context_factory()
+
+            while not self._stopped():
+                try:
+                    item = stage.input.get(timeout=_POLL_SECONDS)
+                except queue.Empty:
+                    continue
+                if item is _END:
+                    break
+                stage.record_queue_depth()
+
+                start_time = time.time()
+                result = stage.func(item, context) if context is not None else stage.func(item)
+                stage.record(time.time() - start_time, finished_early=result is None)
+
+                # Items finished early skip the remaining stages but are still reported
+                if result is None:
+                    self._put(self.output, item)
+                else:
+                    self._put(next_queue, result)
+        except PipelineCancelled as e:
+            # Abandoning an item because the pipeline stopped is not a failure of its own
+            if not self._stopped():
+                self._fail(e)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            if context is not None and hasattr(context, "close"):
+                try:
+                    context.close()
+                except BaseException as e:
+                    self._fail(e)
+            self._worker_done(stage_index)
+
+    def _worker_done(self, stage_index: int):
+        stage = self.stages[stage_index]
+        with stage._lock:
+            stage._active_workers -= 1
+            last_worker = stage._active_workers == 0
+            if last_worker:
+                stage._finished_at = time.time()
+        if not last_worker:
+            return
+        # The last worker of a stage closes the input of the next one
+        if stage_index + 1 < len(self.stages):
+            next_stage = self.stages[stage_index + 1]
+            for _ in range(next_stage.workers):
+                self._put(next_stage.input, _END)
+        else:
+            self.output.put(_END)
+
+    def _feed(self, items):
+        try:
+            for item in items:
+                if not self._put(self.stages[0].input, item):
+                    return
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            for _ in range(self.stages[0].workers):
+                self._put(self.stages[0].input, _END)
+
+    # ------------------- Public -------------------
+    def run(self, items):
+        start_time = time.time()
+        for stage_index, stage in enumerate(self.stages):
+            stage._active_workers = stage.workers
+            stage._started_at = start_time
+            for worker_index in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._worker,
+                    args=(stage_index,),
+                    name=f"{self.name}-{stage.name}-{worker_index}",
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append(thread)
+
+        feeder = threading.Thread(target=self._feed, args=(items,), name=f"{self.name}-feed", daemon=True)
+        feeder.start()
+        self._threads.append(feeder)
+
+        completed = False
+        try:
+            while True:
+                try:
+                    item = self.output.get(timeout=_POLL_SECONDS)
+                except queue.Empty:
+                    if self._stopped():
+                        break
+                    continue
+                if item is _END:
+                    # Workers also close their outputs when stopped early
+                    completed = not self._stop.is_set()
+                    break
+                yield item
+        finally:
+            # Reached on completion, on error, and when the caller stops iterating early
+            self._stop.set()
+            if self.on_stop is not None:
+                try:
+                    self.on_stop()
+                except Exception as e:
+                    print(f"Pipeline {self.name}: on_stop failed: {e}")
+            for thread in self._threads:
+                thread.join()
+            print(f"Pipeline {self.name} finished in {time.time() - start_time:.2f} seconds.")
+            self.print_metrics()
+
+        if self._error is not None:
+            raise self._error
+        if not completed and self.cancel_event is not None and self.cancel_event.is_set():
+            raise PipelineCancelled(f"Pipeline {self.name} was cancelled")
+
+    @property
+    def stop_event(self) -> threading.Event:
+        # Set once the pipeline stops for any reason (completion, error, cancel_event)
+        return self._stop
+
+    def stop(self):
+        self._stop.set()
+
+    def metrics(self) -> list:
+        return [stage.metrics() for stage in self.stages]
+
+    def print_metrics(self):
+        for metrics in self.metrics():
+            print(
+                f"  [{self.name}] {metrics['stage']}: {metrics['processed']} items "
+                f"({metrics['finished_early']} finished early), "
+                f"{metrics['throughput_per_second']}/s with {metrics['workers']} workers, "
+                f"utilisation {metrics['utilisation']:.0%}, "
+                f"queue depth {metrics['queue_depth']} (max {metrics['max_queue_depth']}/{metrics['queue_size']})"
+            )
@@ -9,6 +9,7 @@ import matplotlib.pyplot as plt
 import time  # Added for timing measurements
 import threading
 import asyncio
+import tempfile
 
 from PIL import Image, ImageDraw
 from concurrent.futures import ThreadPoolExecutor
@@ -18,6 +19,7 @@ from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 
 import rasterio
+import rasterio.shutil
 from rasterio import windows, open as rio_open
 from rasterio.mask import mask
 from rasterio.warp import (
@@ -40,13 +42,19 @@ from pyproj import Transformer
 from geoalchemy2.shape import from_shape, to_shape
 
 
-from app import models, schemas, lvm, crud
+from app import models, schemas, lvm, crud, ingest, geo, services
 from app.db import SessionLocal
 from dotenv import load_dotenv
 import base64
 
 from affine import Affine
 from app.websockets import manager
+from app.raster import RasterSource
+from app.imaging import ImageFrame
+from app.memory import raster_memory_budget, estimate_crop_footprint, MemoryBudgetCancelled
+from app.pipeline import Pipeline, Stage, PipelineCancelled
+from app.read_planner import BlockReadPlan, READ_PLANNER_ENABLED
+from app.progress import progress_tracker
 
 
 
@@ -64,6 +72,29 @@ BUCKET_NAME = os.getenv("BUCKET_NAME")
 PREFIX_FIRE_ACCESS_WAY = os.getenv("PREFIX_FIRE_ACCESS_WAY")
 PREFIX_DRONE_MAP = os.getenv("PREFIX_DRONE_MAP")
 
+# Number of polygons analysed by the model at the same time within one image
+POLYGON_WORKERS = max(1, int(os.getenv("POLYGON_WORKERS", "4")))
+
+# Worker count of each crop pipeline stage, and the size of the queue in front of each stage
+PIPELINE_READ_WORKERS = int(os.getenv("PIPELINE_READ_WORKERS", "2"))
+PIPELINE_ENCODE_WORKERS = int(os.getenv("PIPELINE_ENCODE_WORKERS", "2"))
+PIPELINE_UPLOAD_WORKERS = int(os.getenv("PIPELINE_UPLOAD_WORKERS", "4"))
+PIPELINE_INFERENCE_WORKERS = int(os.getenv("PIPELINE_INFERENCE_WORKERS", str(POLYGON_WORKERS)))
+PIPELINE_DB_WORKERS = int(os.getenv("PIPELINE_DB_WORKERS", "1"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+
+# 'model' reads crops at the model's working resolution (from overviews where available),
+# 'full' reads them at full resolution up to MAX_DIMENSION pixels
+CROP_MODE = os.getenv("CROP_MODE", "model").lower()
+CROP_TARGET_SIZE = int(os.getenv("CROP_TARGET_SIZE", "1024"))  # Longest side in pixels
+CROP_TARGET_GSD = float(os.getenv("CROP_TARGET_GSD", "0") or 0)  # Pixel size in raster CRS units, overrides the size
+MAX_DIMENSION = 10000
+# Full-resolution crops needing more memory than this are streamed tile by tile to a GeoTIFF
+CROP_STREAM_THRESHOLD_MB = int(os.getenv("CROP_STREAM_THRESHOLD_MB", "256"))
+
+# JPEG options of the cropped image uploaded for users
+CROPPED_IMAGE_OPTIONS = {"quality": 100, "optimize": True}
+
 s3_client = boto3.client(
     's3',
     aws_access_key_id=AWS_ACCESS_KEY_ID,
@@ -145,128 +176,157 @@ def generate_presigned_url(s3_key: str, expiration: int = 3600):
 
 # -------------------------------- MAIN function --------------------------------
 
-def process_image(db: Session, image: schemas.Image) -> schemas.ImageResponse:
+def check_cancelled(cancel_event: threading.Event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise PipelineCancelled("Processing was cancelled")
+
+
+def mark_processing_failed(image_id: int, lease_lost: threading.Event = None):
+    # After a lease loss the image is being processed by its new owner, whose status must not be overwritten
+    if lease_lost is not None and lease_lost.is_set():
+        print(f"Lease on image {image_id} was lost; leaving its status to the new owner")
+        return
+    progress_tracker.update(image_id, -1)
+
+
+def process_image(db: Session, image: schemas.Image, cancel_event: threading.Event = None, lease_lost: threading.Event = None) -> schemas.ImageResponse:
+    # cancel_event is set (e.g. by the worker's heartbeat) to stop the job between steps and polygons.
+    # lease_lost is set when another worker took the job over: this one then writes nothing more for the image.
     try:
         print("Starting image processing...")
         total_start_time = time.time()  # Start total processing timer
 
         # ------------------- Initialisation ------------------- 
-        crud.update_processing_status(db, image.id, 0)  # Set processing status to 0
-        manager.send_progress_sync(image.id, 0)
+        progress_tracker.update(image.id, 0)  # Set processing status to 0
 
         crud.delete_cropped_images(db, image.id)  # Allow for Reprocessing
 
-        image_s3_path = f's3://{BUCKET_NAME}/{image.original_s3_key}'
-
-        # Set AWS credentials in environment variables
-        os.environ['AWS_ACCESS_KEY_ID'] = AWS_ACCESS_KEY_ID
-        os.environ['AWS_SECRET_ACCESS_KEY'] = AWS_SECRET_ACCESS_KEY
-        os.environ['AWS_REGION'] = AWS_REGION
+        # Read from the Cloud-Optimized GeoTIFF produced at ingest, converting now if it is missing
+        source_s3_key = ingest.ensure_cog(db, image)
+        image_s3_path = f's3://{BUCKET_NAME}/{source_s3_key}'
 
         print("Opening dataset...")
         open_dataset_start_time = time.time()
 
-        with rasterio.Env(
-            GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR',
-            CPL_VSIL_CURL_USE_HEAD='NO',
-            VSI_CACHE='TRUE',
-            GDAL_CACHEMAX=512
-        ):
-            with rasterio.open(image_s3_path) as dataset:
-                open_dataset_end_time = time.time()
-                print(f"Dataset opened in {open_dataset_end_time - open_dataset_start_time:.2f} seconds.")
-
-                # Extract bounds and get address
-                print("Extracting bounds and image center...")
-                extract_bounds_start_time = time.time()
-                bounds, crs, (center_lon, center_lat) = extract_bounds(dataset)
-                location = get_address_from_image_center([center_lon, center_lat])
-                extract_bounds_end_time = time.time()
-                print(f"Bounds extracted and location obtained in {extract_bounds_end_time - extract_bounds_start_time:.2f} seconds.")
-
-                crud.update_processing_status(db, image.id, 25)  # Update status to 25%
-                manager.send_progress_sync(image.id, 25)
-
-                # Get polygons within bounds
-                print("Fetching polygons within bounds...")
-                polygons_fetch_start_time = time.time()
-                polygons = crud.get_polygons_within_bounds(db=db, bounds=bounds)
-                polygons_fetch_end_time = time.time()
-                print(f"Fetched {len(polygons)} polygons in {polygons_fetch_end_time - polygons_fetch_start_time:.2f} seconds.")
-
-                print("\nPolygons:")
-                print(polygons)
-                print("\n")
-
-                # Draw polygons on image
-                print("Drawing polygons on image...")
-                draw_polygons_start_time = time.time()
-                image_annotated_s3_key = draw_polygons_on_image(image, polygons, dataset)
-                draw_polygons_end_time = time.time()
-                print(f"Polygons drawn on image in {draw_polygons_end_time - draw_polygons_start_time:.2f} seconds.")
-                
-                # Attempt to update the image with the annotated S3 key and location
-                try:
-                    crud.update_image(db, image_id=image.id, annotated_s3_key=image_annotated_s3_key, location=location)
-                except IntegrityError as ie:
-                    db.rollback()  # Rollback the transaction to maintain session integrity
-                    print(f"IntegrityError: {ie}")
-                    raise HTTPException(status_code=400, detail="A database integrity error occurred. Possibly a unique constraint violation.")
-                except SQLAlchemyError as sae:
-                    db.rollback()
-                    print(f"SQLAlchemyError: {sae}")
-                    raise HTTPException(status_code=500, detail="A database error occurred while updating the image.")
-
-                crud.update_processing_status(db, image.id, 50)  # Update status to 50%
-                manager.send_progress_sync(image.id, 50)
-
-                # Close the dataset before starting threads
-                dataset.close()
-
-                # Process polygons sequentially and update progress
-                print("Starting polygon cropping and analysis...")
-                crop_polygons_start_time = time.time()
-                total_polygons = len(polygons)
-                polygons_processed = 0
-
-                for idx, polygon in enumerate(polygons):
-                    crop_polygon(db, image, image_s3_path, polygon, idx)
+        # The source raster is opened once and shared by the annotation and every polygon crop
+        with RasterSource(image_s3_path) as dataset:
+            open_dataset_end_time = time.time()
+            print(f"Dataset opened in {open_dataset_end_time - open_dataset_start_time:.2f} seconds.")
+
+            # Extract bounds and get address
+            print("Extracting bounds and image center...")
+            extract_bounds_start_time = time.time()
+            bounds, crs, (center_lon, center_lat) = extract_bounds(dataset)
+            location, location_is_final = get_address_from_image_center(db, [center_lon, center_lat])
+            extract_bounds_end_time = time.time()
+            print(f"Bounds extracted and location obtained in {extract_bounds_end_time - extract_bounds_start_time:.2f} seconds.")
+
+            progress_tracker.update(image.id, 25)  # Update status to 25%
+            check_cancelled(cancel_event)
+
+            # Get polygons within bounds
+            print("Fetching polygons within bounds...")
+            polygons_fetch_start_time = time.time()
+            polygons = crud.get_polygons_within_bounds(db=db, bounds=bounds)
+            polygon_ids = [polygon.id for polygon in polygons]  # Read before commits expire the instances
+            # Reproject every polygon into the raster CRS in one batch, shared by drawing and cropping
+            polygon_rings = geo.reproject_rings([polygon.coordinates for polygon in polygons], geo.POLYGON_CRS, dataset.crs)
+            polygons_fetch_end_time = time.time()
+            print(f"Fetched {len(polygons)} polygons in {polygons_fetch_end_time - polygons_fetch_start_time:.2f} seconds.")
+
+            print("\nPolygons:")
+            print(polygons)
+            print("\n")
+
+            # Draw polygons on image
+            print("Drawing polygons on image...")
+            draw_polygons_start_time = time.time()
+            image_annotated_s3_key = draw_polygons_on_image(image, polygon_rings, dataset)
+            draw_polygons_end_time = time.time()
+            print(f"Polygons drawn on image in {draw_polygons_end_time - draw_polygons_start_time:.2f} seconds.")
+            
+            # Attempt to update the image with the annotated S3 key and location
+            try:
+                crud.update_image(db, image_id=image.id, annotated_s3_key=image_annotated_s3_key, location=location)
+            except IntegrityError as ie:
+                db.rollback()  # Rollback the transaction to maintain session integrity
+                print(f"IntegrityError: {ie}")
+                raise HTTPException(status_code=400, detail="A database integrity error occurred. Possibly a unique constraint violation.")
+            except SQLAlchemyError as sae:
+                db.rollback()
+                print(f"SQLAlchemyError: {sae}")
+                raise HTTPException(status_code=500, detail="A database error occurred while updating the image.")
+
+            if not location_is_final:
+                # Replace the provisional location with Nominatim's answer once it arrives
+                services.refresh_address_async(center_lon, center_lat, image_id=image.id, provisional_address=location)
+
+            progress_tracker.update(image.id, 50)  # Update status to 50%
+            check_cancelled(cancel_event)
+
+            # Plain values for the pipeline threads, which must not touch this session's instances
+            image_id, image_filename, image_original_s3_key = image.id, image.filename, image.original_s3_key
+
+            # Stream polygons through the crop pipeline and update progress as each one finishes
+            print("Starting polygon cropping and analysis pipeline...")
+            crop_polygons_start_time = time.time()
+            total_polygons = len(polygon_ids)
+            polygons_processed = 0
+            crop_cache_hits = 0
+
+            tasks = [
+                CropTask(idx, polygon_id, transformed_coords, image_id, image_filename, image_original_s3_key)
+                for idx, (polygon_id, transformed_coords) in enumerate(zip(polygon_ids, polygon_rings))
+            ]
+            # Order neighbouring polygons so the raster blocks they share are fetched once
+            read_plan = None
+            if READ_PLANNER_ENABLED:
+                tasks, read_plan = plan_crop_reads(tasks, dataset)
+            try:
+                for task in build_crop_pipeline(dataset, image_id, cancel_event, read_plan, lease_lost).run(tasks):
                     polygons_processed += 1
+                    crop_cache_hits += task.cache_hit
                     progress = 50 + int((polygons_processed / total_polygons) * 25)
-                    crud.update_processing_status(db, image.id, progress)
-                    manager.send_progress_sync(image.id, progress)
-                    print(f"Updated processing status to {progress}% after processing polygon {idx}")
-
-                crop_polygons_end_time = time.time()
-                print(f"Polygon cropping and analysis completed in {crop_polygons_end_time - crop_polygons_start_time:.2f} seconds.")
-
-                crud.update_processing_status(db, image.id, 75)  # Update status to 75%
-                manager.send_progress_sync(image.id, 75)
-
-                # Finalize processing
-                crud.update_processing_status(db, image.id, 100)  # Update status to 100%
-                manager.send_progress_sync(image.id, 100)
-
-                total_end_time = time.time()
-                print(f"Total image processing completed in {total_end_time - total_start_time:.2f} seconds.")
-
-                # Final steps
-                return schemas.ImageResponse(
-                    id=image.id,
-                    created_at=image.created_at,
-                    filename=image.filename,
-                    annotated_url=generate_presigned_url(image_annotated_s3_key),
-                    cropped_images=[],  # Adjust as needed
-                )
+                    progress_tracker.update(image_id, progress)
+                    print(f"Updated processing status to {progress}% after processing polygon {task.index} ({polygons_processed}/{total_polygons})")
+            finally:
+                # Memory still held by polygons abandoned on failure
+                raster_memory_budget.release_owner(image_id)
+                print(f"Raster memory budget: {raster_memory_budget.metrics()}")
+                if read_plan is not None:
+                    read_plan.print_metrics()
+
+            crop_polygons_end_time = time.time()
+            print(f"Polygon cropping and analysis completed in {crop_polygons_end_time - crop_polygons_start_time:.2f} seconds.")
+            print(f"Crop cache: {crop_cache_hits} hits, {polygons_processed - crop_cache_hits} misses or skipped")
+
+            progress_tracker.update(image.id, 75)  # Update status to 75%
+
+            # Finalize processing
+            progress_tracker.update(image.id, 100)  # Update status to 100%
+
+            total_end_time = time.time()
+            print(f"Total image processing completed in {total_end_time - total_start_time:.2f} seconds.")
+
+            # Final steps
+            return schemas.ImageResponse(
+                id=image.id,
+                created_at=image.created_at,
+                filename=image.filename,
+                annotated_url=generate_presigned_url(image_annotated_s3_key),
+                cropped_images=[],  # Adjust as needed
+            )
+    except PipelineCancelled:
+        print(f"Processing of image {image.id} cancelled")
+        mark_processing_failed(image.id, lease_lost)
+        raise
     except HTTPException as http_exc:
         print(f"HTTPException: {http_exc.detail}")
-        crud.update_processing_status(db, image.id, -1)
-        manager.send_progress_sync(image.id, -1)
+        mark_processing_failed(image.id, lease_lost)
         raise
     except Exception as e:
         print("PROCESSING ERROR")
-        crud.update_processing_status(db, image.id, -1)
-        manager.send_progress_sync(image.id, -1)
+        mark_processing_failed(image.id, lease_lost)
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
 
 # -------------------------------- Helper functions --------------------------------
@@ -293,52 +353,18 @@ def extract_bounds(dataset):
     print(f"extract_bounds completed in {end_time - start_time:.2f} seconds.")
     return transformed_bounds, original_crs, (center_lon, center_lat)
     
-def reverse_geocode(coordinates):
-    try:
-        start_time = time.time()
-        # Extract the coordinates
-        lon, lat = coordinates
-        
-        # Format the API endpoint URL with the given coordinates
-        url = f"https://nominatim.openstreetmap.org/reverse?lon={lon}&lat={lat}&format=json&addressdetails=1"
-        
-        # Make the API request
-        response = requests.get(url, headers={"User-Agent": "Blockfinder"})
-        
-        # Raise an HTTP exception if the request was not successful
-        response.raise_for_status()
-        
-        # Parse the JSON response
-        data = response.json()
-        
-        # Check if the API returned any results
-        if "address" in data:
-            address_info = data["address"]
-            address = address_info.get("road", "No address found")
-            city = address_info.get("city", "No city found")
-            end_time = time.time()
-            print(f"Reverse geocoding completed in {end_time - start_time:.2f} seconds.")
-            return f"{address}, {city}"
-        else:
-            end_time = time.time()
-            print(f"Reverse geocoding completed in {end_time - start_time:.2f} seconds.")
-            return "No address found for the given coordinates."
-
-    except requests.RequestException as e:
-        print(f"Error occurred while reverse geocoding: {e}")
-        raise HTTPException(status_code=500, detail="Error occurred while reverse geocoding.")
-
-
-def get_address_from_image_center(center_coordinates):
+def get_address_from_image_center(db: Session, center_coordinates):
     print("Starting reverse geocoding...")
-    address = reverse_geocode(center_coordinates)
-    print(f"Address for the image center: {address}")
-    return address
+    start_time = time.time()
+    center_lon, center_lat = center_coordinates
+    # Served from the geocode cache or a local lookup; the network is never on the critical path
+    address, is_final = services.resolve_address(db, center_lon, center_lat)
+    print(f"Address for the image center: {address} ({time.time() - start_time:.2f} seconds)")
+    return address, is_final
 
 def convert_coordinates(coordinates, src_crs, dst_crs):
-    transformer = pyproj.Transformer.from_crs(src_crs, dst_crs, always_xy=True)
-    transformed_coords = [transformer.transform(x, y) for x, y in coordinates]
-    return transformed_coords
+    transformed_coords = geo.transform_coordinates(np.asarray(coordinates, dtype=np.float64).reshape(-1, 2), src_crs, dst_crs)
+    return [tuple(coord) for coord in transformed_coords]
 
 # -------------------------------- Crop polygon --------------------------------
 ### Crop and runs analysis on polygons
@@ -695,216 +721,504 @@ def convert_coordinates(coordinates, src_crs, dst_crs):
 #         print(f'Error occurred while processing polygon {index}: {e}')
 #         raise HTTPException(status_code=500, detail=f"Error occurred while cropping and drawing the polygon: {str(e)}")
 
-def crop_polygon(db, image: schemas.Image, image_s3_path: str, polygon: schemas.Polygon, index: int):
+# -------------------------------- Crop resolution --------------------------------
+def get_crop_scale_factor(window_width: float, window_height: float, src: RasterSource, mode: str = None) -> float:
+    """
+    Scale from the full-resolution window to the crop that is read.
+
+    In 'model' mode the crop is read at the model's working resolution: the
+    longest side is CROP_TARGET_SIZE pixels, or pixels are CROP_TARGET_GSD
+    raster CRS units wide when that is set. In 'full' mode the crop is only
+    capped at MAX_DIMENSION. Crops are never upsampled.
+    """
+    mode = mode or CROP_MODE
+    if mode == "full":
+        return min(1.0, MAX_DIMENSION / max(window_width, window_height))
+
+    if CROP_TARGET_GSD:
+        native_gsd = abs(src.transform.a)
+        return min(1.0, native_gsd / CROP_TARGET_GSD)
+    return min(1.0, CROP_TARGET_SIZE / max(window_width, window_height))
+
+
+def get_full_resolution_s3_key(s3_key: str, extension: str = None) -> str:
+    # {dirname}/full/{basename} next to the model-resolution crop, optionally with another extension
+    dirname, basename = os.path.split(s3_key)
+    if extension:
+        basename = f"{os.path.splitext(basename)[0]}{extension}"
+    return f"{dirname}/full/{basename}"
+
+
+# -------------------------------- Polygon pipeline stages --------------------------------
+class CropTask:
+    """State of one polygon as it moves through the crop pipeline."""
+
+    def __init__(self, index: int, polygon_id: int, transformed_coords: np.ndarray, image_id: int, image_filename: str, image_original_s3_key: str):
+        self.index = index
+        self.polygon_id = polygon_id
+        self.transformed_coords = transformed_coords  # Exterior ring in the raster CRS
+        self.image_id = image_id
+        self.image_filename = image_filename
+        self.image_original_s3_key = image_original_s3_key
+        self.start_time = time.time()
+
+        # Generate a unique filename for the cropped image
+        self.filename_cropped = f"{image_filename}-{index}.jpg"
+
+        # Save to PREFIX_FIRE_ACCESS_WAY bucket folder
+        filename = image_original_s3_key.split('/')[-1]
+        extracted_filename = filename.rsplit('.', 1)[0]
+        self.s3_key = f"{PREFIX_FIRE_ACCESS_WAY}/{extracted_filename}-{index}.jpg"
+
+        # Filled in by the stages
+        self.intersected_polygon = None
+        self.window = None  # Window of the polygon in the raster, and the scale and shape it is read at
+        self.scale_factor = None
+        self.out_shape = None
+        self.out_image = None
+        self.out_transform = None
+        self.mask = None
+        self.memory_reservation = None  # Held in the raster memory budget while the window's pixels are alive
+        self.content_hash = None
+        self.cache_s3_key = None  # Content-addressed copy of the crop, shared through the crop cache
+        self.cached_s3_key = None  # Set when an identical crop was analysed before
+        self.cropped_frame = None  # ImageFrame of the crop with background, for S3
+        self.masked_frame = None  # ImageFrame of the masked crop, for the model
+        self.data = None
+        self.cropped_image = None  # crud.PendingCroppedImage, given an id once its batch is written
+
+    @property
+    def cache_hit(self) -> bool:
+        return self.cached_s3_key is not None
+
+    @property
+    def cropped_image_id(self):
+        return self.cropped_image.id if self.cropped_image is not None else None
+
+
+def get_polygon_window(transformed_coords: np.ndarray, src: RasterSource):
+    # Part of the polygon inside the image and its window, or None if they don't overlap
+
+    # Create a polygon from the transformed coordinates
+    polygon_geom = Polygon(transformed_coords)
+
+    # Intersect the polygon with the image bounds
+    image_bounds_polygon = box(*src.bounds)
+    intersected_polygon = polygon_geom.intersection(image_bounds_polygon)
+
+    # Check if the intersection is valid
+    if intersected_polygon.is_empty or not intersected_polygon.is_valid:
+        return None
+
+    # Get the bounding box of the intersected polygon
+    min_x, min_y, max_x, max_y = intersected_polygon.bounds
+
+    # Create a window from the bounding box
+    window = from_bounds(min_x, min_y, max_x, max_y, src.transform)
+    return intersected_polygon, window
+
+
+def release_crop_memory(task: CropTask):
+    if task.memory_reservation is not None:
+        raster_memory_budget.release(task.memory_reservation)
+        task.memory_reservation = None
+
+
+def prepare_polygon_read(task: CropTask, src: RasterSource, mode: str = None) -> bool:
+    # Work out the polygon's window and read shape; False if the polygon does not overlap the image
+    polygon_window = get_polygon_window(task.transformed_coords, src)
+    if polygon_window is None:
+        return False
+    intersected_polygon, window = polygon_window
+
+    # Get the window width and height
+    window_width = window.width
+    window_height = window.height
+
+    # Calculate the scale factor
+    scale_factor = get_crop_scale_factor(window_width, window_height, src, mode)
+    print(f"Scale factor: {scale_factor}")
+
+    # Calculate the out_shape for reading data
+    out_height = max(1, int(window_height * scale_factor))
+    out_width = max(1, int(window_width * scale_factor))
+
+    task.intersected_polygon = intersected_polygon
+    task.window = window
+    task.scale_factor = scale_factor
+    task.out_shape = (src.count, out_height, out_width)
+    return True
+
+
+def plan_crop_reads(tasks: list, src: RasterSource):
+    """
+    Plan the window reads of every polygon of a job around the raster's blocks.
+
+    Returns:
+        tuple: (tasks, plan) with the tasks reordered so neighbouring polygons
+        that share blocks are read one after the other, and the BlockReadPlan
+        serving their windows.
+    """
+    start_time = time.time()
+    plan = BlockReadPlan(src)
+    for task in tasks:
+        if prepare_polygon_read(task, src):
+            plan.add(task.index, task.window, task.out_shape)
+    tasks_by_index = {task.index: task for task in tasks}
+    ordered = [tasks_by_index[index] for index in plan.order()]
+    # Polygons outside the image go last; the read stage finishes them straight away
+    ordered += [task for task in tasks if task.index not in plan.reads]
+    metrics = plan.metrics()
+    print(
+        f"Planned {metrics['reads']} window reads in {time.time() - start_time:.2f} seconds "
+        f"({metrics['naive_bytes'] / 2**20:.1f} MB if each polygon were read on its own)."
+    )
+    return ordered, plan
+
+
+def read_polygon_window(task: CropTask, src: RasterSource, mode: str = None, plan: BlockReadPlan = None, stop_event: threading.Event = None):
+    # --- Stage 1: read the polygon's window from the raster ---
+    print(f"Processing polygon {task.index} (ID: {task.polygon_id})...")
+    if task.window is None and not prepare_polygon_read(task, src, mode):
+        print(f"No overlap between polygon {task.index} and the image bounds.")
+        return None
+    window = task.window
+    out_shape = task.out_shape
+    out_height, out_width = out_shape[1], out_shape[2]
+
+    # Wait until the window and its copies fit in the memory budget, unless the pipeline stops first
+    footprint = estimate_crop_footprint(out_width, out_height, src.count, np.dtype(src.dtype).itemsize)
     try:
-        start_time = time.time()
-        print(f"Processing polygon {index} (ID: {polygon.id})...")
-        # Convert the polygon to a Shapely geometry
-        shape_geom = to_shape(polygon.coordinates)
-        polygon_id = polygon.id
-
-        # Open the dataset within the thread
-        with rasterio.Env(
-            GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR',
-            CPL_VSIL_CURL_USE_HEAD='NO',
-            VSI_CACHE='TRUE',
-            GDAL_CACHEMAX=512
-        ):
-            with rasterio.open(image_s3_path) as src:
-                # Get the CRS of the raster file
-                raster_crs = src.crs
-
-                # Define the CRS of your input coordinates (assumed to be WGS84 lat/lng)
-                coord_crs = pyproj.CRS('EPSG:4326')
-
-                # Create a transformer to convert from coord_crs to raster_crs
-                transformer = Transformer.from_crs(coord_crs, raster_crs, always_xy=True)
-
-                # Transform the coordinates using vectorized operations
-                coordinates = np.array(shape_geom.exterior.coords)
-                x_coords, y_coords = coordinates[:, 0], coordinates[:, 1]
-                transformed_x, transformed_y = transformer.transform(x_coords, y_coords)
-                transformed_coords = np.column_stack((transformed_x, transformed_y))
-
-                # Create a polygon from the transformed coordinates
-                polygon_geom = Polygon(transformed_coords)
-
-                # Intersect the polygon with the image bounds
-                image_bounds_polygon = box(*src.bounds)
-                intersected_polygon = polygon_geom.intersection(image_bounds_polygon)
-
-                # Check if the intersection is valid
-                if intersected_polygon.is_empty or not intersected_polygon.is_valid:
-                    print(f"No overlap between polygon {index} and the image bounds.")
-                    return  # or handle as appropriate
-
-                # Get the bounding box of the intersected polygon
-                min_x, min_y, max_x, max_y = intersected_polygon.bounds
-
-                # Create a window from the bounding box
-                window = from_bounds(min_x, min_y, max_x, max_y, src.transform)
-
-                # Get the window width and height
-                window_width = window.width
-                window_height = window.height
-
-                # Define the maximum dimension
-                MAX_DIMENSION = 10000  # Adjust as needed
-
-                # Calculate the scale factor
-                scale_factor = min(1.0, MAX_DIMENSION / max(window_width, window_height))
-                print(f"Scale factor: {scale_factor}")
-
-                # Calculate the out_shape for reading data
-                out_height = int(window_height * scale_factor)
-                out_width = int(window_width * scale_factor)
-                out_shape = (src.count, out_height, out_width)
-
-                # Read the data with the out_shape
-                out_image = src.read(
-                    window=window,
-                    out_shape=out_shape,
-                    resampling=Resampling.bilinear  # Use Bilinear resampling for speed
-                )
-
-                # Adjust the transform accordingly
-                out_transform = src.window_transform(window)
-                if scale_factor < 1.0:
-                    # Adjust the transform to account for the scaling
-                    scale_affine = Affine.scale(
-                        (window.width / out_width), (window.height / out_height)
-                    )
-                    out_transform *= scale_affine
-
-                # Create a mask for the intersected polygon
-                out_shape_mask = (out_height, out_width)  # (height, width)
-
-                # Rasterize the intersected polygon
-                mask = rasterize(
-                    [(intersected_polygon, 1)],
-                    out_shape=out_shape_mask,
-                    transform=out_transform,
-                    fill=0,
-                    dtype=rasterio.uint8
-                )
-
-                # --- Create Masked Image for LVM Processing ---
-
-                # Apply the mask to the image using broadcasting
-                masked_image = out_image * mask[np.newaxis, :, :]
-
-                # Convert to RGB image
-                img_masked = np.moveaxis(masked_image, 0, -1)  # Move channels to last dimension
-                img_masked_pil = Image.fromarray(img_masked.astype('uint8'), mode='RGB')
-
-                # --- Create Cropped Image with Background for Users ---
-
-                # Convert out_image to PIL Image
-                img_cropped = np.moveaxis(out_image, 0, -1)
-                img_cropped_pil = Image.fromarray(img_cropped.astype('uint8'), mode='RGB')
-
-                # Draw the intersected polygon boundary on the cropped image
-                draw = ImageDraw.Draw(img_cropped_pil)
-
-                # Transform polygon coordinates to pixel coordinates within the window
-                # Use vectorized operations
-                inv_transform = ~out_transform
-                px, py = inv_transform * (transformed_x, transformed_y)
-                pixel_coords = list(zip(px, py))
-
-                # Adjust line thickness based on image size
-                img_width, img_height = img_cropped_pil.width, img_cropped_pil.height
-                base_thickness = 2  # Base line thickness for smaller images
-                line_thickness = max(base_thickness, int(min(img_width, img_height) * 0.005))  # Adjust scaling factor
-
-                # Draw the polygon boundary
-                draw.line(pixel_coords + [pixel_coords[0]], fill=(255, 0, 0), width=line_thickness)
-                
-                #--- Save the Cropped Image with Background Locally ---
-                # img_cropped_pil.save(f"cropped_image_{index}.jpg", format="JPEG", quality=85, optimize=True)
-
-                # # --- Save the Masked Image for LVM Processing Locally ---
-                # img_masked_pil.save(f"masked_image_{index}.jpg", format="JPEG", quality=85, optimize=True)
-
-
-                # --- Save the Cropped Image with Background to S3 ---
-
-                # Save the image to a BytesIO buffer
-                buffer_cropped = io.BytesIO()
-                img_cropped_pil.save(buffer_cropped, format='JPEG', quality=100, optimize=True)
-                buffer_cropped.seek(0)
-
-                # Generate a unique filename for the cropped image
-                filename_cropped = f"{image.filename}-{index}.jpg"
-
-                # Save to PREFIX_FIRE_ACCESS_WAY bucket folder
-                filename = image.original_s3_key.split('/')[-1]
-                extracted_filename = filename.rsplit('.', 1)[0]
-                prefixed_filename_cropped = f"{PREFIX_FIRE_ACCESS_WAY}/{extracted_filename}-{index}.jpg"
-
-                # Upload the cropped image to S3
-                print(f"Uploading cropped image for polygon {index} to S3...")
-                upload_start_time = time.time()
-                s3_client.put_object(
-                    Bucket=BUCKET_NAME,
-                    Key=prefixed_filename_cropped,
-                    Body=buffer_cropped.getvalue(),
-                    ContentType='image/jpeg'
-                )
-                upload_end_time = time.time()
-                print(f"Cropped image for polygon {index} uploaded in {upload_end_time - upload_start_time:.2f} seconds.")
-
-                # --- Prepare Masked Image for LVM Processing ---
-
-                # Save masked image to a BytesIO buffer (for in-memory processing)
-                buffer_masked = io.BytesIO()
-                img_masked_pil.save(buffer_masked, format='JPEG', quality=100, optimize=True)
-                buffer_masked.seek(0)
-
-            # Save the cropped image details to the database
-            cropped_image = schemas.CroppedImageCreate(
-                image_id=image.id,
-                polygon_id=polygon_id,
-                filename=filename_cropped,
-                s3_key=prefixed_filename_cropped
-            )
-            db_cropped_image = crud.create_cropped_image(db=db, cropped_image=cropped_image)
-
-            # --- Run analysis on the masked image and update the database ---
-
-            print(f"Running analysis on cropped image for polygon {index}...")
-            analysis_start_time = time.time()
-
-            # Run the analysis using the masked image
-            data = lvm.run_image_through_model(buffer_masked)
-
-            analysis_end_time = time.time()
-            print(f"Analysis for polygon {index} completed in {analysis_end_time - analysis_start_time:.2f} seconds.")
+        task.memory_reservation = raster_memory_budget.acquire(
+            footprint, owner=task.image_id, label=f"polygon {task.index}", stop_event=stop_event
+        )
+    except MemoryBudgetCancelled as e:
+        raise PipelineCancelled(str(e))
 
-            db_cropped_image = crud.update_cropped_image_analysis(
-                db=db,
-                cropped_image_id=db_cropped_image.id,
-                data=data,
-                polygon_id=polygon_id
+    # Read the data with the out_shape, from the planned shared blocks or from an overview
+    try:
+        if plan is not None and task.index in plan.reads:
+            out_image = plan.read(task.index, resampling=Resampling.bilinear)
+        else:
+            out_image = src.read_resampled(
+                out_shape,
+                window=window,
+                resampling=Resampling.bilinear  # Use Bilinear resampling for speed
             )
+    except Exception:
+        release_crop_memory(task)
+        raise
 
-            end_time = time.time()
-            print(f"Processing for polygon {index} completed in {end_time - start_time:.2f} seconds.")
-
-            return schemas.CroppedImageResponse(
-                id=db_cropped_image.id,
-                filename=db_cropped_image.filename,
-                url=generate_presigned_url(db_cropped_image.s3_key) if cropped_image.s3_key else None,
-                data=data
+    # Adjust the transform accordingly
+    out_transform = src.window_transform(window)
+    if task.scale_factor < 1.0:
+        # Adjust the transform to account for the scaling
+        scale_affine = Affine.scale(
+            (window.width / out_width), (window.height / out_height)
+        )
+        out_transform *= scale_affine
+
+    task.out_image = out_image
+    task.out_transform = out_transform
+    return task
+
+
+def lookup_cached_crop(task: CropTask, db: Session):
+    # --- Stage 2: mask the crop and look up the analysis of an identical crop ---
+    out_image = task.out_image
+    out_height, out_width = out_image.shape[1], out_image.shape[2]
+
+    # Rasterize the intersected polygon
+    task.mask = rasterize(
+        [(task.intersected_polygon, 1)],
+        out_shape=(out_height, out_width),
+        transform=task.out_transform,
+        fill=0,
+        dtype=rasterio.uint8
+    )
+
+    # Same pixels, mask, model and prompt give the same analysis, so reuse it
+    task.content_hash = services.compute_crop_hash(out_image, task.mask)
+    task.cache_s3_key = services.get_crop_cache_s3_key(task.content_hash)
+    cached = services.get_cached_analysis(db, task.content_hash)
+    if cached:
+        task.cached_s3_key, task.data = cached
+        task.out_image = None  # Nothing left to encode
+        release_crop_memory(task)
+        print(f"Crop cache hit for polygon {task.index}, reusing {task.cached_s3_key}")
+    return task
+
+
+def draw_crop_outline(out_image: np.ndarray, out_transform, transformed_coords: np.ndarray) -> Image.Image:
+    # Convert out_image to PIL Image
+    img_cropped = np.moveaxis(out_image, 0, -1)
+    img_cropped_pil = Image.fromarray(img_cropped.astype('uint8'), mode='RGB')
+
+    # Draw the intersected polygon boundary on the cropped image
+    draw = ImageDraw.Draw(img_cropped_pil)
+
+    # Transform polygon coordinates to pixel coordinates within the window
+    # Use vectorized operations
+    inv_transform = ~out_transform
+    px, py = inv_transform * (transformed_coords[:, 0], transformed_coords[:, 1])
+    pixel_coords = list(zip(px, py))
+
+    # Adjust line thickness based on image size
+    img_width, img_height = img_cropped_pil.width, img_cropped_pil.height
+    base_thickness = 2  # Base line thickness for smaller images
+    line_thickness = max(base_thickness, int(min(img_width, img_height) * 0.005))  # Adjust scaling factor
+
+    # Draw the polygon boundary
+    draw.line(pixel_coords + [pixel_coords[0]], fill=(255, 0, 0), width=line_thickness)
+    return img_cropped_pil
+
+
+def mask_and_encode_crop(task: CropTask):
+    # --- Stage 3: apply the mask and encode the user and model images ---
+    if task.cache_hit:
+        return task
+
+    out_image = task.out_image
+    out_transform = task.out_transform
+    mask = task.mask
+
+    # --- Create Masked Image for LVM Processing ---
+
+    # Apply the mask to the image using broadcasting
+    masked_image = out_image * mask[np.newaxis, :, :]
+
+    # Convert to RGB image
+    masked_frame = ImageFrame.from_bands(masked_image)  # Move channels to last dimension
+
+    # --- Create Cropped Image with Background for Users ---
+    img_cropped_pil = draw_crop_outline(out_image, out_transform, task.transformed_coords)
+
+    # Encode each image once here, on a CPU worker; the upload and the model request reuse the bytes
+    cropped_frame = ImageFrame(image=img_cropped_pil)
+    cropped_frame.encode('JPEG', **CROPPED_IMAGE_OPTIONS)
+    lvm.encode_frame_for_model(masked_frame)
+    cropped_frame.release_pixels()
+    masked_frame.release_pixels()
+
+    task.cropped_frame = cropped_frame
+    task.masked_frame = masked_frame
+    task.out_image = None  # Release the raw pixels as soon as they are encoded
+    task.mask = None
+    release_crop_memory(task)
+    return task
+
+
+def upload_crop(task: CropTask):
+    # --- Stage 4: upload the cropped image with background to S3 ---
+    if task.cache_hit:
+        if task.cached_s3_key != task.s3_key:
+            # Each image owns its crops, so copy the cached object rather than pointing at it
+            s3_client.copy_object(
+                Bucket=BUCKET_NAME,
+                Key=task.s3_key,
+                CopySource={'Bucket': BUCKET_NAME, 'Key': task.cached_s3_key},
             )
+        return task
+
+    print(f"Uploading cropped image for polygon {task.index} to S3...")
+    upload_start_time = time.time()
+    s3_client.put_object(
+        Bucket=BUCKET_NAME,
+        Key=task.s3_key,
+        Body=task.cropped_frame.encode('JPEG', **CROPPED_IMAGE_OPTIONS),
+        ContentType='image/jpeg'
+    )
+    # The crop cache points at an immutable, content-addressed copy: the per-image key above
+    # is overwritten whenever the image is reprocessed, possibly with another polygon's crop
+    s3_client.copy_object(
+        Bucket=BUCKET_NAME,
+        Key=task.cache_s3_key,
+        CopySource={'Bucket': BUCKET_NAME, 'Key': task.s3_key},
+    )
+    upload_end_time = time.time()
+    print(f"Cropped image for polygon {task.index} uploaded in {upload_end_time - upload_start_time:.2f} seconds.")
+
+    task.cropped_frame = None
+    return task
+
+
+def analyse_crop(task: CropTask):
+    # --- Stage 5: run the masked image through the model ---
+    if task.cache_hit:
+        return task
+
+    print(f"Running analysis on cropped image for polygon {task.index}...")
+    analysis_start_time = time.time()
+
+    task.data = lvm.run_image_through_model(task.masked_frame)
+
+    analysis_end_time = time.time()
+    print(f"Analysis for polygon {task.index} completed in {analysis_end_time - analysis_start_time:.2f} seconds.")
+
+    task.masked_frame = None
+    return task
+
+
+def save_crop_result(task: CropTask, writer: crud.CropResultWriter):
+    # --- Stage 6: queue the cropped image and its analysis for the next batched database write ---
+    cropped_image = schemas.CroppedImageCreate(
+        image_id=task.image_id,
+        polygon_id=task.polygon_id,
+        filename=task.filename_cropped,
+        s3_key=task.s3_key
+    )
+    task.cropped_image = writer.add(
+        cropped_image, task.data, content_hash=task.content_hash, cache_s3_key=task.cache_s3_key, cache_hit=task.cache_hit
+    )
+
+    print(f"Processing for polygon {task.index} completed in {time.time() - task.start_time:.2f} seconds.")
+    return task
+
+
+def open_crop_result_writer(lease_lost: threading.Event = None) -> crud.CropResultWriter:
+    # One session per db_write worker; closing the writer flushes the last batch, unless the lease was lost
+    return crud.CropResultWriter(SessionLocal(), discard_event=lease_lost)
+
+
+# -------------------------------- Crop pipeline --------------------------------
+def build_crop_pipeline(src: RasterSource, image_id: int, cancel_event: threading.Event = None, plan: BlockReadPlan = None, lease_lost: threading.Event = None) -> Pipeline:
+    """
+    Build the streaming pipeline that crops, uploads and analyses every polygon of an image.
+
+    Each stage has its own worker count so CPU-bound masking/encoding overlaps
+    with raster reads, S3 uploads and model calls. Crops found in the crop cache
+    pass through encode, upload and inference without doing any work. The database stage gives
+    every worker its own batched writer, so rows are written in bulk rather than
+    one commit per polygon. With a read plan, windows are served from the
+    plan's shared blocks. Once the pipeline stops, reads waiting for memory give
+    up and the image's memory reservations are released before its threads are
+    joined. Once lease_lost is set, the writers drop their buffered rows instead
+    of writing them.
+    """
+    pipeline = Pipeline("crop", [
+        Stage("read", lambda task: read_polygon_window(task, src, plan=plan, stop_event=pipeline.stop_event), workers=PIPELINE_READ_WORKERS, queue_size=PIPELINE_QUEUE_SIZE),
+        Stage("cache_lookup", lookup_cached_crop, workers=PIPELINE_READ_WORKERS, queue_size=PIPELINE_QUEUE_SIZE, context_factory=SessionLocal),
+        Stage("encode", mask_and_encode_crop, workers=PIPELINE_ENCODE_WORKERS, queue_size=PIPELINE_QUEUE_SIZE),
+        Stage("upload", upload_crop, workers=PIPELINE_UPLOAD_WORKERS, queue_size=PIPELINE_QUEUE_SIZE),
+        Stage("inference", analyse_crop, workers=PIPELINE_INFERENCE_WORKERS, queue_size=PIPELINE_QUEUE_SIZE),
+        Stage("db_write", save_crop_result, workers=PIPELINE_DB_WORKERS, queue_size=PIPELINE_QUEUE_SIZE, context_factory=lambda: open_crop_result_writer(lease_lost)),
+    ], cancel_event=cancel_event, on_stop=lambda: raster_memory_budget.release_owner(image_id))
+    return pipeline
+
+
+def crop_polygon(db, image: schemas.Image, src: RasterSource, polygon: schemas.Polygon, index: int, transformed_coords: np.ndarray = None):
+    # Run every pipeline stage for a single polygon on the calling thread
+    try:
+        # Use the ring reprojected for the whole job, or reproject this polygon on its own
+        if transformed_coords is None:
+            transformed_coords = geo.reproject_rings([polygon.coordinates], geo.POLYGON_CRS, src.crs)[0]
+
+        task = CropTask(index, polygon.id, transformed_coords, image.id, image.filename, image.original_s3_key)
+        if read_polygon_window(task, src) is None:
+            return  # No overlap with the image
+        writer = crud.CropResultWriter(db)
+        save_crop_result(analyse_crop(upload_crop(mask_and_encode_crop(lookup_cached_crop(task, db)))), writer)
+        writer.flush()
+
+        return schemas.CroppedImageResponse(
+            id=task.cropped_image_id,
+            filename=task.filename_cropped,
+            url=generate_presigned_url(task.s3_key),
+            data=task.data
+        )
 
     except Exception as e:
         print(f'Error occurred while processing polygon {index}: {e}')
         raise HTTPException(status_code=500, detail=f"Error occurred while cropping and drawing the polygon: {str(e)}")
 
 
+# -------------------------------- Full-resolution archive --------------------------------
+def archive_full_resolution_crop(db: Session, cropped_image_id: int) -> str:
+    """
+    Produce the full-resolution crop of a polygon on demand.
+
+    Pipeline crops are read at the model's resolution; the full-resolution
+    version is only made when someone asks for it, and stored next to the
+    model-resolution crop for later requests. Windows whose in-memory crop would
+    exceed CROP_STREAM_THRESHOLD_MB are streamed tile by tile into a masked
+    Cloud-Optimized GeoTIFF instead of a JPEG (capped at MAX_DIMENSION), so
+    memory stays flat however large the polygon is.
+
+    Returns:
+        str: S3 key of the full-resolution crop.
+    """
+    db_cropped_image = crud.get_cropped_image_by_id(db, cropped_image_id)
+    if not db_cropped_image:
+        raise HTTPException(status_code=404, detail="Cropped image not found")
+
+    for extension in (".jpg", ".tif"):
+        full_s3_key = get_full_resolution_s3_key(db_cropped_image.s3_key, extension)
+        try:
+            s3_client.head_object(Bucket=BUCKET_NAME, Key=full_s3_key)
+            return full_s3_key  # Already archived
+        except s3_client.exceptions.ClientError:
+            pass
+
+    start_time = time.time()
+    db_image = db_cropped_image.image
+    source_s3_key = ingest.get_source_s3_key(db_image)
+    with RasterSource(f's3://{BUCKET_NAME}/{source_s3_key}') as src:
+        ring = geo.reproject_rings([db_cropped_image.polygon.coordinates], geo.POLYGON_CRS, src.crs)[0]
+        polygon_window = get_polygon_window(ring, src)
+        if polygon_window is None:
+            raise HTTPException(status_code=404, detail="Polygon does not overlap the image")
+        intersected_polygon, window = polygon_window
+
+        scale_factor = get_crop_scale_factor(window.width, window.height, src, "full")
+        footprint = estimate_crop_footprint(
+            int(window.width * scale_factor), int(window.height * scale_factor), src.count, np.dtype(src.dtype).itemsize
+        )
+        if footprint > CROP_STREAM_THRESHOLD_MB * 2**20:
+            full_s3_key = get_full_resolution_s3_key(db_cropped_image.s3_key, ".tif")
+            archive_streamed_crop(src, window, intersected_polygon, full_s3_key)
+            print(f"Full-resolution crop {full_s3_key} archived in {time.time() - start_time:.2f} seconds.")
+            return full_s3_key
+
+        task = CropTask(0, db_cropped_image.polygon_id, ring, db_image.id, db_image.filename, db_image.original_s3_key)
+        read_polygon_window(task, src, mode="full")
+
+    full_s3_key = get_full_resolution_s3_key(db_cropped_image.s3_key, ".jpg")
+    try:
+        frame = ImageFrame(image=draw_crop_outline(task.out_image, task.out_transform, ring))
+        frame.encode('JPEG', **CROPPED_IMAGE_OPTIONS)
+        frame.release_pixels()
+        task.out_image = None
+    finally:
+        release_crop_memory(task)
+    s3_client.put_object(
+        Bucket=BUCKET_NAME,
+        Key=full_s3_key,
+        Body=frame.encode('JPEG', **CROPPED_IMAGE_OPTIONS),
+        ContentType='image/jpeg'
+    )
+    print(f"Full-resolution crop {full_s3_key} archived in {time.time() - start_time:.2f} seconds.")
+    return full_s3_key
+
+
+def archive_streamed_crop(src: RasterSource, window, geometry, full_s3_key: str):
+    # Mask the window tile by tile into a temporary GeoTIFF, then upload it as a COG
+    tile_height, tile_width = src.tile_shape()
+    tile_footprint = estimate_crop_footprint(tile_width, tile_height, src.count, np.dtype(src.dtype).itemsize)
+    reservation = raster_memory_budget.acquire(tile_footprint, owner=full_s3_key, label=f"streamed crop {full_s3_key}")
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            masked_path = os.path.join(tmpdir, "masked.tif")
+            cog_path = os.path.join(tmpdir, "masked_cog.tif")
+            src.stream_masked_window(window, geometry, masked_path)
+            # The COG driver builds overviews and copies block by block, so memory stays flat here too
+            rasterio.shutil.copy(masked_path, cog_path, driver="COG", **ingest.cog_creation_options())
+            s3_client.upload_file(cog_path, BUCKET_NAME, full_s3_key, ExtraArgs={'ContentType': 'image/tiff'})
+    finally:
+        raster_memory_budget.release(reservation)
+
+
 # -------------------------------- Annotate Drone Map --------------------------------
-def draw_polygons_on_image(image, polygons: list, dataset) -> str:
+def draw_polygons_on_image(image, polygon_rings: list, dataset) -> str:
     try:
         print("Starting to draw polygons on the image...")
         start_time = time.time()
@@ -921,10 +1235,10 @@ def draw_polygons_on_image(image, polygons: list, dataset) -> str:
         # Calculate the out_shape
         out_shape = (dataset.count, int(dataset.height * scale), int(dataset.width * scale))
         
-        # Read the data
+        # Read the data from the overview closest to the preview size
         print("Reading dataset at reduced resolution for drawing...")
         read_start_time = time.time()
-        data = dataset.read(out_shape=out_shape)
+        data = dataset.read_resampled(out_shape)
         read_end_time = time.time()
         print(f"Dataset read in {read_end_time - read_start_time:.2f} seconds.")
         
@@ -942,28 +1256,19 @@ def draw_polygons_on_image(image, polygons: list, dataset) -> str:
         # Create a mask to draw polygons on (with alpha channel for transparency)
         mask = np.zeros((image_np.shape[0], image_np.shape[1], 4), dtype=np.uint8)
         
-        for idx, polygon in enumerate(polygons):
-            print(f"Drawing polygon {idx} on image...")
-            shape_geom = to_shape(polygon.coordinates)
-            coordinates = mapping(shape_geom)["coordinates"][0]
-            
-            # Transform geographic coordinates to pixel coordinates
-            # Need to transform coordinates to dataset CRS
-            raster_crs = dataset.crs
-            coord_crs = pyproj.CRS('EPSG:4326')
-            transformer = Transformer.from_crs(coord_crs, raster_crs, always_xy=True)
-            transformed_coords = [transformer.transform(x, y) for x, y in coordinates]
-            
-            # Now map the transformed coordinates to pixel coordinates
-            pixel_coords = [
-                (
-                    int((x - left) * x_scale),
-                    int((top - y) * y_scale)
-                ) for x, y in transformed_coords
-            ]
-            
-            # Draw filled polygon on the mask with translucency
-            cv2.fillPoly(mask, [np.array(pixel_coords, dtype=np.int32)], color=(255, 0, 0, 128))  # 128 is the alpha value for 50% opacity
+        # Map every ring (already in the raster CRS) to pixel coordinates in one vectorized step
+        if polygon_rings:
+            coords = np.concatenate(polygon_rings)
+            pixel_coords = np.column_stack((
+                (coords[:, 0] - left) * x_scale,
+                (top - coords[:, 1]) * y_scale,
+            )).astype(np.int32)
+            offsets = np.cumsum([len(ring) for ring in polygon_rings])[:-1]
+
+            # Draw filled polygons on the mask with translucency
+            print(f"Drawing {len(polygon_rings)} polygons on image...")
+            for ring_pixel_coords in np.split(pixel_coords, offsets):
+                cv2.fillPoly(mask, [ring_pixel_coords], color=(255, 0, 0, 128))  # 128 is the alpha value for 50% opacity
         
         # Convert mask to PIL Image
         mask_pil = Image.fromarray(mask, 'RGBA')
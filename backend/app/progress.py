@@ -0,0 +1,161 @@
+# app/progress.py
+import os
+import queue
+import asyncio
+import threading
+import time
+
+from dotenv import load_dotenv
+from fastapi.concurrency import run_in_threadpool
+
+from app import crud
+from app.db import SessionLocal
+from app.websockets import manager
+
+load_dotenv()
+
+# A progress update is published once it moved by at least this many points, or this long after the last one
+PROGRESS_MIN_DELTA = int(os.getenv("PROGRESS_MIN_DELTA", "5"))
+PROGRESS_MIN_INTERVAL_SECONDS = float(os.getenv("PROGRESS_MIN_INTERVAL_SECONDS", "1"))
+# How often the API relays statuses written by worker processes to connected websockets
+PROGRESS_RELAY_SECONDS = float(os.getenv("PROGRESS_RELAY_SECONDS", "1"))
+
+# Statuses that are always published immediately
+STATUS_FAILED = -1
+STATUS_DONE = 100
+
+
+# -------------------------------- Progress tracker --------------------------------
+class ProgressTracker:
+    """
+    In-process record of the processing status of running jobs.
+
+    Jobs report every step through update(), which is cheap: the status is kept
+    in memory and only published when it moved by PROGRESS_MIN_DELTA points or
+    PROGRESS_MIN_INTERVAL_SECONDS passed since the last publish (start, finish
+    and failure are always published). Published statuses go through a single
+    queue to one dispatcher thread, which coalesces them per image and hands the
+    latest to every sink (the database status and the websocket).
+    """
+
+    def __init__(self, min_delta: int = PROGRESS_MIN_DELTA, min_interval: float = PROGRESS_MIN_INTERVAL_SECONDS):
+        self.min_delta = min_delta
+        self.min_interval = min_interval
+        self.sinks = []
+        self._statuses = {}  # image_id -> latest status, while the job is running or not yet persisted
+        self._published = {}  # image_id -> (status, time) of the last publish
+        self._lock = threading.Lock()
+        self._channel = queue.Queue()
+        self._dispatcher = None
+
+    def subscribe(self, sink):
+        # sink(image_id, status) is called on the dispatcher thread
+        self.sinks.append(sink)
+
+    def update(self, image_id: int, status: int, force: bool = False):
+        now = time.time()
+        with self._lock:
+            self._statuses[image_id] = status
+            last_status, last_time = self._published.get(image_id, (None, 0.0))
+            if status == last_status:
+                return
+            publish = (
+                force
+                or last_status is None
+                or status in (0, STATUS_DONE, STATUS_FAILED)
+                or abs(status - last_status) >= self.min_delta
+                or now - last_time >= self.min_interval
+            )
+            if not publish:
+                return
+            self._published[image_id] = (status, now)
+            self._ensure_dispatcher()
+        self._channel.put(image_id)
+
+    # ------------------- Dispatcher -------------------
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None or not self._dispatcher.is_alive():
+            self._dispatcher = threading.Thread(target=self._dispatch, name="progress-dispatcher", daemon=True)
+            self._dispatcher.start()
+
+    def _dispatch(self):
+        while True:
+            image_ids = {self._channel.get()}
+            # Coalesce everything queued meanwhile: only the latest status per image is sent
+            while True:
+                try:
+                    image_ids.add(self._channel.get_nowait())
+                except queue.Empty:
+                    break
+
+            for image_id in image_ids:
+                with self._lock:
+                    status = self._published.get(image_id, (None, 0.0))[0]
+                if status is None:
+                    continue
+                for sink in self.sinks:
+                    try:
+                        sink(image_id, status)
+                    except Exception as e:
+                        print(f"Error occurred while publishing progress {status}% for image {image_id}: {e}")
+
+                if status in (STATUS_DONE, STATUS_FAILED):
+                    # Persisted, so readers can go back to the database
+                    with self._lock:
+                        if self._statuses.get(image_id) == status:
+                            self._statuses.pop(image_id, None)
+                            self._published.pop(image_id, None)
+
+
+# -------------------------------- Sinks --------------------------------
+def save_status(image_id: int, status: int):
+    db = SessionLocal()
+    try:
+        crud.update_processing_status(db, image_id, status)
+    finally:
+        db.close()
+
+
+def send_status(image_id: int, status: int):
+    manager.send_progress_sync(image_id, status)
+
+
+def read_statuses(image_ids: list) -> dict:
+    db = SessionLocal()
+    try:
+        return crud.get_processing_statuses(db, image_ids)
+    finally:
+        db.close()
+
+
+# -------------------------------- Websocket relay --------------------------------
+async def relay_progress_from_db(interval: float = PROGRESS_RELAY_SECONDS):
+    """
+    Forward statuses of images with open websockets from the database.
+
+    Jobs run in worker processes, whose trackers cannot reach this process's
+    websockets, so the API polls the statuses they persist (one query for all
+    connected images) and sends the ones that changed.
+    """
+    last_sent = {}
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            image_ids = list(manager.active_connections.keys())
+            if not image_ids:
+                last_sent.clear()
+                continue
+            statuses = await run_in_threadpool(read_statuses, image_ids)
+            for image_id, status in statuses.items():
+                if last_sent.get(image_id) != status:
+                    last_sent[image_id] = status
+                    await manager.send_progress(image_id, status)
+            for image_id in set(last_sent) - set(image_ids):
+                del last_sent[image_id]
+        except Exception as e:
+            print(f"Error occurred while relaying progress: {e}")
+
+
+progress_tracker = ProgressTracker()
+progress_tracker.subscribe(save_status)
+progress_tracker.subscribe(send_status)
@@ -0,0 +1,411 @@
+# app/raster.py
+import os
+import threading
+import time
+
+import math
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling, Interleaving
+from rasterio.features import rasterize
+from rasterio.session import AWSSession
+from rasterio.windows import Window, transform as window_transform
+from dotenv import load_dotenv
+
+from app.geo import POLYGON_CRS, get_transformer
+from app.raster_cache import raster_cache, RASTER_CACHE_MMAP, MMAP_ENV_OPTIONS
+
+# -------------------------------- Connection to AWS - Access Keys Version --------------------------------
+load_dotenv()  # Load environment variables from .env file
+
+AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
+AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+AWS_REGION = os.getenv("AWS_REGION")
+
+# Tile size used to stream windows of rasters that are stored in strips rather than tiles
+STREAM_TILE_SIZE = int(os.getenv("STREAM_TILE_SIZE", "512"))
+
+# -------------------------------- GDAL I/O profiles --------------------------------
+# Named GDAL configurations for reading source GeoTIFFs from S3. Every read of a
+# RasterSource goes through the selected profile, so tuning happens in one place.
+IO_PROFILES = {
+    # The options the pipeline used before profiles existed, kept for comparison
+    "legacy": {
+        "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+        "CPL_VSIL_CURL_USE_HEAD": "NO",
+        "VSI_CACHE": "TRUE",
+        "GDAL_CACHEMAX": 512,
+    },
+    # COGs on S3: fewer, larger and concurrent range requests, and blocks decoded in parallel
+    "remote": {
+        "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+        "CPL_VSIL_CURL_USE_HEAD": "NO",
+        "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.tiff,.TIF,.TIFF",
+        "VSI_CACHE": "TRUE",
+        "VSI_CACHE_SIZE": 64 * 1024 * 1024,
+        "GDAL_HTTP_VERSION": "2",
+        "GDAL_HTTP_MULTIPLEX": "YES",
+        "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+        "GDAL_NUM_THREADS": "ALL_CPUS",
+        "GDAL_CACHEMAX": 1024,
+        "GDAL_HTTP_TIMEOUT": 30,
+        "GDAL_HTTP_CONNECTTIMEOUT": 10,
+        "GDAL_HTTP_MAX_RETRY": 3,
+        "GDAL_HTTP_RETRY_DELAY": 1,
+    },
+    # Same request pattern with small caches, for workers sharing a host with other processes
+    "low_memory": {
+        "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+        "CPL_VSIL_CURL_USE_HEAD": "NO",
+        "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.tiff,.TIF,.TIFF",
+        "VSI_CACHE": "TRUE",
+        "VSI_CACHE_SIZE": 16 * 1024 * 1024,
+        "GDAL_HTTP_VERSION": "2",
+        "GDAL_HTTP_MULTIPLEX": "YES",
+        "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+        "GDAL_NUM_THREADS": 2,
+        "GDAL_CACHEMAX": 128,
+        "GDAL_HTTP_TIMEOUT": 30,
+        "GDAL_HTTP_CONNECTTIMEOUT": 10,
+        "GDAL_HTTP_MAX_RETRY": 3,
+        "GDAL_HTTP_RETRY_DELAY": 1,
+    },
+}
+
+RASTER_IO_PROFILE = os.getenv("RASTER_IO_PROFILE", "remote")
+
+# Individual settings that override the selected profile when set
+IO_PROFILE_OVERRIDES = {
+    "VSI_CACHE_SIZE": os.getenv("RASTER_IO_VSI_CACHE_SIZE_MB"),
+    "GDAL_CACHEMAX": os.getenv("RASTER_IO_BLOCK_CACHE_MB"),
+    "GDAL_NUM_THREADS": os.getenv("RASTER_IO_NUM_THREADS"),
+    "GDAL_HTTP_TIMEOUT": os.getenv("RASTER_IO_HTTP_TIMEOUT_SECONDS"),
+    "GDAL_HTTP_MAX_RETRY": os.getenv("RASTER_IO_HTTP_MAX_RETRY"),
+}
+
+
+def get_gdal_env_options(profile: str = None) -> dict:
+    """
+    Build the GDAL options of an I/O profile, with the RASTER_IO_* overrides applied.
+
+    Args:
+        profile (str): Name of a profile in IO_PROFILES. Defaults to RASTER_IO_PROFILE.
+
+    Returns:
+        dict: Options to pass to rasterio.Env.
+    """
+    profile = profile or RASTER_IO_PROFILE
+    if profile not in IO_PROFILES:
+        raise ValueError(f"Unknown raster I/O profile '{profile}', expected one of {sorted(IO_PROFILES)}")
+
+    options = dict(IO_PROFILES[profile])
+    for key, value in IO_PROFILE_OVERRIDES.items():
+        if value in (None, ""):
+            continue
+        if key == "VSI_CACHE_SIZE":
+            value = int(float(value) * 1024 * 1024)
+        options[key] = value
+    return options
+
+
+def get_aws_session() -> AWSSession:
+    # Credentials are handed to GDAL through the session, so they never need to be written to os.environ
+    return AWSSession(
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        region_name=AWS_REGION,
+    )
+
+
+# -------------------------------- Raster source --------------------------------
+class RasterSource:
+    """
+    A source GeoTIFF opened once for a whole processing job.
+
+    The dataset header is fetched a single time and every read goes through the
+    same GDAL handle, so the block cache stays warm across polygon crops. The
+    handle exposes the dataset attributes used by the pipeline (crs, transform,
+    bounds, ...) and can be shared between threads: reads are serialised with a
+    lock because a GDAL dataset handle is not thread-safe.
+
+    When the local raster cache is enabled, S3 sources are read from their
+    cached copy instead; path always stays the S3 path.
+    """
+
+    def __init__(self, path: str, profile: str = None):
+        self.path = path
+        self.profile = profile or RASTER_IO_PROFILE
+        self.env_options = get_gdal_env_options(self.profile)
+        self.session = get_aws_session()
+        self.read_path = path  # The local cached copy once opened, if there is one
+        self.dataset = None
+        self.overview_datasets = {}  # Overview level -> dataset handle, opened on first use
+        self.to_raster_transformer = None
+        self._env = None
+        self._lock = threading.RLock()
+
+    def open(self) -> "RasterSource":
+        start_time = time.time()
+        local_path = raster_cache.local_path(self.path)
+        if local_path is not None:
+            self.read_path = local_path
+            if RASTER_CACHE_MMAP:
+                self.env_options = {**self.env_options, **MMAP_ENV_OPTIONS}
+
+        self._env = rasterio.Env(session=self.session, **self.env_options)
+        self._env.__enter__()
+        try:
+            self.dataset = rasterio.open(self.read_path)
+        except Exception:
+            self._env.__exit__(None, None, None)
+            self._env = None
+            raise
+
+        # Transformer from polygon coordinates to the raster CRS, shared by all crops in the job
+        self.to_raster_transformer = get_transformer(POLYGON_CRS, self.dataset.crs)
+        source = "local cache" if self.read_path != self.path else f"I/O profile '{self.profile}'"
+        print(f"Raster source {self.path} opened from {source} in {time.time() - start_time:.2f} seconds.")
+        return self
+
+    def close(self):
+        with self._lock:
+            for overview_dataset in self.overview_datasets.values():
+                overview_dataset.close()
+            self.overview_datasets = {}
+            if self.dataset is not None:
+                self.dataset.close()
+                self.dataset = None
+        if self._env is not None:
+            self._env.__exit__(None, None, None)
+            self._env = None
+
+    def __enter__(self) -> "RasterSource":
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # ------------------- Dataset attributes -------------------
+    @property
+    def crs(self):
+        return self.dataset.crs
+
+    @property
+    def transform(self):
+        return self.dataset.transform
+
+    @property
+    def bounds(self):
+        return self.dataset.bounds
+
+    @property
+    def width(self) -> int:
+        return self.dataset.width
+
+    @property
+    def height(self) -> int:
+        return self.dataset.height
+
+    @property
+    def count(self) -> int:
+        return self.dataset.count
+
+    @property
+    def dtype(self) -> str:
+        return self.dataset.dtypes[0]
+
+    def window_transform(self, window):
+        return window_transform(window, self.dataset.transform)
+
+    # ------------------- Reads -------------------
+    def read(self, *args, **kwargs):
+        # GDAL configuration is thread-local, so re-enter the job environment on the calling thread
+        with self._lock, rasterio.Env(session=self.session, **self.env_options):
+            return self.dataset.read(*args, **kwargs)
+
+    def select_overview_level(self, window_width: float, window_height: float, out_width: int, out_height: int):
+        """
+        Pick the coarsest overview that still has at least the requested resolution.
+
+        Returns (level, factor), where level is None for the full-resolution image
+        and otherwise an index into the dataset's overview list.
+        """
+        decimation = min(window_width / max(out_width, 1), window_height / max(out_height, 1))
+        level, factor = None, 1
+        for overview_level, overview_factor in enumerate(self.dataset.overviews(1)):
+            if overview_factor <= decimation:
+                level, factor = overview_level, overview_factor
+        return level, factor
+
+    def read_resampled(self, out_shape, window=None, resampling=Resampling.nearest):
+        """
+        Read a window (or the whole raster) into out_shape, starting from the best overview.
+
+        Decimated reads on the full-resolution image make GDAL touch every source
+        block in the window; reading from an overview keeps the cost proportional
+        to the output size instead of the source size.
+        """
+        if window is None:
+            window = Window(0, 0, self.width, self.height)
+        out_height, out_width = out_shape[-2], out_shape[-1]
+        level, factor = self.select_overview_level(window.width, window.height, out_width, out_height)
+
+        with self._lock, rasterio.Env(session=self.session, **self.env_options):
+            if level is None:
+                return self.dataset.read(window=window, out_shape=out_shape, resampling=resampling)
+
+            overview_dataset = self.level_dataset(level)
+            overview_window = self.level_window(window, level)
+            print(f"Reading from overview level {level} (factor {factor}) for output {out_width}x{out_height}")
+            return overview_dataset.read(window=overview_window, out_shape=out_shape, resampling=resampling)
+
+    # ------------------- Levels and blocks -------------------
+    def level_dataset(self, level):
+        # Dataset handle of an overview level (None for full resolution), opened on first use
+        if level is None:
+            return self.dataset
+        with self._lock:
+            overview_dataset = self.overview_datasets.get(level)
+            if overview_dataset is None:
+                with rasterio.Env(session=self.session, **self.env_options):
+                    overview_dataset = rasterio.open(self.read_path, overview_level=level)
+                self.overview_datasets[level] = overview_dataset
+            return overview_dataset
+
+    def level_window(self, window, level) -> Window:
+        # Full-resolution window in the pixel space of an overview level
+        if level is None:
+            return window
+        overview_dataset = self.level_dataset(level)
+        # Overview sizes are rounded, so scale the window by the actual size ratio
+        scale_x = overview_dataset.width / self.width
+        scale_y = overview_dataset.height / self.height
+        return Window(
+            window.col_off * scale_x,
+            window.row_off * scale_y,
+            window.width * scale_x,
+            window.height * scale_y,
+        )
+
+    def block_shape(self, level=None) -> tuple:
+        # (height, width) of the internal blocks of a level
+        return self.level_dataset(level).block_shapes[0]
+
+    def block_window(self, level, block_row: int, block_col: int) -> Window:
+        # Pixel window of a block in its level, clipped at the right and bottom edges
+        dataset = self.level_dataset(level)
+        block_height, block_width = self.block_shape(level)
+        col_off, row_off = block_col * block_width, block_row * block_height
+        return Window(col_off, row_off, min(block_width, dataset.width - col_off), min(block_height, dataset.height - row_off))
+
+    def read_block(self, level, block_row: int, block_col: int) -> np.ndarray:
+        # Read and decode exactly one internal block of a level
+        with self._lock, rasterio.Env(session=self.session, **self.env_options):
+            return self.level_dataset(level).read(window=self.block_window(level, block_row, block_col))
+
+    def block_nbytes(self, level, block_row: int, block_col: int) -> int:
+        """
+        Bytes a block takes in the file, i.e. what fetching it transfers.
+
+        Uses the TIFF block size GDAL exposes for (Cloud-Optimized) GeoTIFFs and
+        falls back to the decoded size for other formats.
+        """
+        dataset = self.level_dataset(level)
+        # Pixel-interleaved blocks hold every band; band-interleaved files have one block per band
+        bands = range(1, dataset.count + 1) if dataset.interleaving == Interleaving.band else (1,)
+        with self._lock, rasterio.Env(session=self.session, **self.env_options):
+            sizes = [dataset.get_tag_item(f"BLOCK_SIZE_{block_col}_{block_row}", "TIFF", bidx=band) for band in bands]
+        if all(sizes):
+            return sum(int(size) for size in sizes)
+        window = self.block_window(level, block_row, block_col)
+        return int(window.width * window.height * dataset.count * np.dtype(dataset.dtypes[0]).itemsize)
+
+    # ------------------- Streaming -------------------
+    def pixel_window(self, window) -> Window:
+        # Whole-pixel window covering window, clipped to the raster
+        col_off = max(0, math.floor(window.col_off))
+        row_off = max(0, math.floor(window.row_off))
+        col_end = min(self.width, math.ceil(window.col_off + window.width))
+        row_end = min(self.height, math.ceil(window.row_off + window.height))
+        return Window(col_off, row_off, max(0, col_end - col_off), max(0, row_end - row_off))
+
+    def tile_shape(self) -> tuple:
+        # Internal block shape, or STREAM_TILE_SIZE square tiles for striped rasters
+        block_height, block_width = self.dataset.block_shapes[0]
+        if block_width >= self.width and block_height < STREAM_TILE_SIZE:
+            return STREAM_TILE_SIZE, STREAM_TILE_SIZE
+        return block_height, block_width
+
+    def iter_tiles(self, window):
+        """
+        Walk a window in tiles aligned to the raster's block grid.
+
+        Every tile covers (part of) exactly one internal block, so each block is
+        fetched and decoded once however the window is positioned.
+        """
+        window = self.pixel_window(window)
+        tile_height, tile_width = self.tile_shape()
+        first_row = (window.row_off // tile_height) * tile_height
+        first_col = (window.col_off // tile_width) * tile_width
+        for row in range(first_row, window.row_off + window.height, tile_height):
+            row_off = max(row, window.row_off)
+            row_end = min(row + tile_height, window.row_off + window.height)
+            for col in range(first_col, window.col_off + window.width, tile_width):
+                col_off = max(col, window.col_off)
+                col_end = min(col + tile_width, window.col_off + window.width)
+                yield Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+    def stream_masked_window(self, window, geometry, dst_path: str, **creation_options) -> dict:
+        """
+        Write the pixels of window inside geometry to a tiled GeoTIFF, one tile at a time.
+
+        Only one source tile and its mask are in memory at once, so memory stays
+        flat however large the window is. Tiles outside the geometry are neither
+        read nor written (they read back as 0).
+
+        Returns:
+            dict: Stats of the run (tiles, tiles_read, width, height).
+        """
+        start_time = time.time()
+        window = self.pixel_window(window)
+        profile = {
+            "driver": "GTiff",
+            "width": window.width,
+            "height": window.height,
+            "count": self.count,
+            "dtype": self.dtype,
+            "crs": self.crs,
+            "transform": self.window_transform(window),
+            "tiled": True,
+            "blockxsize": 512,
+            "blockysize": 512,
+            "compress": "DEFLATE",
+            "BIGTIFF": "IF_SAFER",
+            "SPARSE_OK": True,
+        }
+        profile.update(creation_options)
+
+        tiles = tiles_read = 0
+        with rasterio.open(dst_path, "w", **profile) as dst:
+            for tile in self.iter_tiles(window):
+                tiles += 1
+                mask = rasterize(
+                    [(geometry, 1)],
+                    out_shape=(tile.height, tile.width),
+                    transform=self.window_transform(tile),
+                    fill=0,
+                    dtype="uint8",
+                )
+                if not mask.any():
+                    continue
+                tiles_read += 1
+                data = self.read(window=tile)
+                data *= mask[np.newaxis, :, :].astype(data.dtype, copy=False)
+                dst.write(data, window=Window(tile.col_off - window.col_off, tile.row_off - window.row_off, tile.width, tile.height))
+
+        print(
+            f"Streamed a {window.width}x{window.height} masked window in {tiles_read}/{tiles} tiles "
+            f"in {time.time() - start_time:.2f} seconds."
+        )
+        return {"tiles": tiles, "tiles_read": tiles_read, "width": window.width, "height": window.height}
@@ -0,0 +1,295 @@
+# app/raster_cache.py
+import os
+import json
+import time
+import fcntl
+import hashlib
+import threading
+from contextlib import contextmanager
+
+import boto3
+from botocore.client import Config
+from botocore.exceptions import ClientError, BotoCoreError
+from dotenv import load_dotenv
+
+# -------------------------------- Connection to AWS - Access Keys Version --------------------------------
+load_dotenv()  # Load environment variables from .env file
+
+AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
+AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+AWS_REGION = os.getenv("AWS_REGION")
+
+s3_client = boto3.client(
+    's3',
+    aws_access_key_id=AWS_ACCESS_KEY_ID,
+    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+    region_name=AWS_REGION,
+    config=Config(signature_version='s3v4'),
+)
+
+# Directory source rasters are downloaded to; the cache is disabled when empty
+RASTER_CACHE_DIR = os.getenv("RASTER_CACHE_DIR", "")
+RASTER_CACHE_MAX_GB = float(os.getenv("RASTER_CACHE_MAX_GB", "20"))
+# Let GDAL memory-map cached files instead of reading them through its block cache
+RASTER_CACHE_MMAP = os.getenv("RASTER_CACHE_MMAP", "true").lower() in ("1", "true", "yes")
+
+# GDAL options added when a raster is read from the cache. Virtual memory I/O only
+# applies to uncompressed GeoTIFFs; GDAL ignores it for compressed ones such as our COGs.
+MMAP_ENV_OPTIONS = {"GTIFF_VIRTUAL_MEM_IO": "IF_ENOUGH_RAM"}
+
+_DATA_SUFFIX = ".tif"
+_META_SUFFIX = ".json"
+_LOCK_SUFFIX = ".lock"
+_RESERVED_SUFFIX = ".reserved"
+
+
+def parse_s3_path(path: str):
+    # 's3://bucket/key' -> ('bucket', 'key'), anything else -> None
+    if not path.startswith("s3://"):
+        return None
+    bucket, _, key = path[len("s3://"):].partition("/")
+    return (bucket, key) if bucket and key else None
+
+
+# -------------------------------- Raster cache --------------------------------
+class RasterCache:
+    """
+    Local copies of source rasters, shared by every process using the same directory.
+
+    A raster is downloaded whole the first time it is opened and read from disk
+    afterwards, as long as its S3 ETag has not changed. Entries are evicted least
+    recently used first to stay under the disk quota. Downloads and evictions are
+    serialised across processes with file locks, and files are only ever replaced
+    atomically, so a reader never sees a partial download. Space for a download
+    is reserved before it starts, so concurrent downloads stay under the quota
+    together. Evicting a file that is still open is safe: the open handle keeps
+    reading the unlinked file.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory) and self.max_bytes > 0
+
+    # ------------------- Internal -------------------
+    def _entry_path(self, bucket: str, key: str) -> str:
+        digest = hashlib.sha1(f"{bucket}/{key}".encode()).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    @contextmanager
+    def _file_lock(self, path: str, blocking: bool = True):
+        # Yields whether the lock was taken (always True when blocking). Entry lock
+        # files are removed on eviction, so a lock taken on a file that was unlinked
+        # or replaced in the meantime is retried on the current one.
+        while True:
+            with open(path, "a") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    yield False
+                    return
+                try:
+                    current = os.path.samestat(os.fstat(lock_file.fileno()), os.stat(path))
+                except FileNotFoundError:
+                    current = False
+                if not current:
+                    continue
+                try:
+                    yield True
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                return
+
+    def _read_meta(self, entry: str):
+        try:
+            with open(entry + _META_SUFFIX) as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+        return meta if os.path.exists(entry + _DATA_SUFFIX) else None
+
+    def _touch(self, entry: str):
+        # The metadata file's mtime records the last use, for LRU eviction
+        try:
+            os.utime(entry + _META_SUFFIX)
+        except OSError:
+            pass
+
+    def _entries(self) -> list:
+        # (last_used, size, entry) of every complete entry in the directory
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(_META_SUFFIX):
+                continue
+            entry = os.path.join(self.directory, name[:-len(_META_SUFFIX)])
+            try:
+                last_used = os.path.getmtime(entry + _META_SUFFIX)
+                size = os.path.getsize(entry + _DATA_SUFFIX)
+            except OSError:
+                continue
+            entries.append((last_used, size, entry))
+        return entries
+
+    def _reserved(self, keep: str) -> int:
+        # Bytes reserved by downloads in flight. Called under the directory lock; a
+        # reservation whose entry lock is free was left by a process that died.
+        reserved = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(_RESERVED_SUFFIX):
+                continue
+            entry = os.path.join(self.directory, name[:-len(_RESERVED_SUFFIX)])
+            if entry == keep:
+                continue
+            with self._file_lock(entry + _LOCK_SUFFIX, blocking=False) as locked:
+                if locked:
+                    self._remove(entry, (_RESERVED_SUFFIX, _LOCK_SUFFIX))
+                    continue
+            try:
+                with open(entry + _RESERVED_SUFFIX) as reserved_file:
+                    reserved += int(reserved_file.read() or 0)
+            except (OSError, ValueError):
+                continue
+        return reserved
+
+    def _remove(self, entry: str, suffixes: tuple = (_META_SUFFIX, _DATA_SUFFIX)):
+        for suffix in suffixes:
+            try:
+                os.remove(entry + suffix)
+            except FileNotFoundError:
+                pass
+
+    def _evict_to_fit(self, incoming_bytes: int, keep: str) -> bool:
+        # Whether the incoming bytes fit once evictable entries are gone
+        entries = self._entries()
+        used = sum(size for _, size, entry in entries if entry != keep) + self._reserved(keep)
+        for last_used, size, entry in sorted(entries):
+            if used + incoming_bytes <= self.max_bytes:
+                break
+            if entry == keep:
+                continue
+            # Entries another process is checking or downloading are skipped. The lock
+            # file goes with the entry, removed while held so waiters retry on a new one.
+            with self._file_lock(entry + _LOCK_SUFFIX, blocking=False) as locked:
+                if not locked:
+                    continue
+                self._remove(entry, (_META_SUFFIX, _DATA_SUFFIX, _LOCK_SUFFIX))
+            used -= size
+            with self._lock:
+                self.evictions += 1
+            print(f"Raster cache evicted {os.path.basename(entry)} ({size / 2**20:.1f} MB)")
+        return used + incoming_bytes <= self.max_bytes
+
+    def _download(self, bucket: str, key: str, etag: str, entry: str):
+        start_time = time.time()
+        tmp_path = f"{entry}.{os.getpid()}.{threading.get_ident()}.part"
+        try:
+            # IfMatch makes S3 refuse the download if the object changed after the HEAD
+            s3_client.download_file(bucket, key, tmp_path, ExtraArgs={"IfMatch": etag})
+            os.replace(tmp_path, entry + _DATA_SUFFIX)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with open(entry + _META_SUFFIX, "w") as meta_file:
+            json.dump({"bucket": bucket, "key": key, "etag": etag}, meta_file)
+        print(f"Raster cache downloaded s3://{bucket}/{key} in {time.time() - start_time:.2f} seconds.")
+
+    # ------------------- Public -------------------
+    def local_path(self, path: str):
+        """
+        Get a local copy of an S3 raster, downloading it if it is missing or stale.
+
+        Returns:
+            str | None: Path of the cached file, or None if the raster should be
+            read from S3 directly (cache disabled, raster larger than the quota,
+            or the download failed).
+        """
+        parsed = parse_s3_path(path)
+        if not self.enabled or parsed is None:
+            return None
+        bucket, key = parsed
+        os.makedirs(self.directory, exist_ok=True)
+        entry = self._entry_path(bucket, key)
+
+        try:
+            head = s3_client.head_object(Bucket=bucket, Key=key)
+        except (ClientError, BotoCoreError) as e:
+            # Without S3 there is nothing to compare against, so fall back to reading remotely
+            print(f"Raster cache could not check {path}: {e}")
+            with self._lock:
+                self.bypassed += 1
+            return None
+        etag, size = head["ETag"], head["ContentLength"]
+
+        try:
+            with self._file_lock(entry + _LOCK_SUFFIX):
+                meta = self._read_meta(entry)
+                if meta is not None and meta.get("etag") == etag:
+                    self._touch(entry)
+                    with self._lock:
+                        self.hits += 1
+                    print(f"Raster cache hit for {path}")
+                    return entry + _DATA_SUFFIX
+
+                if size > self.max_bytes:
+                    with self._lock:
+                        self.bypassed += 1
+                    print(f"Raster {path} ({size / 2**20:.1f} MB) is larger than the cache quota, reading from S3")
+                    return None
+
+                with self._file_lock(os.path.join(self.directory, _LOCK_SUFFIX)):
+                    self._remove(entry)  # Stale copy, if any
+                    if not self._evict_to_fit(size, keep=entry):
+                        with self._lock:
+                            self.bypassed += 1
+                        print(f"Raster cache is full with downloads in flight, reading {path} from S3")
+                        return None
+                    # Counted by other processes' evictions until the download is in place
+                    with open(entry + _RESERVED_SUFFIX, "w") as reserved_file:
+                        reserved_file.write(str(size))
+                try:
+                    self._download(bucket, key, etag, entry)
+                finally:
+                    self._remove(entry, (_RESERVED_SUFFIX,))
+                with self._lock:
+                    self.misses += 1
+                return entry + _DATA_SUFFIX
+        except (OSError, ClientError, BotoCoreError) as e:
+            print(f"Raster cache failed for {path}, reading from S3: {e}")
+            with self._lock:
+                self.bypassed += 1
+            return None
+
+    def evict(self, path: str):
+        # Drop the cached copy of an S3 raster, e.g. when the image is deleted
+        parsed = parse_s3_path(path)
+        if not self.enabled or parsed is None or not os.path.isdir(self.directory):
+            return
+        entry = self._entry_path(*parsed)
+        # Removed while held, so processes waiting on the lock file retry on a new one
+        with self._file_lock(entry + _LOCK_SUFFIX):
+            self._remove(entry, (_META_SUFFIX, _DATA_SUFFIX, _LOCK_SUFFIX))
+
+    def metrics(self) -> dict:
+        entries = self._entries() if self.enabled and os.path.isdir(self.directory) else []
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "entries": len(entries),
+                "used_bytes": sum(size for _, size, _ in entries),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "evictions": self.evictions,
+            }
+
+
+raster_cache = RasterCache(RASTER_CACHE_DIR, int(RASTER_CACHE_MAX_GB * 2**30))
@@ -0,0 +1,267 @@
+# app/read_planner.py
+import os
+import math
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.warp import reproject
+from rasterio.windows import Window
+from dotenv import load_dotenv
+
+from app.raster import RasterSource
+
+load_dotenv()
+
+# Group the reads of a job by internal block so each block is fetched and decoded once
+READ_PLANNER_ENABLED = os.getenv("READ_PLANNER_ENABLED", "true").lower() in ("1", "true", "yes")
+# Decoded blocks kept for reads still to come; beyond this the least recently used are dropped (and refetched if needed)
+READ_PLANNER_CACHE_MB = int(os.getenv("READ_PLANNER_CACHE_MB", "256"))
+
+
+# -------------------------------- Planned read --------------------------------
+class PlannedRead:
+    """One window to be read at out_shape, and the blocks of its level it touches."""
+
+    def __init__(self, key, window: Window, out_shape: tuple, level, level_window: Window, blocks: list):
+        self.key = key
+        self.window = window
+        self.out_shape = out_shape
+        self.level = level
+        self.level_window = level_window  # Whole-pixel window in the level, covering the read
+        self.blocks = blocks  # (level, block_row, block_col) in row-major order
+        self.done = False
+
+
+# -------------------------------- Read plan --------------------------------
+class BlockReadPlan:
+    """
+    Serves the windows of a job from shared, decoded raster blocks.
+
+    Every read is mapped to the internal blocks of the overview level it is read
+    from. order() puts reads that share blocks next to each other (neighbouring
+    fire access ways), walking groups in block order, so a block is fetched and
+    decoded once and kept only until the last read needing it is served. Reads
+    are then assembled from the cached blocks and resampled to their output shape.
+
+    Thread-safe: concurrent reads of the same block wait for a single fetch.
+    """
+
+    def __init__(self, src: RasterSource, max_cache_bytes: int = None):
+        self.src = src
+        self.max_cache_bytes = max_cache_bytes if max_cache_bytes is not None else READ_PLANNER_CACHE_MB * 2**20
+        self.reads = {}
+        self._remaining = {}  # Block -> number of planned reads still needing it
+        self._blocks = OrderedDict()  # Block -> decoded array, least recently used first
+        self._block_locks = {}
+        self._block_nbytes = {}
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+
+        self.blocks_fetched = 0
+        self.block_hits = 0
+        self.bytes_read = 0
+        self.naive_bytes = 0
+        self.fetch_seconds = 0.0
+
+    # ------------------- Planning -------------------
+    def add(self, key, window: Window, out_shape: tuple) -> PlannedRead:
+        # Register a read of window at out_shape (bands, height, width)
+        out_height, out_width = out_shape[-2], out_shape[-1]
+        level, _ = self.src.select_overview_level(window.width, window.height, out_width, out_height)
+        level_dataset = self.src.level_dataset(level)
+        level_window = self.src.level_window(window, level)
+
+        # Whole pixels of the level covering the window, clipped to the level
+        col_off = max(0, math.floor(level_window.col_off))
+        row_off = max(0, math.floor(level_window.row_off))
+        col_end = min(level_dataset.width, math.ceil(level_window.col_off + level_window.width))
+        row_end = min(level_dataset.height, math.ceil(level_window.row_off + level_window.height))
+        level_window = Window(col_off, row_off, max(1, col_end - col_off), max(1, row_end - row_off))
+
+        block_height, block_width = self.src.block_shape(level)
+        blocks = [
+            (level, block_row, block_col)
+            for block_row in range(row_off // block_height, (row_off + level_window.height - 1) // block_height + 1)
+            for block_col in range(col_off // block_width, (col_off + level_window.width - 1) // block_width + 1)
+        ]
+
+        read = PlannedRead(key, window, out_shape, level, level_window, blocks)
+        self.reads[key] = read
+        for block in blocks:
+            self._remaining[block] = self._remaining.get(block, 0) + 1
+            self.naive_bytes += self._nbytes(block)
+        return read
+
+    def _nbytes(self, block) -> int:
+        nbytes = self._block_nbytes.get(block)
+        if nbytes is None:
+            nbytes = self.src.block_nbytes(*block)
+            self._block_nbytes[block] = nbytes
+        return nbytes
+
+    def order(self) -> list:
+        """
+        Keys of the planned reads, with reads that share blocks grouped together.
+
+        Reads connected through shared blocks form one group; groups are walked
+        in the order of their first block, and reads within a group likewise.
+        """
+        parent = {key: key for key in self.reads}
+
+        def find(key):
+            while parent[key] != key:
+                parent[key] = parent[parent[key]]
+                key = parent[key]
+            return key
+
+        first_reader = {}
+        for key, read in self.reads.items():
+            for block in read.blocks:
+                if block in first_reader:
+                    parent[find(key)] = find(first_reader[block])
+                else:
+                    first_reader[block] = key
+
+        def block_order(read):
+            level, block_row, block_col = read.blocks[0]
+            return (-1 if level is None else level, block_row, block_col)
+
+        groups = {}
+        for key, read in self.reads.items():
+            groups.setdefault(find(key), []).append(read)
+        ordered = []
+        for group in sorted(groups.values(), key=lambda reads: min(block_order(read) for read in reads)):
+            ordered.extend(read.key for read in sorted(group, key=block_order))
+        return ordered
+
+    # ------------------- Reads -------------------
+    def _get_block(self, block) -> np.ndarray:
+        with self._lock:
+            data = self._blocks.get(block)
+            if data is not None:
+                self._blocks.move_to_end(block)
+                self.block_hits += 1
+                return data
+            block_lock = self._block_locks.setdefault(block, threading.Lock())
+
+        with block_lock:
+            # Another thread may have fetched it while this one waited
+            with self._lock:
+                data = self._blocks.get(block)
+                if data is not None:
+                    self._blocks.move_to_end(block)
+                    self.block_hits += 1
+                    return data
+
+            start_time = time.time()
+            data = self.src.read_block(*block)
+            with self._lock:
+                self.fetch_seconds += time.time() - start_time
+                self.blocks_fetched += 1
+                self.bytes_read += self._nbytes(block)
+                if self._remaining.get(block, 0) > 0:
+                    self._blocks[block] = data
+                    self._cached_bytes += data.nbytes
+                    self._evict()
+            return data
+
+    def _evict(self):
+        # Called with self._lock held; drops the least recently used blocks beyond the cap
+        while self._cached_bytes > self.max_cache_bytes and len(self._blocks) > 1:
+            _, data = self._blocks.popitem(last=False)
+            self._cached_bytes -= data.nbytes
+
+    def _release(self, read: PlannedRead):
+        # The read no longer needs its blocks; drop those no other read is waiting for
+        with self._lock:
+            if read.done:
+                return
+            read.done = True
+            for block in read.blocks:
+                self._remaining[block] -= 1
+                if self._remaining[block] <= 0:
+                    data = self._blocks.pop(block, None)
+                    if data is not None:
+                        self._cached_bytes -= data.nbytes
+                    self._block_locks.pop(block, None)
+
+    def read(self, key, resampling=Resampling.bilinear) -> np.ndarray:
+        """
+        Read a planned window at its output shape from the shared blocks.
+
+        Returns:
+            np.ndarray: Array of shape out_shape, as RasterSource.read_resampled would return.
+        """
+        read = self.reads[key]
+        try:
+            level_dataset = self.src.level_dataset(read.level)
+            level_window = read.level_window
+            mosaic = np.zeros((self.src.count, level_window.height, level_window.width), dtype=self.src.dtype)
+            for block in read.blocks:
+                data = self._get_block(block)
+                block_window = self.src.block_window(*block)
+                # Overlap of the block and the read, in level pixels
+                col_off = max(block_window.col_off, level_window.col_off)
+                row_off = max(block_window.row_off, level_window.row_off)
+                col_end = min(block_window.col_off + block_window.width, level_window.col_off + level_window.width)
+                row_end = min(block_window.row_off + block_window.height, level_window.row_off + level_window.height)
+                mosaic[
+                    :,
+                    row_off - level_window.row_off:row_end - level_window.row_off,
+                    col_off - level_window.col_off:col_end - level_window.col_off,
+                ] = data[
+                    :,
+                    row_off - block_window.row_off:row_end - block_window.row_off,
+                    col_off - block_window.col_off:col_end - block_window.col_off,
+                ]
+        finally:
+            self._release(read)
+
+        # Resample the covering mosaic onto the grid of the requested window
+        out_height, out_width = read.out_shape[-2], read.out_shape[-1]
+        dst_transform = self.src.window_transform(read.window) * Affine.scale(
+            read.window.width / out_width, read.window.height / out_height
+        )
+        out_image = np.zeros(read.out_shape, dtype=self.src.dtype)
+        reproject(
+            source=mosaic,
+            destination=out_image,
+            src_transform=level_dataset.window_transform(level_window),
+            src_crs=self.src.crs,
+            dst_transform=dst_transform,
+            dst_crs=self.src.crs,
+            resampling=resampling,
+        )
+        return out_image
+
+    def skip(self, key):
+        # Release the blocks of a planned read that will not happen (e.g. the job was cancelled)
+        if key in self.reads:
+            self._release(self.reads[key])
+
+    # ------------------- Metrics -------------------
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "reads": len(self.reads),
+                "blocks_fetched": self.blocks_fetched,
+                "block_hits": self.block_hits,
+                "bytes_read": self.bytes_read,
+                "naive_bytes": self.naive_bytes,
+                "bytes_saved": self.naive_bytes - self.bytes_read,
+                "fetch_seconds": round(self.fetch_seconds, 3),
+                "cached_bytes": self._cached_bytes,
+            }
+
+    def print_metrics(self):
+        metrics = self.metrics()
+        ratio = metrics["bytes_read"] / metrics["naive_bytes"] if metrics["naive_bytes"] else 0.0
+        print(
+            f"Read plan: {metrics['reads']} reads, {metrics['blocks_fetched']} blocks fetched "
+            f"({metrics['block_hits']} served from shared blocks), "
+            f"{metrics['bytes_read'] / 2**20:.1f} MB read vs {metrics['naive_bytes'] / 2**20:.1f} MB naive ({ratio:.0%})"
+        )
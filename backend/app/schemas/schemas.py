@@ -16,6 +16,17 @@ class PolygonCreate(PolygonBase):
 class PolygonUpdate(PolygonBase):
     pass
 
+class PolygonImportError(BaseModel):
+    row: int  # 1-based position of the record in the upload
+    error: str
+
+class PolygonImportResponse(BaseModel):
+    total: int
+    imported: int
+    failed: int
+    ids: List[int]
+    errors: List[PolygonImportError]
+
 class Polygon(PolygonBase):
     id: int
     latest_status: Optional[models.StatusEnum]
@@ -53,6 +64,7 @@ class ImageBase(BaseModel):
     location: Optional[str] = None
     original_s3_key: Optional[str] = None
     annotated_s3_key: Optional[str] = None
+    cog_s3_key: Optional[str] = None
 
 class ImageCreate(ImageBase):
     pass
@@ -113,6 +125,13 @@ class MetricsResponse(BaseModel):
     is_vehicle_count: int
     is_flammable_count: int
 
+class CropCacheStatsResponse(BaseModel):
+    hits: int
+    misses: int
+    hit_rate: float
+    entries: int
+    total_hits: int
+
 class PresignedUrlRequest(BaseModel):
     label: str
 
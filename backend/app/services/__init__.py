@@ -1 +1,5 @@
-from .service_analytics import *
\ No newline at end of file
+from .service_analytics import *
+from .service_geocode import *
+from .service_crop_cache import *
+from .service_exports import *
+from .service_polygon_import import *
\ No newline at end of file
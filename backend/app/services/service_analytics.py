@@ -1,7 +1,7 @@
 # services/analytics_service.py
 from sqlalchemy.orm import Session, aliased
 from sqlalchemy import func, case
-from app import models, schemas
+from app import models, schemas, geo
 from datetime import datetime
 import json
 from geoalchemy2.shape import from_shape, to_shape
@@ -44,7 +44,7 @@ def get_heat_map_data(db: Session, start_date: datetime = None, end_date: dateti
         db.query(
             models.Polygon.id.label('id'),
             models.Polygon.name.label('name'),
-            models.Polygon.coordinates.label('coordinates'),
+            func.ST_AsBinary(models.Polygon.coordinates).label('wkb'),
             func.count(
                 case(
                     (CroppedImageAlias.data['obstruction_present'].astext == 'true', 1), 
@@ -57,14 +57,16 @@ def get_heat_map_data(db: Session, start_date: datetime = None, end_date: dateti
         .group_by(models.Polygon.id)
     )
     results = query.all()
+    # The heat map takes [lat, long] pairs
+    coordinates = geo.ring_coordinate_lists([result.wkb for result in results], swap_xy=True)
 
     return [schemas.HeatMapResponse(
             id=result.id,
             name=result.name,
-            coordinates=[[lat, long] for long, lat in mapping(to_shape(result.coordinates))["coordinates"][0]],
+            coordinates=result_coordinates,
             obstruction_count=result.obstruction_count,
         )
-        for result in results
+        for result, result_coordinates in zip(results, coordinates)
     ]
 
 # --------------------------- 
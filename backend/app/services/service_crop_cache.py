@@ -0,0 +1,96 @@
+# services/service_crop_cache.py
+import os
+import hashlib
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from dotenv import load_dotenv
+
+from app import models, lvm
+
+load_dotenv()
+
+PREFIX_FIRE_ACCESS_WAY = os.getenv("PREFIX_FIRE_ACCESS_WAY")
+
+# --------------------------- Hashing ---------------------------
+def compute_crop_hash(pixels: np.ndarray, mask: np.ndarray) -> str:
+    """
+    Content address of a polygon crop.
+
+    Args:
+        pixels (np.ndarray): Window read from the raster, (bands, height, width).
+        mask (np.ndarray): Rasterized polygon mask over the same window.
+
+    Returns:
+        str: SHA-256 of the pixels, mask, their shapes, the model and the prompt version.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{pixels.shape}:{pixels.dtype}:{mask.shape}:{mask.dtype}".encode("utf-8"))
+    digest.update(np.ascontiguousarray(pixels).tobytes())
+    digest.update(np.ascontiguousarray(mask).tobytes())
+    digest.update(f"{lvm.MODEL_NAME}:{lvm.PROMPT_VERSION}:{lvm.TEMPERATURE}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_crop_cache_s3_key(content_hash: str) -> str:
+    # Content-addressed copy of a crop; only ever written with the crop of that hash, so never overwritten with another
+    return f"{PREFIX_FIRE_ACCESS_WAY}/crops/{content_hash}.jpg"
+
+
+# --------------------------- Cache ---------------------------
+def get_cached_analysis(db: Session, content_hash: str):
+    """
+    Look up the analysis of an identical crop.
+
+    Returns:
+        tuple | None: (s3_key, data) of the cached crop, if any.
+    """
+    # Entries from before crops were content-addressed point at per-image keys, which
+    # reprocessing can overwrite with another polygon's crop; those count as misses
+    entry = db.query(models.CropAnalysisCache.s3_key, models.CropAnalysisCache.data).filter(
+        models.CropAnalysisCache.content_hash == content_hash,
+        models.CropAnalysisCache.s3_key == get_crop_cache_s3_key(content_hash),
+    ).first()
+    db.rollback()  # Read only; don't leave the session idle in a transaction between polygons
+
+    # Hits and misses are counted by CropResultWriter when the crop results are written
+    if entry:
+        return entry.s3_key, entry.data
+    return None
+
+
+def purge_crop_cache(db: Session, s3_keys: list):
+    # Drop legacy entries pointing at per-image cropped images that are being deleted from S3
+    if not s3_keys:
+        return
+    db.query(models.CropAnalysisCache).filter(
+        models.CropAnalysisCache.s3_key.in_(s3_keys)
+    ).delete(synchronize_session=False)
+    db.commit()
+
+
+def get_crop_cache_stats(db: Session) -> dict:
+    """
+    Hit and miss counts of the crop cache.
+
+    Returns:
+        dict: Hits and misses recorded by every worker (persisted with the crop
+        results), plus the number of entries and the hits recorded on them
+        since they were created.
+    """
+    counter = db.query(models.CropCacheCounter.hits, models.CropCacheCounter.misses).filter(
+        models.CropCacheCounter.id == 1
+    ).first()
+    hits, misses = (counter.hits, counter.misses) if counter else (0, 0)
+    entries, total_hits = db.query(
+        func.count(models.CropAnalysisCache.content_hash),
+        func.coalesce(func.sum(models.CropAnalysisCache.hit_count), 0),
+    ).one()
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / (hits + misses), 3) if hits + misses else 0.0,
+        "entries": entries,
+        "total_hits": int(total_hits),
+    }
@@ -0,0 +1,214 @@
+# services/service_exports.py
+import os
+import time
+import queue
+import threading
+
+from dotenv import load_dotenv
+
+from app.db import engine
+
+load_dotenv()
+
+# Rows are sent to the client in chunks of about this size, with at most this many chunks buffered
+EXPORT_CHUNK_BYTES = int(os.getenv("EXPORT_CHUNK_BYTES", str(64 * 1024)))
+EXPORT_QUEUE_CHUNKS = int(os.getenv("EXPORT_QUEUE_CHUNKS", "8"))
+
+EXPORT_FORMATS = {
+    "csv": {"media_type": "text/csv", "extension": "csv"},
+    "geojson": {"media_type": "application/geo+json", "extension": "geojson"},
+    "ndjson": {"media_type": "application/x-ndjson", "extension": "ndjson"},
+}
+
+# Same columns and coordinate format ([[lon, lat], ...]) as the original CSV download
+_CSV_QUERY = """
+    SELECT id, name, address, type,
+           (ST_AsGeoJSON(coordinates, 15)::json -> 'coordinates' -> 0)::text AS coordinates
+    FROM polygons
+    ORDER BY id
+    OFFSET %(skip)s LIMIT %(limit)s
+"""
+
+_FEATURE_SQL = """
+    json_build_object(
+        'type', 'Feature',
+        'id', id,
+        'geometry', ST_AsGeoJSON(coordinates, 15)::json,
+        'properties', json_build_object(
+            'name', name,
+            'address', address,
+            'type', type,
+            'latest_status', latest_status
+        )
+    )::text
+"""
+
+_NDJSON_QUERY = f"""
+    SELECT {_FEATURE_SQL}
+    FROM polygons
+    ORDER BY id
+    OFFSET %(skip)s LIMIT %(limit)s
+"""
+
+# Features of a FeatureCollection, with the separating comma before all but the first
+_GEOJSON_QUERY = f"""
+    SELECT CASE WHEN row_number() OVER (ORDER BY id) > 1 THEN ',' ELSE '' END || feature
+    FROM (
+        SELECT id, {_FEATURE_SQL} AS feature
+        FROM polygons
+        ORDER BY id
+        OFFSET %(skip)s LIMIT %(limit)s
+    ) AS features
+    ORDER BY id
+"""
+
+# JSON rows are copied as CSV with control characters as quote and delimiter: JSON text never
+# contains them unescaped, so rows come out verbatim (text format would double every backslash)
+_RAW_ROW_OPTIONS = "FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02'"
+
+_END = object()
+
+# How long closing an export waits for its COPY thread after cancelling the query
+_CANCEL_JOIN_SECONDS = 5
+
+
+class _ExportCancelled(Exception):
+    pass
+
+
+# --------------------------- Chunk writer ---------------------------
+class _ChunkWriter:
+    """File-like target for copy_expert that hands coalesced chunks to a bounded queue."""
+
+    def __init__(self, chunks: queue.Queue, stop: threading.Event):
+        self.chunks = chunks
+        self.stop = stop
+        self.buffer = bytearray()
+        self.bytes_written = 0
+        self.connection = None  # psycopg2 connection running the COPY, so the query can be cancelled
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.buffer += data
+        if len(self.buffer) >= EXPORT_CHUNK_BYTES:
+            self.flush()
+
+    def put(self, item):
+        # Blocks while the client is behind, which stops COPY reading further rows
+        while not self.stop.is_set():
+            try:
+                self.chunks.put(item, timeout=0.2)
+                return
+            except queue.Full:
+                continue
+        raise _ExportCancelled()
+
+    def flush(self):
+        if self.buffer:
+            chunk, self.buffer = bytes(self.buffer), bytearray()
+            self.bytes_written += len(chunk)
+            self.put(chunk)
+
+
+def _copy_to_queue(sql: str, params: dict, writer: _ChunkWriter, errors: list):
+    start_time = time.time()
+    connection = engine.raw_connection()
+    writer.connection = connection.dbapi_connection
+    try:
+        if writer.stop.is_set():
+            raise _ExportCancelled()  # Closed before the query was even sent
+        cursor = connection.cursor()
+        try:
+            copy_sql = cursor.mogrify(sql, params).decode("utf-8")
+            cursor.copy_expert(copy_sql, writer)
+            writer.flush()
+        finally:
+            cursor.close()
+        connection.rollback()  # Read-only; ends the transaction before the connection goes back to the pool
+        print(f"Exported {writer.bytes_written} bytes in {time.time() - start_time:.2f} seconds.")
+    except _ExportCancelled:
+        # The connection is left mid-COPY, so it is discarded rather than returned to the pool
+        connection.invalidate()
+        print(f"Export cancelled by the client after {writer.bytes_written} bytes.")
+    except Exception as e:
+        connection.invalidate()
+        if writer.stop.is_set():
+            # The query was cancelled because the client went away
+            print(f"Export cancelled by the client after {writer.bytes_written} bytes.")
+        else:
+            errors.append(e)
+    finally:
+        writer.connection = None
+        connection.close()
+        try:
+            writer.put(_END)
+        except _ExportCancelled:
+            pass
+
+
+# --------------------------- Polygon export ---------------------------
+def stream_polygon_export(export_format: str = "csv", skip: int = 0, limit: int = None):
+    """
+    Stream every polygon straight out of Postgres with COPY ... TO STDOUT.
+
+    COPY runs on its own connection in a background thread and its output is
+    handed over through a small bounded queue, so memory stays constant however
+    many polygons there are and the first bytes go out before the query ends.
+    Closing the generator (e.g. the client disconnects) cancels the query and
+    does not wait more than a few seconds for the COPY thread to finish.
+
+    Args:
+        export_format (str): 'csv', 'geojson' (a FeatureCollection) or 'ndjson' (one Feature per line).
+        skip (int): Number of polygons to skip, by id.
+        limit (int): Maximum number of polygons, or None for all.
+
+    Yields:
+        bytes: Chunks of the export.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{export_format}', expected one of {sorted(EXPORT_FORMATS)}")
+
+    params = {"skip": max(0, int(skip)), "limit": int(limit) if limit is not None else None}  # LIMIT NULL means no limit
+    if export_format == "csv":
+        sql = f"COPY ({_CSV_QUERY}) TO STDOUT WITH (FORMAT csv, HEADER true)"
+    elif export_format == "ndjson":
+        sql = f"COPY ({_NDJSON_QUERY}) TO STDOUT WITH ({_RAW_ROW_OPTIONS})"
+    else:
+        sql = f"COPY ({_GEOJSON_QUERY}) TO STDOUT WITH ({_RAW_ROW_OPTIONS})"
+
+    chunks = queue.Queue(maxsize=max(1, EXPORT_QUEUE_CHUNKS))
+    stop = threading.Event()
+    errors = []
+    writer = _ChunkWriter(chunks, stop)
+    producer = threading.Thread(
+        target=_copy_to_queue, args=(sql, params, writer, errors), name="polygon-export", daemon=True
+    )
+    producer.start()
+
+    try:
+        if export_format == "geojson":
+            yield b'{"type": "FeatureCollection", "features": [\n'
+        while True:
+            chunk = chunks.get()
+            if chunk is _END:
+                break
+            yield chunk
+        if errors:
+            # Headers are already sent, so the truncated body is all the client can be told
+            raise errors[0]
+        if export_format == "geojson":
+            yield b"]}\n"
+    finally:
+        stop.set()
+        # The COPY may be blocked in the server (e.g. sorting before its first row) and only sees
+        # the stop flag at its next write, so cancel the query rather than wait for it
+        connection = writer.connection
+        if connection is not None and producer.is_alive():
+            try:
+                connection.cancel()
+            except Exception as e:
+                print(f"Could not cancel the export query: {e}")
+        producer.join(timeout=_CANCEL_JOIN_SECONDS)
+        if producer.is_alive():
+            print("Export thread still running after cancellation; leaving it to finish in the background.")
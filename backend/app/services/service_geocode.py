@@ -0,0 +1,260 @@
+# services/service_geocode.py
+import os
+import math
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from dotenv import load_dotenv
+from sqlalchemy import func, update
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert
+
+from app import models
+from app.db import SessionLocal
+
+load_dotenv()
+
+# Size of the grid cell coordinates are snapped to (0.001 degrees is roughly 110 m)
+GEOCODE_GRID_DEGREES = float(os.getenv("GEOCODE_GRID_DEGREES", "0.001"))
+GEOCODE_TTL_DAYS = int(os.getenv("GEOCODE_TTL_DAYS", "90"))
+GEOCODE_CACHE_MAX_ENTRIES = int(os.getenv("GEOCODE_CACHE_MAX_ENTRIES", "10000"))
+# Cache writes between two evictions in a process; the background refresh also evicts after each write
+GEOCODE_EVICT_EVERY_WRITES = int(os.getenv("GEOCODE_EVICT_EVERY_WRITES", "100"))
+GEOCODE_TIMEOUT_SECONDS = float(os.getenv("GEOCODE_TIMEOUT_SECONDS", "5"))
+# How far (in degrees) the nearest polygon may be for its address to describe the image
+GEOCODE_LOCAL_MAX_DISTANCE = float(os.getenv("GEOCODE_LOCAL_MAX_DISTANCE", "0.01"))
+
+NOMINATIM_REVERSE_URL = "https://nominatim.openstreetmap.org/reverse"
+
+SOURCE_NOMINATIM = "nominatim"
+SOURCE_LOCAL = "local"
+
+# Nominatim allows one request per second, so remote lookups run one at a time off the critical path
+_remote_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="reverse-geocode")
+_remote_in_flight = set()
+_remote_in_flight_lock = threading.Lock()
+
+# Cache writes by this process since it last evicted
+_writes_since_eviction = 0
+_eviction_lock = threading.Lock()
+
+
+# --------------------------- Grid snapping ---------------------------
+def snap_to_cell(lon: float, lat: float) -> str:
+    """
+    Snap coordinates to the geocode grid.
+
+    Args:
+        lon (float): Longitude in WGS84.
+        lat (float): Latitude in WGS84.
+
+    Returns:
+        str: Key of the grid cell containing the point.
+    """
+    return f"{math.floor(lon / GEOCODE_GRID_DEGREES)}:{math.floor(lat / GEOCODE_GRID_DEGREES)}"
+
+
+# --------------------------- Cache ---------------------------
+def get_cached_address(db: Session, lon: float, lat: float):
+    """
+    Get the cached address for the cell containing the point.
+
+    Returns:
+        tuple | None: (address, source) of the unexpired cache entry, if any.
+    """
+    now = datetime.now(timezone.utc)
+    cell_key = snap_to_cell(lon, lat)
+    entry = db.query(models.GeocodeCache.address, models.GeocodeCache.source).filter(
+        models.GeocodeCache.cell_key == cell_key,
+        models.GeocodeCache.expires_at > now,
+    ).first()
+    if entry:
+        # Single-statement touch so eviction keeps frequently used cells
+        db.execute(
+            update(models.GeocodeCache)
+            .where(models.GeocodeCache.cell_key == cell_key)
+            .values(last_used_at=now)
+        )
+        db.commit()
+        return entry.address, entry.source
+    return None
+
+
+def store_address(db: Session, lon: float, lat: float, address: str, source: str, evict: bool = False):
+    """
+    Insert or replace the cache entry for the cell containing the point.
+
+    Old entries are evicted when evict is True, and otherwise once every
+    GEOCODE_EVICT_EVERY_WRITES writes, so the job path rarely pays for the
+    eviction queries.
+    """
+    now = datetime.now(timezone.utc)
+    values = {
+        "cell_key": snap_to_cell(lon, lat),
+        "address": address,
+        "source": source,
+        "last_used_at": now,
+        "expires_at": now + timedelta(days=GEOCODE_TTL_DAYS),
+    }
+    statement = insert(models.GeocodeCache).values(**values)
+    statement = statement.on_conflict_do_update(
+        index_elements=[models.GeocodeCache.cell_key],
+        set_={key: value for key, value in values.items() if key != "cell_key"},
+    )
+    db.execute(statement)
+    if evict or _eviction_due():
+        evict_expired_addresses(db)
+    db.commit()
+
+
+def _eviction_due() -> bool:
+    global _writes_since_eviction
+    with _eviction_lock:
+        _writes_since_eviction += 1
+        if _writes_since_eviction < GEOCODE_EVICT_EVERY_WRITES:
+            return False
+        _writes_since_eviction = 0
+        return True
+
+
+def evict_expired_addresses(db: Session):
+    # Drop expired entries, then the least recently used ones beyond the size cap (both columns are indexed)
+    db.query(models.GeocodeCache).filter(
+        models.GeocodeCache.expires_at <= datetime.now(timezone.utc)
+    ).delete(synchronize_session=False)
+
+    overflow = (
+        db.query(models.GeocodeCache.cell_key)
+        .order_by(models.GeocodeCache.last_used_at.desc())
+        .offset(GEOCODE_CACHE_MAX_ENTRIES)
+        .subquery()
+    )
+    db.query(models.GeocodeCache).filter(
+        models.GeocodeCache.cell_key.in_(overflow.select())
+    ).delete(synchronize_session=False)
+
+
+# --------------------------- Lookups ---------------------------
+def lookup_nearest_polygon_address(db: Session, lon: float, lat: float):
+    """
+    Derive a location offline from the address of the nearest fire access way.
+
+    Returns:
+        str | None: The address, or None if no polygon with an address is close enough.
+    """
+    point = func.ST_SetSRID(func.ST_MakePoint(lon, lat), 4326)
+    result = (
+        db.query(models.Polygon.address)
+        .filter(
+            models.Polygon.address.isnot(None),
+            models.Polygon.address != "",
+            func.ST_DWithin(models.Polygon.coordinates, point, GEOCODE_LOCAL_MAX_DISTANCE),
+        )
+        .order_by(models.Polygon.coordinates.distance_centroid(point))
+        .first()
+    )
+    return result.address if result else None
+
+
+def fetch_remote_address(lon: float, lat: float):
+    """
+    Reverse geocode through Nominatim.
+
+    Returns:
+        str | None: The address, or None if the request failed.
+    """
+    try:
+        start_time = time.time()
+        response = requests.get(
+            NOMINATIM_REVERSE_URL,
+            params={"lon": lon, "lat": lat, "format": "json", "addressdetails": 1},
+            headers={"User-Agent": "Blockfinder"},
+            timeout=GEOCODE_TIMEOUT_SECONDS,
+        )
+        response.raise_for_status()
+        data = response.json()
+        print(f"Reverse geocoding completed in {time.time() - start_time:.2f} seconds.")
+
+        if "address" in data:
+            address_info = data["address"]
+            address = address_info.get("road", "No address found")
+            city = address_info.get("city", "No city found")
+            return f"{address}, {city}"
+        return "No address found for the given coordinates."
+
+    except (requests.RequestException, ValueError) as e:
+        print(f"Error occurred while reverse geocoding: {e}")
+        return None
+
+
+def resolve_address(db: Session, lon: float, lat: float):
+    """
+    Resolve a location for the point without touching the network.
+
+    A cached address is returned as is. On a miss the address of the nearest
+    polygon (or the coordinates themselves) is cached and returned, so the same
+    site is never looked up twice; the caller can then ask for a remote refresh.
+
+    Returns:
+        tuple: (address, is_final) where is_final is False for a local fallback.
+    """
+    cached = get_cached_address(db, lon, lat)
+    if cached:
+        address, source = cached
+        print(f"Geocode cache hit for cell {snap_to_cell(lon, lat)} ({source})")
+        return address, True
+
+    address = f"{lat:.5f}, {lon:.5f}"
+    try:
+        address = lookup_nearest_polygon_address(db, lon, lat) or address
+        store_address(db, lon, lat, address, SOURCE_LOCAL)
+    except Exception as e:
+        # A cache failure must not fail the job; the coordinates are still a usable location
+        db.rollback()
+        print(f"Error occurred while caching the local address: {e}")
+    print(f"Geocode cache miss, using local address: {address}")
+    return address, False
+
+
+def refresh_address_async(lon: float, lat: float, image_id: int = None, provisional_address: str = None):
+    """
+    Look the point up on Nominatim in the background and cache the result.
+
+    If image_id is given, the image location is replaced as long as it still
+    holds the provisional address.
+    """
+    cell_key = snap_to_cell(lon, lat)
+    with _remote_in_flight_lock:
+        if cell_key in _remote_in_flight:
+            return
+        _remote_in_flight.add(cell_key)
+
+    def run():
+        try:
+            address = fetch_remote_address(lon, lat)
+            if address is None:
+                return  # Keep the local address until the entry expires
+            db = SessionLocal()
+            try:
+                # Off the job path, so this write also evicts old entries
+                store_address(db, lon, lat, address, SOURCE_NOMINATIM, evict=True)
+                if image_id is not None:
+                    db.execute(
+                        update(models.Image)
+                        .where(models.Image.id == image_id)
+                        .where((models.Image.location == provisional_address) | models.Image.location.is_(None))
+                        .values(location=address)
+                    )
+                    db.commit()
+            finally:
+                db.close()
+        except Exception as e:
+            print(f"Background reverse geocoding failed for cell {cell_key}: {e}")
+        finally:
+            with _remote_in_flight_lock:
+                _remote_in_flight.discard(cell_key)
+
+    _remote_executor.submit(run)
@@ -0,0 +1,252 @@
+# services/service_polygon_import.py
+import os
+import io
+import csv
+import json
+import tempfile
+
+import numpy as np
+import shapely
+from shapely.geometry import shape
+
+# Type id of a Polygon in shapely.get_type_id
+_POLYGON_TYPE_ID = 3
+
+IMPORT_FORMATS = {
+    ".geojson": "geojson",
+    ".json": "geojson",
+    ".csv": "csv",
+    ".zip": "shapefile",
+}
+
+
+class ParsedPolygons:
+    """Attributes and geometries of the records of an upload, plus the errors found so far per record."""
+
+    def __init__(self):
+        self.rows = []  # {"name", "address", "type"} per record
+        self.geometries = []  # Shapely geometry (or None) per record, in WGS84
+        self.errors = {}  # Record index -> error message
+
+    def add(self, properties: dict, geometry=None, error: str = None):
+        # Attribute names are matched case-insensitively
+        properties = {str(key).lower(): value for key, value in (properties or {}).items()}
+        values = {key: properties.get(key) for key in ("name", "address", "type")}
+        self.rows.append({key: str(value) if value not in (None, "") else None for key, value in values.items()})
+        self.geometries.append(geometry)
+        if error:
+            self.errors[len(self.rows) - 1] = error
+
+
+# --------------------------- Readers ---------------------------
+def read_geojson(content: bytes) -> ParsedPolygons:
+    """
+    Read a FeatureCollection, a list of Features or a single Feature.
+
+    Geometries are decoded together with shapely.from_geojson; the few it
+    cannot read (e.g. with Z coordinates) are retried one by one.
+    """
+    try:
+        document = json.loads(content)
+    except ValueError as e:
+        raise ValueError(f"Invalid GeoJSON: {e}")
+    if isinstance(document, dict) and document.get("type") == "FeatureCollection":
+        features = document.get("features") or []
+    elif isinstance(document, dict) and document.get("type") == "Feature":
+        features = [document]
+    elif isinstance(document, list):
+        features = document
+    else:
+        raise ValueError("GeoJSON must be a FeatureCollection, a Feature or a list of Features")
+
+    parsed = ParsedPolygons()
+    geometry_objects, geometry_texts = [], []
+    for feature in features:
+        geometry = feature.get("geometry") if isinstance(feature, dict) else None
+        properties = feature.get("properties") if isinstance(feature, dict) else None
+        parsed.add(properties if isinstance(properties, dict) else {}, error=None if geometry else "Missing geometry")
+        geometry_objects.append(geometry)
+        geometry_texts.append(json.dumps(geometry) if geometry else None)
+
+    geometries = shapely.from_geojson(np.array(geometry_texts, dtype=object), on_invalid="ignore")
+    parsed.geometries = list(geometries)
+
+    # GEOS (before 3.12) rejects GeoJSON with a third coordinate, so those are read with shapely.geometry.shape
+    for index in np.flatnonzero(shapely.is_missing(geometries)):
+        if not isinstance(geometry_objects[index], dict):
+            continue
+        try:
+            parsed.geometries[index] = shape(geometry_objects[index])
+        except Exception:
+            pass  # Reported as unreadable by validate_polygons
+    return parsed
+
+
+def read_csv(content: bytes) -> ParsedPolygons:
+    """
+    Read a CSV with name, address and type columns and the geometry in either a
+    'coordinates' column ([[lon, lat], ...], as exported) or a 'wkt' column.
+
+    WKT is decoded with shapely.from_wkt and coordinate rings are assembled with
+    shapely.linearrings / shapely.polygons, each in one call for the whole file.
+    """
+    try:
+        text = content.decode("utf-8-sig")
+    except UnicodeDecodeError as e:
+        raise ValueError(f"CSV must be UTF-8 encoded: {e}")
+    reader = csv.DictReader(io.StringIO(text))
+    if reader.fieldnames is None:
+        raise ValueError("CSV is empty")
+    columns = {name.lower() for name in reader.fieldnames}
+    if "coordinates" not in columns and "wkt" not in columns:
+        raise ValueError("CSV needs a 'coordinates' or a 'wkt' column")
+
+    parsed = ParsedPolygons()
+    wkt_rows, wkt_texts = [], []
+    ring_rows, ring_coords = [], []
+    for record in reader:
+        record = {str(key).lower(): value for key, value in record.items() if key is not None}
+        parsed.add(record)
+        index = len(parsed.rows) - 1
+
+        if record.get("wkt"):
+            wkt_rows.append(index)
+            wkt_texts.append(record["wkt"])
+            continue
+        try:
+            coords = np.asarray(json.loads(record.get("coordinates") or "null"), dtype=np.float64)
+        except (ValueError, TypeError):
+            parsed.errors[index] = "Unreadable coordinates"
+            continue
+        if coords.ndim != 2 or coords.shape[1] != 2:
+            parsed.errors[index] = "Coordinates must be a list of [lon, lat] pairs"
+        elif len(np.unique(coords, axis=0)) < 3:
+            parsed.errors[index] = "A polygon needs at least 3 distinct coordinates"
+        else:
+            ring_rows.append(index)
+            ring_coords.append(coords)
+
+    if wkt_rows:
+        geometries = shapely.from_wkt(np.array(wkt_texts, dtype=object), on_invalid="ignore")
+        for index, geometry in zip(wkt_rows, geometries):
+            parsed.geometries[index] = geometry
+    if ring_rows:
+        # Every ring in one call: coordinates concatenated, with the ring each one belongs to
+        ring_index = np.repeat(np.arange(len(ring_coords)), [len(coords) for coords in ring_coords])
+        rings = shapely.linearrings(np.concatenate(ring_coords), indices=ring_index)
+        for index, geometry in zip(ring_rows, shapely.polygons(rings)):
+            parsed.geometries[index] = geometry
+    return parsed
+
+
+def read_shapefile(content: bytes) -> ParsedPolygons:
+    """
+    Read a zipped Shapefile (.shp, .shx, .dbf and ideally .prj) with OGR.
+
+    Features are reprojected to WGS84 when the layer has another CRS. Needs the
+    GDAL Python bindings, which are optional at import time.
+    """
+    try:
+        from osgeo import ogr, osr
+    except ImportError:
+        raise ValueError("Shapefile import needs the GDAL Python bindings (osgeo), which are not installed")
+
+    parsed = ParsedPolygons()
+    wkb_rows, wkb_values = [], []
+    with tempfile.TemporaryDirectory(prefix="polygon-import-") as tmp_dir:
+        zip_path = os.path.join(tmp_dir, "upload.zip")
+        with open(zip_path, "wb") as zip_file:
+            zip_file.write(content)
+
+        data_source = ogr.Open(f"/vsizip/{zip_path}")
+        if data_source is None or data_source.GetLayerCount() == 0:
+            raise ValueError("The zip file does not contain a readable Shapefile")
+        layer = data_source.GetLayer(0)
+
+        transform = None
+        source_srs = layer.GetSpatialRef()
+        if source_srs is not None:
+            target_srs = osr.SpatialReference()
+            target_srs.ImportFromEPSG(4326)
+            # Keep lon/lat order whatever the CRS definitions say
+            source_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            target_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            if not source_srs.IsSame(target_srs):
+                transform = osr.CoordinateTransformation(source_srs, target_srs)
+
+        field_names = [layer.GetLayerDefn().GetFieldDefn(i).GetName() for i in range(layer.GetLayerDefn().GetFieldCount())]
+        for feature in layer:
+            parsed.add({name: feature.GetField(name) for name in field_names})
+            index = len(parsed.rows) - 1
+            geometry = feature.GetGeometryRef()
+            if geometry is None:
+                parsed.errors[index] = "Missing geometry"
+                continue
+            geometry = geometry.Clone()
+            if transform is not None and geometry.Transform(transform) != 0:
+                parsed.errors[index] = "Could not reproject the geometry to WGS84"
+                continue
+            wkb_rows.append(index)
+            wkb_values.append(bytes(geometry.ExportToWkb()))
+        data_source = None  # Closes the dataset before the temporary directory is removed
+
+    if wkb_rows:
+        geometries = shapely.from_wkb(np.array(wkb_values, dtype=object), on_invalid="ignore")
+        for index, geometry in zip(wkb_rows, geometries):
+            parsed.geometries[index] = geometry
+    return parsed
+
+
+# --------------------------- Validation ---------------------------
+def validate_polygons(parsed: ParsedPolygons) -> np.ndarray:
+    """
+    Check every geometry of an upload in vectorized passes.
+
+    Records must hold a non-empty, valid Polygon; the reason GEOS gives is
+    recorded for invalid ones. Errors are added to parsed.errors. Z (and M)
+    coordinates are dropped from parsed.geometries, as the column is 2D.
+
+    Returns:
+        np.ndarray: Indices of the records that can be imported.
+    """
+    geometries = np.array(parsed.geometries, dtype=object)
+    if len(geometries) == 0:
+        return np.empty(0, dtype=np.int64)
+    geometries = shapely.force_2d(geometries)
+    parsed.geometries = list(geometries)
+
+    missing = shapely.is_missing(geometries)
+    is_polygon = shapely.get_type_id(geometries) == _POLYGON_TYPE_ID
+    empty = shapely.is_empty(geometries)
+    valid = shapely.is_valid(geometries)
+
+    candidates = ~missing & is_polygon & ~empty
+    invalid = np.flatnonzero(candidates & ~valid)
+    reasons = shapely.is_valid_reason(geometries[invalid]) if len(invalid) else []
+
+    for index in np.flatnonzero(missing):
+        parsed.errors.setdefault(int(index), "Unreadable geometry")
+    for index in np.flatnonzero(~missing & ~is_polygon):
+        parsed.errors.setdefault(int(index), f"Expected a Polygon, got a {geometries[index].geom_type}")
+    for index in np.flatnonzero(~missing & is_polygon & empty):
+        parsed.errors.setdefault(int(index), "Empty polygon")
+    for index, reason in zip(invalid, reasons):
+        parsed.errors.setdefault(int(index), f"Invalid polygon: {reason}")
+
+    has_error = np.zeros(len(geometries), dtype=bool)
+    if parsed.errors:
+        has_error[list(parsed.errors)] = True
+    return np.flatnonzero(candidates & valid & ~has_error)
+
+
+def read_polygon_upload(filename: str, content: bytes) -> ParsedPolygons:
+    # Parse an upload by its extension
+    extension = os.path.splitext(filename or "")[1].lower()
+    import_format = IMPORT_FORMATS.get(extension)
+    if import_format == "geojson":
+        return read_geojson(content)
+    if import_format == "csv":
+        return read_csv(content)
+    if import_format == "shapefile":
+        return read_shapefile(content)
+    raise ValueError(f"Unsupported file type '{extension}', expected one of {', '.join(IMPORT_FORMATS)}")
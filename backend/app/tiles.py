@@ -0,0 +1,398 @@
+# app/tiles.py
+import os
+import math
+import time
+import fcntl
+import shutil
+import threading
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+from sqlalchemy import text, func
+from sqlalchemy.orm import Session
+
+from app import models
+
+load_dotenv()
+
+# Directory rendered tiles are kept in, shared by the API and the workers; caching is off when empty
+TILE_CACHE_DIR = os.getenv("TILE_CACHE_DIR", "")
+# Upper bound on how long a cached tile is served, in case an invalidation was missed
+TILE_CACHE_TTL_SECONDS = int(os.getenv("TILE_CACHE_TTL_SECONDS", "3600"))
+# Size cap of the cache directory; a periodic sweep removes expired tiles, then the oldest ones beyond the cap
+TILE_CACHE_MAX_MB = int(os.getenv("TILE_CACHE_MAX_MB", "2048"))
+TILE_CACHE_SWEEP_SECONDS = int(os.getenv("TILE_CACHE_SWEEP_SECONDS", "300"))
+TILE_MAX_ZOOM = int(os.getenv("TILE_MAX_ZOOM", "22"))
+
+# MVT grid size and the buffer (in grid units) kept around each tile so outlines are not clipped at tile edges
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+TILE_LAYER_NAME = "polygons"
+
+# Above this many tiles per zoom level, invalidation clears the whole level instead of single tiles
+_MAX_TILES_PER_LEVEL = 1024
+
+# Files in the cache directory besides the tiles
+_GENERATION_FILE = ".generation"
+_GENERATION_LOCK_FILE = ".generation.lock"
+_SWEEP_LOCK_FILE = ".sweep.lock"
+_TILE_SUFFIX = ".mvt"
+
+_TILE_SQL = text("""
+    WITH bounds AS (
+        SELECT
+            ST_TileEnvelope(:z, :x, :y) AS geom,
+            ST_Transform(ST_TileEnvelope(:z, :x, :y, margin => :margin), 4326) AS search_geom
+    ),
+    tile_polygons AS (
+        SELECT p.id, p.name, p.address, p.type, p.latest_status, p.coordinates
+        FROM polygons p, bounds
+        WHERE p.coordinates && bounds.search_geom
+    ),
+    obstructions AS (
+        SELECT c.polygon_id, count(*) AS obstruction_count
+        FROM cropped_images c
+        JOIN tile_polygons t ON t.id = c.polygon_id
+        WHERE c.data ->> 'obstruction_present' = 'true'
+        GROUP BY c.polygon_id
+    )
+    SELECT ST_AsMVT(tile, :layer, :extent, 'geom', 'id')
+    FROM (
+        SELECT
+            t.id,
+            t.name,
+            t.address,
+            t.type,
+            t.latest_status::text AS latest_status,
+            COALESCE(o.obstruction_count, 0) AS obstruction_count,
+            ST_AsMVTGeom(ST_Transform(t.coordinates, 3857), bounds.geom, :extent, :buffer, true) AS geom
+        FROM tile_polygons t
+        CROSS JOIN bounds
+        LEFT JOIN obstructions o ON o.polygon_id = t.id
+    ) AS tile
+    WHERE tile.geom IS NOT NULL
+""")
+
+
+# -------------------------------- Tile math --------------------------------
+def is_valid_tile(z: int, x: int, y: int) -> bool:
+    return 0 <= z <= TILE_MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def lonlat_to_tile_fraction(lon: float, lat: float, z: int) -> tuple:
+    # Fractional web mercator tile coordinates of a WGS84 point
+    n = 2 ** z
+    lat = max(-85.05112878, min(85.05112878, lat))
+    x = (lon + 180.0) / 360.0 * n
+    y = (1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n
+    return x, y
+
+
+def tiles_for_bounds(bounds, z: int) -> tuple:
+    """
+    Range of tiles at zoom z whose buffered area touches bounds.
+
+    Returns:
+        tuple: (min_x, min_y, max_x, max_y), inclusive.
+    """
+    min_lon, min_lat, max_lon, max_lat = bounds
+    buffer = TILE_BUFFER / TILE_EXTENT
+    left, top = lonlat_to_tile_fraction(min_lon, max_lat, z)
+    right, bottom = lonlat_to_tile_fraction(max_lon, min_lat, z)
+    last = 2 ** z - 1
+    return (
+        max(0, math.floor(left - buffer)),
+        max(0, math.floor(top - buffer)),
+        min(last, math.floor(right + buffer)),
+        min(last, math.floor(bottom + buffer)),
+    )
+
+
+# -------------------------------- Tile cache --------------------------------
+class TileCache:
+    """
+    Rendered vector tiles on disk, laid out as {z}/{x}/{y}.mvt.
+
+    Writes go through a temporary file and os.replace, so a reader never sees a
+    partial tile. Invalidation removes every cached tile, at every zoom level,
+    whose buffered area touches the bounds of a changed polygon, and bumps a
+    generation counter shared by every process using the directory: a tile
+    rendered while an invalidation ran is not kept (see put()). Expired tiles
+    are removed when read, and a periodic sweep keeps the directory under
+    max_bytes by removing expired tiles and then the oldest ones.
+    """
+
+    def __init__(self, directory: str, ttl_seconds: int = TILE_CACHE_TTL_SECONDS, max_bytes: int = TILE_CACHE_MAX_MB * 2**20, sweep_seconds: int = TILE_CACHE_SWEEP_SECONDS):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.sweep_seconds = sweep_seconds
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self.discarded = 0
+        self.swept = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def _path(self, z: int, x: int, y: int) -> str:
+        return os.path.join(self.directory, str(z), str(x), f"{y}{_TILE_SUFFIX}")
+
+    @contextmanager
+    def _file_lock(self, name: str, blocking: bool = True):
+        # Yields whether the lock on the named file in the cache directory is held
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, name), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # ------------------- Generation -------------------
+    def generation(self) -> int:
+        # Number of invalidations so far; read it before rendering a tile and hand it to put()
+        if not self.enabled:
+            return 0
+        try:
+            with open(os.path.join(self.directory, _GENERATION_FILE)) as generation_file:
+                return int(generation_file.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _bump_generation(self):
+        try:
+            with self._file_lock(_GENERATION_LOCK_FILE):
+                path = os.path.join(self.directory, _GENERATION_FILE)
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "w") as generation_file:
+                    generation_file.write(str(self.generation() + 1))
+                os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not bump the tile cache generation: {e}")
+
+    # ------------------- Reads and writes -------------------
+    def get(self, z: int, x: int, y: int):
+        # Cached tile bytes, or None on a miss
+        if not self.enabled:
+            return None
+        path = self._path(z, x, y)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                os.remove(path)  # Expired tiles are dropped as they are found
+                raise FileNotFoundError(path)
+            with open(path, "rb") as tile_file:
+                data = tile_file.read()
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, z: int, x: int, y: int, data: bytes, generation: int = None):
+        """
+        Cache a rendered tile.
+
+        generation is the value of generation() read before the tile was
+        rendered. If an invalidation ran since then, the tile may show data from
+        before the change, so it is not kept. The check is repeated after the
+        tile is in place, because an invalidation can also land in between.
+        """
+        if not self.enabled:
+            return
+        if generation is not None and self.generation() != generation:
+            with self._lock:
+                self.discarded += 1
+            return
+        path = self._path(z, x, y)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as tile_file:
+                tile_file.write(data)
+            os.replace(tmp_path, path)
+            if generation is not None and self.generation() != generation:
+                # Invalidations bump the generation before removing tiles, so either that removal
+                # or this one drops the tile
+                os.remove(path)
+                with self._lock:
+                    self.discarded += 1
+        except OSError as e:
+            # A tile that cannot be cached is still served
+            print(f"Could not cache tile {z}/{x}/{y}: {e}")
+        self._maybe_sweep()
+
+    # ------------------- Invalidation -------------------
+    def invalidate_bounds(self, bounds):
+        """
+        Remove the cached tiles touched by a WGS84 bounding box.
+
+        Args:
+            bounds (tuple): (min_lon, min_lat, max_lon, max_lat).
+        """
+        if not self.enabled or not os.path.isdir(self.directory):
+            return
+        # Bumped first, so tiles being rendered right now are not kept (see put())
+        self._bump_generation()
+        removed = 0
+        for z in range(TILE_MAX_ZOOM + 1):
+            level_dir = os.path.join(self.directory, str(z))
+            if not os.path.isdir(level_dir):
+                continue
+            min_x, min_y, max_x, max_y = tiles_for_bounds(bounds, z)
+            if (max_x - min_x + 1) * (max_y - min_y + 1) > _MAX_TILES_PER_LEVEL:
+                shutil.rmtree(level_dir, ignore_errors=True)
+                continue
+            for x in range(min_x, max_x + 1):
+                for y in range(min_y, max_y + 1):
+                    try:
+                        os.remove(self._path(z, x, y))
+                        removed += 1
+                    except FileNotFoundError:
+                        pass
+        with self._lock:
+            self.invalidated += removed
+
+    def clear(self):
+        if self.enabled:
+            self._bump_generation()
+            for z in range(TILE_MAX_ZOOM + 1):
+                shutil.rmtree(os.path.join(self.directory, str(z)), ignore_errors=True)
+
+    # ------------------- Sweep -------------------
+    def _maybe_sweep(self):
+        # At most one sweep per sweep_seconds per process, in the background
+        now = time.time()
+        with self._lock:
+            if now - self._last_sweep < self.sweep_seconds:
+                return
+            self._last_sweep = now
+        threading.Thread(target=self.sweep, name="tile-cache-sweep", daemon=True).start()
+
+    def sweep(self):
+        """
+        Remove expired tiles, leftover temporary files, and then the oldest
+        tiles until the directory fits in max_bytes. Skipped if another process
+        is already sweeping.
+        """
+        if not self.enabled or not os.path.isdir(self.directory):
+            return
+        start_time = time.time()
+        with self._file_lock(_SWEEP_LOCK_FILE, blocking=False) as acquired:
+            if not acquired:
+                return
+            now = time.time()
+            tiles, removed = [], 0
+            for dirpath, _, filenames in os.walk(self.directory):
+                for filename in filenames:
+                    if filename.startswith("."):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                        if now - stat.st_mtime > self.ttl_seconds:
+                            # Expired tiles, and temporary files older than any tile can live
+                            os.remove(path)
+                            removed += 1
+                            continue
+                    except FileNotFoundError:
+                        continue
+                    if filename.endswith(_TILE_SUFFIX):
+                        tiles.append((stat.st_mtime, stat.st_size, path))
+
+            used = sum(size for _, size, _ in tiles)
+            for _, size, path in sorted(tiles):
+                if used <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+                used -= size
+        with self._lock:
+            self.swept += removed
+        print(f"Tile cache sweep removed {removed} files, {used / 2**20:.1f} MB left, in {time.time() - start_time:.2f} seconds.")
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidated": self.invalidated,
+                "discarded": self.discarded,
+                "swept": self.swept,
+            }
+
+
+tile_cache = TileCache(TILE_CACHE_DIR)
+
+
+# -------------------------------- Tiles --------------------------------
+def render_polygon_tile(db: Session, z: int, x: int, y: int) -> bytes:
+    # Mapbox Vector Tile of the polygons in tile z/x/y, with their status and obstruction count
+    margin = TILE_BUFFER / TILE_EXTENT
+    data = db.execute(_TILE_SQL, {
+        "z": z, "x": x, "y": y,
+        "margin": margin,
+        "layer": TILE_LAYER_NAME,
+        "extent": TILE_EXTENT,
+        "buffer": TILE_BUFFER,
+    }).scalar()
+    return bytes(data) if data is not None else b""
+
+
+def get_polygon_tile(db: Session, z: int, x: int, y: int) -> bytes:
+    data = tile_cache.get(z, x, y)
+    if data is not None:
+        return data
+    start_time = time.time()
+    generation = tile_cache.generation()
+    data = render_polygon_tile(db, z, x, y)
+    tile_cache.put(z, x, y, data, generation=generation)
+    print(f"Rendered tile {z}/{x}/{y} ({len(data)} bytes) in {time.time() - start_time:.3f} seconds.")
+    return data
+
+
+def get_polygon_bounds(db: Session, polygon_ids) -> list:
+    # (min_lon, min_lat, max_lon, max_lat) of every polygon in polygon_ids, in one query
+    polygon_ids = list(polygon_ids)
+    if not polygon_ids:
+        return []
+    rows = db.query(
+        func.ST_XMin(models.Polygon.coordinates),
+        func.ST_YMin(models.Polygon.coordinates),
+        func.ST_XMax(models.Polygon.coordinates),
+        func.ST_YMax(models.Polygon.coordinates),
+    ).filter(
+        models.Polygon.id.in_(polygon_ids),
+        models.Polygon.coordinates.isnot(None),
+    ).all()
+    return [tuple(row) for row in rows]
+
+
+def invalidate_polygon_tiles(db: Session, polygon_ids):
+    """
+    Remove the cached tiles showing any of the given polygons.
+
+    Call it after committing a change to the polygons' geometry, status or
+    analyses (which feed the obstruction counts). Failures are logged and
+    swallowed: the TTL bounds how long a missed invalidation is visible.
+    """
+    if not tile_cache.enabled:
+        return
+    try:
+        for bounds in get_polygon_bounds(db, polygon_ids):
+            tile_cache.invalidate_bounds(bounds)
+    except Exception as e:
+        print(f"Tile cache invalidation failed for polygons {list(polygon_ids)}: {e}")
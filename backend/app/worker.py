@@ -0,0 +1,167 @@
+# app/worker.py
+"""
+Standalone processing worker.
+
+Usage:
+    python -m app.worker --processes 4
+
+Each process claims jobs from the processing_jobs table, processes one image
+at a time and keeps its lease alive with a heartbeat thread. Any number of
+workers can run on any number of hosts against the same database.
+"""
+import os
+import time
+import signal
+import socket
+import argparse
+import threading
+import multiprocessing
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+from app import crud, jobs, processing
+from app.db import SessionLocal
+from app.pipeline import PipelineCancelled
+
+load_dotenv()
+
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+# How often a running job checks whether it was cancelled
+JOB_CANCEL_CHECK_SECONDS = float(os.getenv("JOB_CANCEL_CHECK_SECONDS", "2"))
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
+
+
+# -------------------------------- Heartbeat --------------------------------
+class Heartbeat:
+    # Extends the job's lease every third of JOB_LEASE_SECONDS and watches for cancellation until stopped
+    def __init__(self, job_id: int, worker_id: str):
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.interval = max(1.0, jobs.JOB_LEASE_SECONDS / 3)
+        self.lost = threading.Event()
+        self.cancelled = threading.Event()  # Also set when the lease is lost, as the job now belongs to another worker
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"heartbeat-{job_id}", daemon=True)
+
+    def _run(self):
+        db = SessionLocal()
+        last_beat = time.time()
+        try:
+            while not self._stop.wait(min(self.interval, JOB_CANCEL_CHECK_SECONDS)):
+                try:
+                    if jobs.is_cancel_requested(db, self.job_id):
+                        print(f"Job {self.job_id} cancellation requested")
+                        self.cancelled.set()
+                        return
+                    if time.time() - last_beat < self.interval:
+                        continue
+                    last_beat = time.time()
+                    if not jobs.heartbeat_job(db, self.job_id, self.worker_id):
+                        print(f"Worker {self.worker_id} lost the lease on job {self.job_id}")
+                        self.lost.set()
+                        self.cancelled.set()
+                        return
+                except Exception as e:
+                    db.rollback()
+                    print(f"Heartbeat for job {self.job_id} failed: {e}")
+        finally:
+            db.close()
+
+    def __enter__(self) -> "Heartbeat":
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+
+
+# -------------------------------- Worker loop --------------------------------
+def run_job(db, job, worker_id: str):
+    print(f"Worker {worker_id} processing job {job.id} for image {job.image_id} (attempt {job.attempts}/{job.max_attempts})")
+    start_time = time.time()
+    heartbeat = Heartbeat(job.id, worker_id)
+    try:
+        with heartbeat:
+            db_image = crud.get_image_by_id(db, image_id=job.image_id)
+            if not db_image:
+                raise HTTPException(status_code=404, detail="Image not found")
+            processing.process_image(db, db_image, cancel_event=heartbeat.cancelled, lease_lost=heartbeat.lost)
+    except PipelineCancelled:
+        db.rollback()
+        if not heartbeat.lost.is_set():
+            jobs.mark_cancelled(db, job.id, worker_id)
+        return
+    except Exception as e:
+        db.rollback()
+        error = e.detail if isinstance(e, HTTPException) else str(e)
+        jobs.fail_job(db, job.id, worker_id, str(error))
+        return
+
+    jobs.complete_job(db, job.id, worker_id)
+    print(f"Worker {worker_id} finished job {job.id} in {time.time() - start_time:.2f} seconds.")
+
+
+def run_worker(worker_id: str):
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        # Finish the current job, then exit
+        print(f"Worker {worker_id} stopping...")
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    print(f"Worker {worker_id} started")
+    while not stopping.is_set():
+        db = SessionLocal()
+        try:
+            job = jobs.claim_job(db, worker_id)
+            if job is None:
+                db.close()
+                stopping.wait(JOB_POLL_SECONDS)
+                continue
+            run_job(db, job, worker_id)
+        except Exception as e:
+            print(f"Worker {worker_id} error: {e}")
+            stopping.wait(JOB_POLL_SECONDS)
+        finally:
+            db.close()
+    print(f"Worker {worker_id} stopped")
+
+
+# -------------------------------- Entrypoint --------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Process queued images.")
+    parser.add_argument("--processes", type=int, default=WORKER_PROCESSES, help="Number of worker processes to run.")
+    args = parser.parse_args()
+
+    hostname = socket.gethostname()
+    if args.processes <= 1:
+        run_worker(f"{hostname}-{os.getpid()}")
+        return
+
+    # Spawned (not forked) processes each open their own database and GDAL connections
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_worker, args=(f"{hostname}-{os.getpid()}-{index}",), name=f"worker-{index}")
+        for index in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    def forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()  # SIGTERM: each worker finishes its current job
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
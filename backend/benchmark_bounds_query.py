@@ -0,0 +1,124 @@
+"""
+Compare the query plans of the old and new polygon bounds queries.
+
+Runs EXPLAIN (ANALYZE, BUFFERS) for random image-sized boxes inside the extent
+of the polygons table, once with the old ST_Transform(ST_SetSRID(ST_GeomFromText(...)))
+filter and once with crud.polygons_within_bounds_query, and reports which scan
+each plan uses and how long it took. Run it after `alembic upgrade head`.
+
+    python benchmark_bounds_query.py
+    python benchmark_bounds_query.py --seed 200000 --queries 50
+
+--seed inserts synthetic polygons inside the benchmark's transaction, which is
+rolled back at the end, so the table is left as it was.
+"""
+import time
+import random
+import argparse
+import statistics
+
+from shapely.geometry import box
+from sqlalchemy import func, text
+from sqlalchemy.dialects import postgresql
+
+from app import crud, models
+from app.db import SessionLocal
+
+
+def legacy_bounds_query(db, bounds):
+    # The filter get_polygons_within_bounds used before the spatial index migration
+    bounding_box_wkt = box(*bounds).wkt
+    return db.query(models.Polygon).filter(
+        models.Polygon.coordinates.ST_Intersects(
+            func.ST_Transform(func.ST_SetSRID(func.ST_GeomFromText(bounding_box_wkt), 4326), 4326)
+        )
+    )
+
+
+def seed_polygons(db, count: int):
+    # Small rectangles roughly the size of fire access ways, scattered over Singapore
+    start_time = time.time()
+    db.execute(text(
+        "INSERT INTO polygons (name, address, type, coordinates, latest_status) "
+        "SELECT 'benchmark-' || n, NULL, 'benchmark', "
+        "ST_MakeEnvelope(x, y, x + 0.0003, y + 0.0001, 4326), 'clear' "
+        "FROM (SELECT n, 103.6 + random() * 0.4 AS x, 1.2 + random() * 0.25 AS y "
+        "FROM generate_series(1, :count) AS n) AS points"
+    ), {"count": count})
+    db.execute(text("ANALYZE polygons"))
+    print(f"Seeded {count} polygons in {time.time() - start_time:.2f} seconds.")
+
+
+def scan_types(plan: dict) -> set:
+    # Node types of every scan in a JSON plan tree
+    found = set()
+    if "Scan" in plan["Node Type"]:
+        found.add(plan["Node Type"])
+    for child in plan.get("Plans", []):
+        found |= scan_types(child)
+    return found
+
+
+def explain(db, query) -> dict:
+    sql = str(query.statement.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+    result = db.execute(text(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}")).scalar()
+    plan = result[0]
+    return {
+        "scans": scan_types(plan["Plan"]),
+        "execution_ms": plan["Execution Time"],
+        "rows": plan["Plan"]["Actual Rows"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the plans of the old and new polygon bounds queries.")
+    parser.add_argument("--seed", type=int, default=0, help="Synthetic polygons to add for the run (rolled back)")
+    parser.add_argument("--queries", type=int, default=20, help="Number of random boxes to query")
+    parser.add_argument("--box-degrees", type=float, default=0.01, help="Width and height of each box")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.seed:
+            seed_polygons(db, args.seed)
+
+        extent = db.query(
+            func.ST_XMin(func.ST_Extent(models.Polygon.coordinates)),
+            func.ST_YMin(func.ST_Extent(models.Polygon.coordinates)),
+            func.ST_XMax(func.ST_Extent(models.Polygon.coordinates)),
+            func.ST_YMax(func.ST_Extent(models.Polygon.coordinates)),
+        ).one()
+        if extent[0] is None:
+            print("The polygons table is empty; use --seed to add polygons for the run.")
+            return
+        total = db.query(func.count(models.Polygon.id)).scalar()
+        print(f"{total} polygons, extent {tuple(round(value, 4) for value in extent)}")
+
+        rng = random.Random(42)
+        results = {"legacy": [], "envelope": []}
+        for _ in range(args.queries):
+            min_lon = rng.uniform(extent[0], max(extent[0], extent[2] - args.box_degrees))
+            min_lat = rng.uniform(extent[1], max(extent[1], extent[3] - args.box_degrees))
+            bounds = (min_lon, min_lat, min_lon + args.box_degrees, min_lat + args.box_degrees)
+            results["legacy"].append(explain(db, legacy_bounds_query(db, bounds)))
+            results["envelope"].append(explain(db, crud.polygons_within_bounds_query(db, bounds)))
+
+        print()
+        print(f"{'query':<10} {'scans':<40} {'p50 ms':>8} {'max ms':>8} {'rows p50':>9}")
+        for name, runs in results.items():
+            scans = sorted(set().union(*(run["scans"] for run in runs)))
+            timings = [run["execution_ms"] for run in runs]
+            print(
+                f"{name:<10} {', '.join(scans):<40} {statistics.median(timings):>8.2f} "
+                f"{max(timings):>8.2f} {statistics.median(run['rows'] for run in runs):>9.0f}"
+            )
+
+        if any("Seq Scan" in run["scans"] for run in results["envelope"]):
+            print("\nThe envelope query still used a sequential scan; check that idx_polygons_coordinates exists and is valid.")
+    finally:
+        db.rollback()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Compare the raster I/O profiles of app/raster.py against a local S3 stand-in.
+
+A synthetic tiled GeoTIFF with overviews is uploaded to a moto server started in
+process (or to the S3-compatible endpoint given with --endpoint-url, e.g. a MinIO
+container), then every profile reads the same random windows through RasterSource,
+both at full resolution and resampled from overviews.
+
+    python benchmark_raster_io.py
+    python benchmark_raster_io.py --endpoint-url http://localhost:9000 --size 16384 --reads 50
+
+A local stand-in has almost no latency, so it mostly shows the effect of request
+counts, caching and decoding threads; point --endpoint-url at a remote bucket to
+see the effect of multiplexing and range merging on round trips.
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+import statistics
+
+import boto3
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+BENCHMARK_BUCKET = "raster-io-benchmark"
+BENCHMARK_KEY = "benchmark/source.tif"
+
+
+def start_stand_in() -> tuple:
+    # moto is only needed for the benchmark, so it is imported here
+    from moto.server import ThreadedMotoServer
+
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    return server, f"http://{host}:{port}"
+
+
+def configure_endpoint(endpoint_url: str):
+    # GDAL and boto3 both read these from the environment, so they must be set before app.raster is imported
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("AWS_REGION", "us-east-1")
+    os.environ["AWS_S3_ENDPOINT"] = endpoint_url.split("://", 1)[-1]
+    os.environ["AWS_HTTPS"] = "YES" if endpoint_url.startswith("https") else "NO"
+    os.environ["AWS_VIRTUAL_HOSTING"] = "FALSE"
+
+
+def upload_source(endpoint_url: str, size: int) -> str:
+    """
+    Write a synthetic 3-band COG of size x size pixels and upload it to the stand-in.
+
+    Returns:
+        str: The s3:// path of the uploaded raster.
+    """
+    start_time = time.time()
+    s3_client = boto3.client(
+        "s3",
+        endpoint_url=endpoint_url,
+        aws_access_key_id=os.environ["AWS_ACCESS_KEY_ID"],
+        aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"],
+        region_name=os.environ["AWS_REGION"],
+    )
+    try:
+        s3_client.create_bucket(Bucket=BENCHMARK_BUCKET)
+    except s3_client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+
+    with tempfile.TemporaryDirectory(prefix="raster-io-") as tmp_dir:
+        striped_path = os.path.join(tmp_dir, "striped.tif")
+        cog_path = os.path.join(tmp_dir, "cog.tif")
+        profile = {
+            "driver": "GTiff",
+            "width": size,
+            "height": size,
+            "count": 3,
+            "dtype": "uint8",
+            "crs": "EPSG:3857",
+            "transform": from_origin(11560000, 150000, 0.05, 0.05),
+        }
+        rng = np.random.default_rng(0)
+        with rasterio.open(striped_path, "w", **profile) as dst:
+            # Written in row bands so the source never has to fit in memory
+            for row_off in range(0, size, 1024):
+                height = min(1024, size - row_off)
+                # Smooth gradients plus noise compress roughly like aerial imagery
+                base = (np.arange(size, dtype=np.uint16)[np.newaxis, :] + row_off) % 256
+                band = (base + rng.integers(0, 32, (height, size), dtype=np.uint16)).astype(np.uint8)
+                dst.write(np.stack([band, band[::-1], band[:, ::-1]]), window=Window(0, row_off, size, height))
+
+        with rasterio.open(striped_path) as src:
+            rasterio.shutil.copy(src, cog_path, driver="COG", COMPRESS="DEFLATE", BLOCKSIZE=512, OVERVIEWS="AUTO")
+        s3_client.upload_file(cog_path, BENCHMARK_BUCKET, BENCHMARK_KEY)
+        print(f"Uploaded a {size}x{size} COG ({os.path.getsize(cog_path) / 1024 / 1024:.1f} MB) in {time.time() - start_time:.2f} seconds.")
+
+    return f"s3://{BENCHMARK_BUCKET}/{BENCHMARK_KEY}"
+
+
+def plan_windows(size: int, reads: int, window_size: int) -> list:
+    rng = random.Random(42)
+    return [
+        Window(rng.randrange(0, size - window_size), rng.randrange(0, size - window_size), window_size, window_size)
+        for _ in range(reads)
+    ]
+
+
+def benchmark_profile(path: str, profile: str, windows: list, out_size: int) -> dict:
+    from app.raster import RasterSource
+
+    full_times, resampled_times = [], []
+    start_time = time.time()
+    with RasterSource(path, profile=profile) as src:
+        open_seconds = time.time() - start_time
+        for window in windows:
+            read_start = time.time()
+            src.read(window=window)
+            full_times.append(time.time() - read_start)
+
+            read_start = time.time()
+            src.read_resampled((src.count, out_size, out_size), window=window, resampling=Resampling.bilinear)
+            resampled_times.append(time.time() - read_start)
+
+    return {
+        "profile": profile,
+        "open_seconds": open_seconds,
+        "total_seconds": time.time() - start_time,
+        "full_median_ms": statistics.median(full_times) * 1000,
+        "full_p95_ms": sorted(full_times)[int(len(full_times) * 0.95) - 1] * 1000,
+        "resampled_median_ms": statistics.median(resampled_times) * 1000,
+        "resampled_p95_ms": sorted(resampled_times)[int(len(resampled_times) * 0.95) - 1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare raster I/O profiles against a local S3 stand-in.")
+    parser.add_argument("--endpoint-url", help="S3-compatible endpoint to use instead of an in-process moto server")
+    parser.add_argument("--profiles", nargs="+", help="Profiles to compare (default: all)")
+    parser.add_argument("--size", type=int, default=8192, help="Width and height of the synthetic raster")
+    parser.add_argument("--reads", type=int, default=20, help="Number of windows read per profile")
+    parser.add_argument("--window-size", type=int, default=2048, help="Width and height of each window")
+    parser.add_argument("--out-size", type=int, default=512, help="Output size of the resampled reads")
+    parser.add_argument("--repeat", type=int, default=2, help="Runs per profile; the fastest is reported")
+    args = parser.parse_args()
+
+    server = None
+    endpoint_url = args.endpoint_url
+    if endpoint_url is None:
+        server, endpoint_url = start_stand_in()
+        print(f"Started moto S3 stand-in at {endpoint_url}")
+    configure_endpoint(endpoint_url)
+
+    try:
+        from app.raster import IO_PROFILES
+
+        path = upload_source(endpoint_url, args.size)
+        windows = plan_windows(args.size, args.reads, args.window_size)
+        profiles = args.profiles or list(IO_PROFILES)
+
+        results = []
+        for profile in profiles:
+            runs = [benchmark_profile(path, profile, windows, args.out_size) for _ in range(args.repeat)]
+            results.append(min(runs, key=lambda run: run["total_seconds"]))
+
+        print()
+        print(f"{'profile':<12} {'open s':>8} {'total s':>8} {'full p50 ms':>12} {'full p95 ms':>12} {'resampled p50 ms':>17} {'resampled p95 ms':>17}")
+        for result in results:
+            print(
+                f"{result['profile']:<12} {result['open_seconds']:>8.2f} {result['total_seconds']:>8.2f} "
+                f"{result['full_median_ms']:>12.1f} {result['full_p95_ms']:>12.1f} "
+                f"{result['resampled_median_ms']:>17.1f} {result['resampled_p95_ms']:>17.1f}"
+            )
+    finally:
+        if server is not None:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
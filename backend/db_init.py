@@ -34,7 +34,7 @@ class Polygon(Base):
     name = Column(String, index=True)
     address = Column(String, index=True)
     type = Column(String, index=True)
-    coordinates = Column(Geometry('POLYGON'))
+    coordinates = Column(Geometry('POLYGON', srid=4326))
 
     def __repr__(self):
         return f"<Polygon(id={self.id}, name={self.name}, address={self.address}, type={self.type})>"